@@ -0,0 +1,54 @@
+import hashlib
+from enum import Enum
+
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+class PayloadSection(Enum):
+    INFO = "info"
+    STATE = "state"
+    SEGMENTS = "segments"
+    PRESETS = "presets"
+
+
+class SectionHashCache(object):
+    """Content hash of the last scraped payload of each WLED instance, per
+    section, so unchanged sections can skip metric extraction"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_CHANGE_DETECTION", "false")
+
+    @classmethod
+    def get_digest(cls, *parts):
+        # The wled models are dataclasses, their repr covers every field
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).digest()
+
+    def __init__(self):
+        self._digests = {}
+
+    def is_unchanged(self, device_ip, section, digest):
+        if self._digests.get((device_ip, section)) != digest:
+            return False
+        Metrics.WLED_SCRAPER_SECTIONS_SKIPPED.labels(
+            section=section.value,
+        ).inc()
+        return True
+
+    def remember(self, device_ip, section, digest):
+        self._digests[(device_ip, section)] = digest
+
+    def forget(self, device_ip):
+        for key in list(self._digests.keys()):
+            if key[0] == device_ip:
+                del self._digests[key]
+
+    def reset(self):
+        self._digests.clear()
+
+
+# Global section hash cache instance
+section_hashes = SectionHashCache()
@@ -0,0 +1,148 @@
+import time
+from enum import Enum
+
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+class CircuitBreakerOpenException(Exception):
+    pass
+
+
+class CircuitState(Enum):
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+
+class CircuitBreaker(object):
+    """Stops calling a device after repeated failures, probing it later"""
+
+    def __init__(
+        self, name, failure_threshold, reset_timeout, clock=time.monotonic
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = CircuitState.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._export_state()
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def consecutive_failures(self):
+        return self._consecutive_failures
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    def allow_request(self):
+        """Whether a call may go out, moving an expired open circuit to half-open"""
+        if not self.enabled or self._state == CircuitState.CLOSED:
+            return True
+        if self._state == CircuitState.OPEN:
+            if self._clock() - self._opened_at < self.reset_timeout:
+                return False
+            log.info(f"Circuit for {self.name} is half-open, probing")
+            self._set_state(CircuitState.HALF_OPEN)
+        # Only a single probe at a time while half-open
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def release_probe(self):
+        """Give up a probe without an outcome, e.g. when it was cancelled"""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        if self._state != CircuitState.CLOSED:
+            log.info(f"Circuit for {self.name} closed, device recovered")
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+        self._set_state(CircuitState.CLOSED)
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        self._probe_in_flight = False
+        if not self.enabled:
+            return
+        if (
+            self._state == CircuitState.HALF_OPEN
+            or self._consecutive_failures >= self.failure_threshold
+        ):
+            if self._state != CircuitState.OPEN:
+                log.warning(
+                    f"Circuit for {self.name} opened after "
+                    f"{self._consecutive_failures} consecutive failures"
+                )
+            self._opened_at = self._clock()
+            self._set_state(CircuitState.OPEN)
+
+    def _set_state(self, state):
+        self._state = state
+        self._export_state()
+
+    def _export_state(self):
+        Metrics.WLED_CLIENT_CIRCUIT_BREAKER_STATE.labels(
+            ip=self.name,
+        ).set(self._state.value)
+
+
+class CircuitBreakerRegistry(object):
+    """Process wide circuit breakers, one per WLED instance"""
+
+    @classmethod
+    def get_failure_threshold(cls):
+        """Consecutive failures before a circuit opens (0 disables)"""
+        return EnvHelper.get_int(
+            "WLED_CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5, minimum=0
+        )
+
+    @classmethod
+    def get_reset_timeout_seconds(cls):
+        """How long a circuit stays open before a half-open probe"""
+        return EnvHelper.get_float(
+            "WLED_CIRCUIT_BREAKER_RESET_SECONDS", 300, minimum=0
+        )
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._breakers = {}
+
+    def get_breaker(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                failure_threshold=self.get_failure_threshold(),
+                reset_timeout=self.get_reset_timeout_seconds(),
+                clock=self._clock,
+            )
+            self._breakers[name] = breaker
+        return breaker
+
+    def remove_breaker(self, name):
+        if self._breakers.pop(name, None) is None:
+            return
+        try:
+            Metrics.WLED_CLIENT_CIRCUIT_BREAKER_STATE.remove(name)
+        except KeyError:
+            pass
+
+    def reset(self):
+        for name in list(self._breakers.keys()):
+            self.remove_breaker(name)
+
+
+# Global circuit breaker registry instance
+circuit_breakers = CircuitBreakerRegistry()
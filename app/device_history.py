@@ -0,0 +1,247 @@
+import math
+import time
+from array import array
+
+import orjson
+
+from .metrics import Metrics
+from .raw_scraper import RawDevice
+from .shared_metrics import SharedFile
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+NAN = float("nan")
+DEVICE_HISTORY_FILE_NAME = "wargos_device_history.json"
+
+
+def _raw_getter(*path):
+    def getter(info):
+        for key in path:
+            if not isinstance(info, dict):
+                return None
+            info = info.get(key)
+        return info
+
+    return getter
+
+
+def _model_getter(*path):
+    def getter(info):
+        for attribute in path:
+            info = getattr(info, attribute, None)
+        return info
+
+    return getter
+
+
+# field -> (getter of a /json info payload, getter of a wled.Info model)
+HISTORY_FIELDS = {
+    "rssi": (_raw_getter("wifi", "rssi"), _model_getter("wifi", "rssi")),
+    "fps": (_raw_getter("leds", "fps"), _model_getter("leds", "fps")),
+    "power": (_raw_getter("leds", "pwr"), _model_getter("leds", "power")),
+    "free_heap": (_raw_getter("freeheap"), _model_getter("free_heap")),
+}
+
+
+class DeviceHistory(object):
+    """Fixed size ring buffer of samples of one device, a column of
+    doubles per field plus one of timestamps, so memory never grows"""
+
+    def __init__(self, capacity, fields=tuple(HISTORY_FIELDS)):
+        self.capacity = capacity
+        self.fields = fields
+        self._timestamps = array("d", [NAN]) * capacity
+        self._columns = {
+            field: array("d", [NAN]) * capacity for field in fields
+        }
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def last_timestamp(self):
+        if not self._count:
+            return None
+        return self._timestamps[(self._next - 1) % self.capacity]
+
+    @property
+    def memory_bytes(self):
+        columns = [self._timestamps, *self._columns.values()]
+        return sum(column.itemsize * len(column) for column in columns)
+
+    def append(self, timestamp, values):
+        index = self._next
+        self._timestamps[index] = timestamp
+        for field, column in self._columns.items():
+            value = values.get(field)
+            column[index] = NAN if value is None else value
+        self._next = (index + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def _indexes_since(self, since):
+        start = (self._next - self._count) % self.capacity
+        indexes = [
+            (start + offset) % self.capacity for offset in range(self._count)
+        ]
+        if since is not None:
+            indexes = [
+                index for index in indexes if self._timestamps[index] >= since
+            ]
+        return indexes
+
+    def query(self, fields=None, since=None, max_points=None):
+        """Samples oldest first, averaged into at most max_points buckets
+        stamped with the time of their first sample"""
+        fields = list(fields or self.fields)
+        indexes = self._indexes_since(since)
+        bucket_size = 1
+        if max_points and len(indexes) > max_points:
+            bucket_size = math.ceil(len(indexes) / max_points)
+        buckets = [
+            indexes[offset : offset + bucket_size]
+            for offset in range(0, len(indexes), bucket_size)
+        ]
+        result = {
+            "timestamps": [self._timestamps[bucket[0]] for bucket in buckets],
+            "fields": {},
+        }
+        for field in fields:
+            column = self._columns[field]
+            points = []
+            for bucket in buckets:
+                values = [
+                    column[index]
+                    for index in bucket
+                    if not math.isnan(column[index])
+                ]
+                points.append(sum(values) / len(values) if values else None)
+            result["fields"][field] = points
+        return result
+
+    @classmethod
+    def from_samples(cls, capacity, samples):
+        """Rebuild from the result of an unbucketed query()"""
+        history = cls(capacity)
+        fields = samples["fields"]
+        for index, timestamp in enumerate(samples["timestamps"]):
+            history.append(
+                timestamp,
+                {
+                    field: points[index]
+                    for field, points in fields.items()
+                    if field in history._columns
+                },
+            )
+        return history
+
+
+class DeviceHistoryStore(object):
+    """Recent samples of each WLED instance, one row per scrape"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_DEVICE_HISTORY", "false")
+
+    @classmethod
+    def get_capacity(cls):
+        # 12 hours at the default 60s interval, or one hour at 5s
+        return EnvHelper.get_int("WLED_HISTORY_SAMPLES", 720, minimum=1)
+
+    @classmethod
+    def get_values(cls, device):
+        """The history fields of a scraped device or raw payload"""
+        source = 0 if isinstance(device, RawDevice) else 1
+        return {
+            field: getters[source](device.info)
+            for field, getters in HISTORY_FIELDS.items()
+        }
+
+    @classmethod
+    def get_device_ip(cls, device, default):
+        if isinstance(device, RawDevice):
+            return device.info.get("ip") or default
+        return getattr(device.info, "ip", None) or default
+
+    def __init__(self, clock=time.time, shared_file=None):
+        self._clock = clock
+        self._histories = {}
+        self._shared_file = shared_file or SharedFile(DEVICE_HISTORY_FILE_NAME)
+
+    def record(self, device_ip, values, min_interval=None):
+        """Append a row, unless the last one is less than `min_interval`
+        seconds old"""
+        now = self._clock()
+        history = self._histories.get(device_ip)
+        if history is None:
+            history = self._histories[device_ip] = DeviceHistory(
+                self.get_capacity()
+            )
+            self._set_memory_metric()
+        elif min_interval and history.last_timestamp is not None:
+            if now - history.last_timestamp < min_interval:
+                return history
+        history.append(now, values)
+        return history
+
+    def record_device(self, device, default_ip=None, min_interval=None):
+        """Append a row for a device fetched by a scrape"""
+        device_ip = self.get_device_ip(device, default_ip)
+        return self.record(
+            device_ip, self.get_values(device), min_interval=min_interval
+        )
+
+    def get(self, device_ip):
+        return self._histories.get(device_ip)
+
+    def remove(self, device_ip):
+        if self._histories.pop(device_ip, None) is not None:
+            self._set_memory_metric()
+
+    def reset(self):
+        self._histories = {}
+        self._set_memory_metric()
+
+    def memory_bytes(self):
+        return sum(
+            history.memory_bytes for history in self._histories.values()
+        )
+
+    def dumps(self):
+        return orjson.dumps(
+            {
+                device_ip: history.query()
+                for device_ip, history in self._histories.items()
+            }
+        )
+
+    def loads(self, body):
+        """Replace the histories with the ones of a dumps() body"""
+        capacity = self.get_capacity()
+        self._histories = {
+            device_ip: DeviceHistory.from_samples(capacity, samples)
+            for device_ip, samples in orjson.loads(body).items()
+        }
+        self._set_memory_metric()
+
+    def publish(self):
+        """Write the histories for the workers that don't scrape"""
+        self._shared_file.write(self.dumps())
+
+    def refresh(self):
+        """Load what the scraping worker published, if it changed"""
+        body = self._shared_file.read_changed()
+        if body is None:
+            return False
+        self.loads(body)
+        return True
+
+    def _set_memory_metric(self):
+        # Only changes when a device is added or removed
+        Metrics.DEVICE_HISTORY_MEMORY_BYTES.set(self.memory_bytes())
+
+
+# Global device history store instance
+device_histories = DeviceHistoryStore()
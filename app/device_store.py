@@ -0,0 +1,201 @@
+import hashlib
+import time
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+
+import orjson
+
+from .shared_metrics import SharedFile
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+# Presets are keyed by their integer id
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+DEVICE_STATES_FILE_NAME = "wargos_device_states.json"
+
+
+def make_etag(body):
+    return f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def is_not_modified(headers, etag, modified_at):
+    """Whether the conditional request headers match the current version"""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have whole seconds
+        return int(modified_at) <= since
+    return False
+
+
+@dataclass(frozen=True)
+class DeviceRecord:
+    """Last scraped payloads of one WLED instance, rendered once"""
+
+    device_ip: str
+    info: dict
+    state: dict
+    presets: dict
+    modified_at: float
+    body: bytes
+    etag: str
+
+    @classmethod
+    def build(cls, device_ip, info, state, presets, modified_at):
+        body = orjson.dumps(
+            {
+                "ip": device_ip,
+                "modified_at": modified_at,
+                "info": info,
+                "state": state,
+                "presets": presets,
+            },
+            option=JSON_OPTIONS,
+        )
+        return cls(
+            device_ip=device_ip,
+            info=info,
+            state=state,
+            presets=presets,
+            modified_at=modified_at,
+            body=body,
+            etag=make_etag(body),
+        )
+
+    def summary(self):
+        return {
+            "ip": self.device_ip,
+            "name": self.info.get("name"),
+            "version": self.info.get("ver"),
+            "on": self.state.get("on"),
+            "brightness": self.state.get("bri"),
+            "modified_at": self.modified_at,
+        }
+
+
+class DeviceStateStore(object):
+    """Last scraped state of each WLED instance, so it can be read any
+    number of times without querying the device"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_DEVICE_STATE_STORE", "false")
+
+    def __init__(self, clock=time.time, shared_file=None):
+        self._clock = clock
+        self._records = {}
+        self._listing = None
+        self._shared_file = shared_file or SharedFile(DEVICE_STATES_FILE_NAME)
+
+    def update(self, device_ip, info=None, state=None, presets=None):
+        """Store the parts that were scraped, keep the others"""
+        previous = self._records.get(device_ip)
+        if state is not None and isinstance(state.get("seg"), dict):
+            # Device models key segments by id, payloads list them
+            state = dict(state, seg=list(state["seg"].values()))
+        if previous is not None:
+            info = previous.info if info is None else info
+            state = previous.state if state is None else state
+            presets = previous.presets if presets is None else presets
+            if (info, state, presets) == (
+                previous.info,
+                previous.state,
+                previous.presets,
+            ):
+                return previous
+        record = DeviceRecord.build(
+            device_ip,
+            info or {},
+            state or {},
+            presets or {},
+            self._clock(),
+        )
+        # Copy on write, requests being served keep a consistent view
+        self._records = {**self._records, device_ip: record}
+        self._listing = None
+        return record
+
+    def get(self, device_ip):
+        return self._records.get(device_ip)
+
+    def get_listing(self):
+        """(body, etag, modified_at) of the summary of every device"""
+        if self._listing is None:
+            records = sorted(
+                self._records.values(), key=lambda record: record.device_ip
+            )
+            body = orjson.dumps(
+                {"devices": [record.summary() for record in records]}
+            )
+            modified_at = max(
+                (record.modified_at for record in records), default=0
+            )
+            self._listing = (body, make_etag(body), modified_at)
+        return self._listing
+
+    def remove(self, device_ip):
+        records = dict(self._records)
+        records.pop(device_ip, None)
+        self._records = records
+        self._listing = None
+
+    def reset(self):
+        self._records = {}
+        self._listing = None
+
+    def dumps(self):
+        return orjson.dumps(
+            [
+                {
+                    "ip": record.device_ip,
+                    "info": record.info,
+                    "state": record.state,
+                    "presets": record.presets,
+                    "modified_at": record.modified_at,
+                }
+                for record in self._records.values()
+            ],
+            option=JSON_OPTIONS,
+        )
+
+    def loads(self, body):
+        """Replace the records with the ones of a dumps() body"""
+        self._records = {
+            item["ip"]: DeviceRecord.build(
+                item["ip"],
+                item["info"],
+                item["state"],
+                item["presets"],
+                item["modified_at"],
+            )
+            for item in orjson.loads(body)
+        }
+        self._listing = None
+
+    def publish(self):
+        """Write the records for the workers that don't scrape"""
+        self._shared_file.write(self.dumps())
+
+    def refresh(self):
+        """Load what the scraping worker published, if it changed"""
+        body = self._shared_file.read_changed()
+        if body is None:
+            return False
+        self.loads(body)
+        return True
+
+
+# Global device state store instance
+device_states = DeviceStateStore()
@@ -0,0 +1,270 @@
+import asyncio
+import contextlib
+import ipaddress
+import os
+import time
+from dataclasses import dataclass
+
+from .inventory import InventoryChange
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+from .wled_client import WLEDClient
+
+log = LogHelper.get_env_logger(__name__)
+
+
+@dataclass
+class AddressEntry:
+    """Discovery state of a single address of the swept ranges"""
+
+    next_due: float
+    found: bool = False
+    misses: int = 0
+
+
+def parse_cidrs(raw_cidrs):
+    """Networks of a comma separated list like `10.0.1.0/24,10.0.2.0/25`"""
+    networks = []
+    for raw_cidr in raw_cidrs.split(","):
+        if not raw_cidr.strip():
+            continue
+        try:
+            networks.append(
+                ipaddress.ip_network(raw_cidr.strip(), strict=False)
+            )
+        except ValueError:
+            log.error(f"Invalid discovery range: {raw_cidr}")
+    return networks
+
+
+class SubnetDiscovery(object):
+    """Sweeps CIDR ranges for WLED instances to scrape, found devices are
+    checked again often and empty addresses rarely"""
+
+    # A found device that stops answering is only dropped after a few sweeps
+    MAX_MISSES = 3
+    # Refuse ranges like a /8, that would be millions of probes
+    MAX_ADDRESSES = 65536
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_DISCOVERY", "false")
+
+    @classmethod
+    def get_cidrs(cls):
+        return parse_cidrs(os.environ.get("WLED_DISCOVERY_CIDRS", ""))
+
+    @classmethod
+    def get_max_concurrency(cls):
+        return EnvHelper.get_int(
+            "WLED_DISCOVERY_MAX_CONCURRENCY", 64, minimum=1
+        )
+
+    @classmethod
+    def get_connect_timeout_seconds(cls):
+        return EnvHelper.get_float(
+            "WLED_DISCOVERY_CONNECT_TIMEOUT_SECONDS", 0.5, minimum=0.01
+        )
+
+    @classmethod
+    def get_info_timeout_seconds(cls):
+        return EnvHelper.get_float(
+            "WLED_DISCOVERY_INFO_TIMEOUT_SECONDS", 2, minimum=0.01
+        )
+
+    @classmethod
+    def get_device_interval_seconds(cls):
+        """How often a found device is checked to still be there"""
+        return EnvHelper.get_float(
+            "WLED_DISCOVERY_DEVICE_INTERVAL_SECONDS", 300, minimum=0
+        )
+
+    @classmethod
+    def get_empty_interval_seconds(cls):
+        """How often an address without a device is probed again"""
+        return EnvHelper.get_float(
+            "WLED_DISCOVERY_EMPTY_INTERVAL_SECONDS", 3600, minimum=0
+        )
+
+    @classmethod
+    def get_tick_seconds(cls):
+        """How often due addresses are swept"""
+        return EnvHelper.get_float(
+            "WLED_DISCOVERY_TICK_SECONDS", 60, minimum=0.1
+        )
+
+    @classmethod
+    def can_run_in_workers(cls, leader_election):
+        """Every worker would sweep and scrape its own discovered devices,
+        so more than one worker needs leader election"""
+        return leader_election is not None or EnvHelper.get_worker_count() == 1
+
+    @classmethod
+    def get_discovery(cls):
+        return cls(
+            cls.get_cidrs(),
+            max_concurrency=cls.get_max_concurrency(),
+            connect_timeout=cls.get_connect_timeout_seconds(),
+            info_timeout=cls.get_info_timeout_seconds(),
+            device_interval=cls.get_device_interval_seconds(),
+            empty_interval=cls.get_empty_interval_seconds(),
+        )
+
+    @classmethod
+    def is_wled_info(cls, info):
+        """Whether a /json/info payload comes from WLED"""
+        return isinstance(info, dict) and "ver" in info and "leds" in info
+
+    def __init__(
+        self,
+        cidrs=(),
+        port=80,
+        max_concurrency=64,
+        connect_timeout=0.5,
+        info_timeout=2,
+        device_interval=300,
+        empty_interval=3600,
+        clock=time.monotonic,
+    ):
+        self._port = port
+        self._max_concurrency = max_concurrency
+        self._connect_timeout = connect_timeout
+        self._info_timeout = info_timeout
+        self._device_interval = device_interval
+        self._empty_interval = empty_interval
+        self._clock = clock
+        self._addresses = {}
+        for network in cidrs:
+            if network.num_addresses > self.MAX_ADDRESSES:
+                log.error(f"Discovery range {network} is too large, skipped")
+                continue
+            for address in network.hosts():
+                self._addresses[str(address)] = AddressEntry(next_due=0)
+        self._task = None
+
+    @property
+    def devices(self):
+        """Addresses currently known to be WLED instances"""
+        return [ip for ip, entry in self._addresses.items() if entry.found]
+
+    def get_entry(self, device_ip):
+        return self._addresses.get(device_ip)
+
+    def pop_due(self):
+        now = self._clock()
+        return [
+            ip
+            for ip, entry in self._addresses.items()
+            if entry.next_due <= now
+        ]
+
+    def _get_host(self, device_ip):
+        if self._port == 80:
+            return device_ip
+        return f"{device_ip}:{self._port}"
+
+    async def probe(self, device_ip):
+        """A cheap TCP connect first, then the /json/info fingerprint of
+        the addresses that accepted it. Returns the probe result"""
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(device_ip, self._port),
+                timeout=self._connect_timeout,
+            )
+        except (OSError, asyncio.TimeoutError):
+            return "closed"
+        writer.close()
+        with contextlib.suppress(OSError):
+            await writer.wait_closed()
+        try:
+            async with asyncio.timeout(self._info_timeout):
+                info = await WLEDClient.get_client().get_wled_instance_info(
+                    self._get_host(device_ip)
+                )
+        except Exception as e:
+            log.debug(f"Discovery: {device_ip} is open but not WLED: {e}")
+            return "open"
+        return "wled" if self.is_wled_info(info) else "open"
+
+    async def sweep(self):
+        """Probe the due addresses with bounded fan-out. Returns the
+        InventoryChange of the devices that appeared or disappeared"""
+        due = self.pop_due()
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        async def bounded_probe(device_ip):
+            async with semaphore:
+                return await self.probe(device_ip)
+
+        with Metrics.DISCOVERY_SWEEP_TIME.time():
+            results = await asyncio.gather(
+                *(bounded_probe(device_ip) for device_ip in due)
+            )
+        added = []
+        removed = []
+        for device_ip, result in zip(due, results):
+            Metrics.DISCOVERY_PROBES.labels(result=result).inc()
+            was_found = self._addresses[device_ip].found
+            is_found = self._record(device_ip, result == "wled")
+            if is_found and not was_found:
+                added.append(device_ip)
+            elif was_found and not is_found:
+                removed.append(device_ip)
+        if due:
+            log.info(
+                f"Discovery swept {len(due)} addresses: "
+                f"{results.count('wled')} WLED, "
+                f"{len(added)} new, {len(removed)} gone"
+            )
+        devices = len(self.devices)
+        # Over the whole ranges, later sweeps mostly probe found devices
+        if self._addresses:
+            Metrics.DISCOVERY_RANGE_HIT_RATIO.set(
+                devices / len(self._addresses)
+            )
+        Metrics.DISCOVERY_DEVICES.set(devices)
+        return InventoryChange(added=tuple(added), removed=tuple(removed))
+
+    def _record(self, device_ip, is_wled):
+        entry = self._addresses[device_ip]
+        if is_wled:
+            entry.found = True
+            entry.misses = 0
+        elif entry.found:
+            entry.misses += 1
+            entry.found = entry.misses < self.MAX_MISSES
+        interval = self._device_interval
+        if not entry.found:
+            interval = self._empty_interval
+        entry.next_due = self._clock() + interval
+        return entry.found
+
+    async def run(self, is_active=None, on_change=None):
+        """Sweep the due addresses every tick, while `is_active` allows"""
+        tick = self.get_tick_seconds()
+        while True:
+            if is_active is None or is_active():
+                try:
+                    change = await self.sweep()
+                    if change and on_change is not None:
+                        on_change(change)
+                except Exception as e:
+                    log.error(f"Discovery sweep failed: {e}")
+            await asyncio.sleep(tick)
+
+    def start(self, is_active=None, on_change=None):
+        self._task = asyncio.create_task(
+            self.run(is_active=is_active, on_change=on_change)
+        )
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+# Global subnet discovery instance
+subnet_discovery = SubnetDiscovery.get_discovery()
@@ -0,0 +1,187 @@
+import math
+
+from prometheus_client import REGISTRY, Gauge, generate_latest
+from prometheus_client.utils import floatToGoString
+
+from .snapshot import DeviceSnapshotCollector
+from .utils import EnvHelper, LogHelper
+
+try:
+    # Private helpers of prometheus_client, the writer escapes and checks
+    # names exactly like it. If they move, generate_latest() is used
+    from prometheus_client.openmetrics.exposition import (
+        _escape,
+        escape_label_name,
+    )
+    from prometheus_client.validation import _is_valid_legacy_metric_name
+except ImportError:
+    _escape = escape_label_name = _is_valid_legacy_metric_name = None
+
+log = LogHelper.get_env_logger(__name__)
+
+if _escape is None:
+    log.warning(
+        "prometheus_client escaping helpers not found, "
+        "ENABLE_FAST_EXPOSITION falls back to generate_latest()"
+    )
+
+# Enough for the usual gauge values, uptimes and heaps churn through it
+MAX_CACHED_VALUES = 8192
+MAX_CACHED_LABEL_PAIRS = 65536
+ZERO = b"0.0\n"
+MINUS_ZERO = b"-0.0\n"
+
+
+class _SingleFamily(object):
+    """Lets generate_latest() render one already collected family"""
+
+    def __init__(self, family):
+        self._family = family
+
+    def collect(self):
+        return [self._family]
+
+
+class _CollectorList(object):
+    """Lets generate_latest() render part of a registry"""
+
+    def __init__(self, collectors):
+        self._collectors = collectors
+
+    def collect(self):
+        for collector in self._collectors:
+            yield from collector.collect()
+
+
+class ExpositionWriter(object):
+    """Renders a registry in the same text format as generate_latest(), but
+    writes labelled gauges (and device snapshots) from cached line prefixes
+    into one reused buffer. Other families use prometheus_client itself"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_FAST_EXPOSITION", "false")
+
+    @classmethod
+    def can_render(cls, registry=None):
+        if _is_valid_legacy_metric_name is None:
+            return False
+        # Target info has its own collect logic. Multiprocess values read
+        # the same, aggregating them takes a separate collector anyway
+        return not getattr(registry, "_target_info", None)
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # metric name -> label values -> b'name{sorted="labels"} '
+        self._prefixes = {}
+        self._headers = {}
+        self._label_pairs = {}
+        self._values = {}
+
+    def render(self, registry=REGISTRY):
+        if not self.can_render(registry):
+            return generate_latest(registry)
+        with registry._lock:
+            collectors = list(registry._collector_to_names)
+        return self.render_collectors(collectors)
+
+    def render_collectors(self, collectors):
+        """Renders the given collectors of a registry, in their order"""
+        out = self._buffer
+        del out[:]
+        for collector in collectors:
+            if isinstance(collector, DeviceSnapshotCollector):
+                for metric, samples in collector.collect_samples():
+                    self._write_family(out, metric, samples)
+            elif self._is_fast_gauge(collector):
+                with collector._lock:
+                    children = list(collector._metrics.items())
+                self._write_family(
+                    out,
+                    collector,
+                    [
+                        (label_values, child._value.get())
+                        for label_values, child in children
+                    ],
+                )
+            else:
+                for family in collector.collect():
+                    out += generate_latest(_SingleFamily(family))
+        return bytes(out)
+
+    @classmethod
+    def _is_fast_gauge(cls, collector):
+        return (
+            type(collector) is Gauge
+            and bool(collector._labelnames)
+            and not collector._unit
+            and _is_valid_legacy_metric_name(collector._name)
+        )
+
+    def _write_family(self, out, metric, samples):
+        name = metric._name
+        header = self._headers.get(name)
+        if header is None:
+            documentation = metric._documentation
+            documentation = documentation.replace("\\", r"\\")
+            documentation = documentation.replace("\n", r"\n")
+            header = self._headers[name] = (
+                f"# HELP {name} {documentation}\n# TYPE {name} gauge\n"
+            ).encode("utf-8")
+        out += header
+        prefixes = self._prefixes.get(name)
+        if prefixes is None or len(prefixes) > 2 * len(samples) + 64:
+            # Drop prefixes of series that went away
+            prefixes = self._prefixes[name] = {}
+        values = self._values
+        if len(values) > MAX_CACHED_VALUES:
+            values.clear()
+        if len(self._label_pairs) > MAX_CACHED_LABEL_PAIRS:
+            self._label_pairs.clear()
+        for label_values, value in samples:
+            prefix = prefixes.get(label_values)
+            if prefix is None:
+                prefix = prefixes[label_values] = self._format_prefix(
+                    name, metric._labelnames, label_values
+                )
+            if not value:
+                # 0.0 and -0.0 share a dict slot but render differently
+                formatted = ZERO if math.copysign(1, value) > 0 else MINUS_ZERO
+            else:
+                formatted = values.get(value)
+            if formatted is None:
+                formatted = values[value] = (
+                    floatToGoString(value) + "\n"
+                ).encode("utf-8")
+            out += prefix
+            out += formatted
+
+    def _format_prefix(self, name, label_names, label_values):
+        pairs = []
+        for label_name, label_value in sorted(zip(label_names, label_values)):
+            key = (label_name, label_value)
+            pair = self._label_pairs.get(key)
+            if pair is None:
+                pair = self._label_pairs[key] = (
+                    f'{escape_label_name(label_name)}="{_escape(label_value)}"'
+                )
+            pairs.append(pair)
+        return f"{name}{{{','.join(pairs)}}} ".encode("utf-8")
+
+
+def render_metrics(registry=REGISTRY):
+    """The /metrics body, from the fast writer when it is enabled"""
+    if ExpositionWriter.is_enabled():
+        return exposition_writer.render(registry)
+    return generate_latest(registry)
+
+
+def render_collectors(collectors):
+    """Like render_metrics(), for only some collectors of a registry"""
+    if ExpositionWriter.is_enabled() and ExpositionWriter.can_render():
+        return exposition_writer.render_collectors(collectors)
+    return generate_latest(_CollectorList(collectors))
+
+
+# Global exposition writer instance
+exposition_writer = ExpositionWriter()
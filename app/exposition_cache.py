@@ -0,0 +1,89 @@
+import gzip
+import time
+
+from .shared_metrics import render_exposition
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+def _get_quality(params):
+    """The q value of a coding's parameters, malformed ones refuse it"""
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0
+    return 1
+
+
+def accepts_gzip(accept_encoding):
+    """Whether an `Accept-Encoding` header allows a gzip response. An
+    explicit gzip entry wins over `*`, and q=0 refuses the coding"""
+    qualities = {}
+    for coding in (accept_encoding or "").split(","):
+        name, *params = coding.split(";")
+        qualities[name.strip().lower()] = _get_quality(params)
+    quality = qualities.get("gzip", qualities.get("*", 0))
+    return quality > 0
+
+
+class ExpositionCache(object):
+    """Rendered /metrics bytes and their gzip copy, kept until a scrape
+    changes the device metrics (or the optional TTL runs out)"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_EXPOSITION_CACHE", "false")
+
+    @classmethod
+    def get_ttl_seconds(cls):
+        # 0 keeps the rendering until the next invalidation
+        return EnvHelper.get_float(
+            "METRICS_EXPOSITION_CACHE_TTL_SECONDS", 0, minimum=0
+        )
+
+    @classmethod
+    def get_gzip_level(cls):
+        return min(9, EnvHelper.get_int("METRICS_GZIP_LEVEL", 6, minimum=1))
+
+    def __init__(self, render=render_exposition, clock=time.monotonic):
+        self._render = render
+        self._clock = clock
+        self._generation = 0
+        self._body = None
+        self._gzip_body = None
+        self._body_generation = None
+        self._rendered_at = None
+
+    def invalidate(self):
+        # Only bump a counter, this is called for every scraped device
+        self._generation += 1
+
+    def is_fresh(self):
+        if self._body is None or self._body_generation != self._generation:
+            return False
+        ttl = self.get_ttl_seconds()
+        return not ttl or self._clock() - self._rendered_at < ttl
+
+    def get(self, use_gzip=False):
+        """The exposition body, and whether it is gzip compressed"""
+        if not self.is_fresh():
+            generation = self._generation
+            self._body = self._render()
+            self._gzip_body = None
+            self._body_generation = generation
+            self._rendered_at = self._clock()
+        if not use_gzip:
+            return self._body, False
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(
+                self._body, compresslevel=self.get_gzip_level()
+            )
+        return self._gzip_body, True
+
+
+# Global exposition cache instance
+exposition_cache = ExpositionCache()
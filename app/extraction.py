@@ -0,0 +1,797 @@
+import collections
+import os
+import time
+from dataclasses import dataclass
+from enum import Enum
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+from .change_detection import PayloadSection, section_hashes
+from .exposition_cache import exposition_cache
+from .metrics import Metrics
+from .scrape_intervals import scrape_intervals
+from .snapshot import DeviceSnapshotStore, device_snapshots
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+COLOR_PRIORITIES = ("primary", "secondary", "tertiary")
+
+
+class MetricScope(Enum):
+    INFO = "info"
+    STATE = "state"
+    SEGMENT = "segment"
+    COLOR = "color"
+    PRESETS = "presets"
+    PRESET = "preset"
+
+
+@dataclass(frozen=True)
+class MetricSpec:
+    """Maps a JSON path of a WLED payload to a metric
+
+    The path is read from the scope's data (the info or state dict, a
+    single segment, color value or preset) and set as `value or 0` unless
+    a transform, a constant value or a label to copy the value from is
+    given. Extra labels are computed from the scope's data.
+    """
+
+    family: str
+    scope: MetricScope
+    metric: Any
+    path: tuple = ()
+    default: Any = 0
+    transform: Optional[Callable] = None
+    value: Optional[float] = None
+    label_value: Optional[str] = None
+    labels: tuple = ()
+
+
+def not_active(value):
+    # WLED uses -1 for no preset, playlist or WebSocket support
+    return value if value and value != -1 else 0
+
+
+def get_architecture(info):
+    architecture = info.get("arch", "unknown").lower()
+    if architecture == "esp8266" and "fs" in info:
+        total = info["fs"].get("t", 1)
+        if total <= 256:
+            return "esp01"
+        if total <= 512:
+            return "esp02"
+    return architecture
+
+
+def get_version(info):
+    version = info.get("ver")
+    return str(version) if version else "None"
+
+
+def get_preset_quick_label(preset):
+    return preset.get("ql") or "missing"
+
+
+def _info(family, metric, *path, **kwargs):
+    return MetricSpec(family, MetricScope.INFO, metric, path, **kwargs)
+
+
+def _state(family, metric, *path, **kwargs):
+    return MetricSpec(family, MetricScope.STATE, metric, path, **kwargs)
+
+
+def _segment(metric, *path, **kwargs):
+    return MetricSpec("segments", MetricScope.SEGMENT, metric, path, **kwargs)
+
+
+def _preset(metric, *path, **kwargs):
+    return MetricSpec("presets", MetricScope.PRESET, metric, path, **kwargs)
+
+
+# Defaults follow the wled models, so both scrape paths export the same
+METRIC_SPECS = (
+    _info(
+        "info",
+        Metrics.INSTANCE_INFO,
+        value=1,
+        labels=(
+            ("architecture", get_architecture),
+            ("arduino_core_version", lambda i: i.get("core", "Unknown")),
+            ("brand", lambda i: i.get("brand", "WLED")),
+            ("build", lambda i: i.get("vid", "Unknown")),
+            ("mac_address", lambda i: i.get("mac", "")),
+            ("product", lambda i: i.get("product", "DIY Light")),
+            ("version", get_version),
+        ),
+    ),
+    _info("info", Metrics.INSTANCE_FREE_HEAP, "freeheap"),
+    _info("info", Metrics.INSTANCE_PALETTE_COUNT_VALUE, "palcount"),
+    _info("info", Metrics.INSTANCE_EFFECT_COUNT_VALUE, "fxcount"),
+    _info("info", Metrics.INSTANCE_LIVE_STATE, "live"),
+    _info("info", Metrics.INSTANCE_UPTIME_SECONDS, "uptime"),
+    _info(
+        "info", Metrics.INSTANCE_WEBSOCKET_CLIENTS, "ws", transform=not_active
+    ),
+    _info("info", Metrics.INSTANCE_UDP_PORT, "udpport"),
+    _info("leds", Metrics.INSTANCE_LED_COUNT_VALUE, "leds", "count"),
+    _info("leds", Metrics.INSTANCE_LED_FPS_VALUE, "leds", "fps"),
+    _info("leds", Metrics.INSTANCE_LED_MAX_SEGMENTS, "leds", "maxseg"),
+    _info("leds", Metrics.INSTANCE_LED_MAX_POWER, "leds", "maxpwr"),
+    _info("leds", Metrics.INSTANCE_LED_CURRENT_POWER, "leds", "pwr"),
+    _info(
+        "filesystem",
+        Metrics.INSTANCE_FILESYSTEM_SPACE_TOTAL,
+        "fs",
+        "t",
+        default=1,
+    ),
+    _info(
+        "filesystem",
+        Metrics.INSTANCE_FILESYSTEM_SPACE_USED,
+        "fs",
+        "u",
+        default=1,
+    ),
+    _info("wifi", Metrics.INSTANCE_WIFI_CHANNEL, "wifi", "channel"),
+    _info("wifi", Metrics.INSTANCE_WIFI_RSSI, "wifi", "rssi"),
+    _info("wifi", Metrics.INSTANCE_WIFI_SIGNAL, "wifi", "signal"),
+    _info(
+        "wifi",
+        Metrics.INSTANCE_WIFI_BSSID,
+        value=1,
+        labels=(
+            (
+                "bssid",
+                lambda i: (i.get("wifi") or {}).get(
+                    "bssid", "00:00:00:00:00:00"
+                ),
+            ),
+        ),
+    ),
+    _state("state", Metrics.INSTANCE_STATE_BRIGHTNESS, "bri", default=1),
+    _state("state", Metrics.INSTANCE_STATE_TRANSITION, "transition"),
+    _state("state", Metrics.INSTANCE_STATE_ON, "on"),
+    _state(
+        "state", Metrics.INSTANCE_STATE_PLAYLIST_ID, "pl", transform=not_active
+    ),
+    _state(
+        "state", Metrics.INSTANCE_STATE_PRESET_ID, "ps", transform=not_active
+    ),
+    _state("sync", Metrics.INSTANCE_SYNC_RECEIVE_STATE, "udpn", "recv"),
+    _state("sync", Metrics.INSTANCE_SYNC_RECEIVE_GROUPS, "udpn", "rgrp"),
+    _state("sync", Metrics.INSTANCE_SYNC_SEND_STATE, "udpn", "send"),
+    _state("sync", Metrics.INSTANCE_SYNC_SEND_GROUPS, "udpn", "sgrp"),
+    _state(
+        "nightlight",
+        Metrics.INSTANCE_NIGHTLIGHT_DURATION_MINUTES,
+        "nl",
+        "dur",
+        default=1,
+    ),
+    _state("nightlight", Metrics.INSTANCE_NIGHTLIGHT_ON_VALUE, "nl", "on"),
+    _state(
+        "nightlight",
+        Metrics.INSTANCE_NIGHTLIGHT_TARGET_BRIGHTNESS_VALUE,
+        "nl",
+        "tbri",
+    ),
+    _segment(Metrics.INSTANCE_SEGMENT_BRIGHTNESS_VALUE, "bri"),
+    _segment(Metrics.INSTANCE_SEGMENT_CLONES_VALUE, "cln", default=-1),
+    _segment(Metrics.INSTANCE_SEGMENT_EFFECT_ID_VALUE, "fx"),
+    _segment(Metrics.INSTANCE_SEGMENT_INTENSITY_VALUE, "ix"),
+    _segment(Metrics.INSTANCE_SEGMENT_LENGTH_VALUE, "len"),
+    _segment(Metrics.INSTANCE_SEGMENT_ON_VALUE, "on"),
+    _segment(Metrics.INSTANCE_SEGMENT_PALETTE_ID_VALUE, "pal"),
+    _segment(Metrics.INSTANCE_SEGMENT_REVERSE_VALUE, "rev"),
+    # Segments are identified by their position, like the wled models do
+    _segment(Metrics.INSTANCE_SEGMENT_SEGMENT_ID_VALUE, label_value="segment"),
+    _segment(Metrics.INSTANCE_SEGMENT_SELECTED_VALUE, "sel"),
+    _segment(Metrics.INSTANCE_SEGMENT_SPEED_VALUE, "sx"),
+    _segment(Metrics.INSTANCE_SEGMENT_CCT_VALUE, "cct"),
+    _segment(Metrics.INSTANCE_SEGMENT_START_VALUE, "start"),
+    _segment(Metrics.INSTANCE_SEGMENT_STOP_VALUE, "stop"),
+    MetricSpec(
+        "segment_colors",
+        MetricScope.COLOR,
+        Metrics.INSTANCE_SEGMENT_COLOR_VALUE,
+        transform=lambda color_value: color_value,
+    ),
+    MetricSpec(
+        "presets",
+        MetricScope.PRESETS,
+        Metrics.INSTANCE_PRESET_COUNT_VALUE,
+        transform=len,
+    ),
+    _preset(Metrics.INSTANCE_PRESET_IS_ON_VALUE, "on"),
+    _preset(Metrics.INSTANCE_PRESET_TRANSITION_VALUE, "transition"),
+    _preset(
+        Metrics.INSTANCE_PRESET_QUICK_LABEL_INFO,
+        value=1,
+        labels=(("preset_quick_label", get_preset_quick_label),),
+    ),
+)
+
+SCOPE_SECTIONS = {
+    MetricScope.INFO: PayloadSection.INFO,
+    MetricScope.STATE: PayloadSection.STATE,
+    MetricScope.SEGMENT: PayloadSection.SEGMENTS,
+    MetricScope.COLOR: PayloadSection.SEGMENTS,
+    MetricScope.PRESETS: PayloadSection.PRESETS,
+    MetricScope.PRESET: PayloadSection.PRESETS,
+}
+
+METRIC_FAMILIES = tuple(sorted({spec.family for spec in METRIC_SPECS}))
+
+# Scopes repeated per segment, color slot or preset, the rest is fixed
+BUDGETED_SCOPES = (MetricScope.SEGMENT, MetricScope.COLOR, MetricScope.PRESET)
+BUDGETED_FAMILIES = tuple(
+    sorted(
+        {spec.family for spec in METRIC_SPECS if spec.scope in BUDGETED_SCOPES}
+    )
+)
+
+
+def compile_getter(path, default):
+    if not path:
+        return lambda data: data
+    if len(path) == 1:
+        (key,) = path
+        return lambda data: data.get(key, default)
+    *parents, key = path
+
+    def get_nested(data):
+        for parent in parents:
+            data = data.get(parent) or {}
+        return data.get(key, default)
+
+    return get_nested
+
+
+def compile_value(spec):
+    if spec.value is not None:
+        value = spec.value
+        return lambda labels, data: value
+    if spec.label_value is not None:
+        label_name = spec.label_value
+        return lambda labels, data: labels[label_name]
+    getter = compile_getter(spec.path, spec.default)
+    transform = spec.transform
+    if transform is not None:
+        return lambda labels, data: transform(getter(data))
+    return lambda labels, data: getter(data) or 0
+
+
+def compile_spec(spec):
+    """Turn a spec with extra labels into a closure setting its metric"""
+    metric = spec.metric
+    section = SCOPE_SECTIONS[spec.scope]
+    get_value = compile_value(spec)
+    extra_labels = dict(spec.labels)
+    label_names = metric._labelnames
+
+    def extract(labels, data, device):
+        label_values = []
+        for name in label_names:
+            get_label = extra_labels.get(name)
+            if get_label is None:
+                label_values.append(labels[name])
+            else:
+                label_values.append(get_label(data))
+        device.get_child(metric, label_values, section).set(
+            get_value(labels, data)
+        )
+
+    return extract
+
+
+class SnapshotSlot(object):
+    """Stands in for a labelled gauge child in snapshot mode"""
+
+    __slots__ = ("_device", "_section", "_key")
+
+    def __init__(self, device, section, key):
+        self._device = device
+        self._section = section
+        self._key = key
+
+    def set(self, value):
+        self._device.samples[self._section][self._key] = float(value)
+
+
+class BoundDevice(object):
+    """Labelled metric children of one device, bound on its first scrape so
+    the next ones only call `child.set()`. In snapshot mode the children
+    write into per section samples instead of the global gauges"""
+
+    def __init__(self, name, snapshot=False, track_series=False):
+        self.name = name
+        self.segment_ids = None
+        self.preset_keys = None
+        self.children = {}
+        self.samples = {} if snapshot else None
+        # Scrape target the device was last finished for, and when
+        self.scrape_ip = None
+        self.finished_at = None
+        # Bound keys and payload labelled series emitted per section
+        self.emitted = {} if track_series else None
+        self.current = None
+        self.series = {}
+        self.active_series = {}
+        self.active_items = {}
+
+    def _new_child(self, metric, label_values, section):
+        if self.samples is None:
+            # Positional label values skip the keyword validation
+            return metric.labels(*label_values)
+        label_values = tuple(str(value) for value in label_values)
+        return SnapshotSlot(self, section, (metric, label_values))
+
+    def get_child(self, metric, label_values, section):
+        if self.current is not None:
+            self.current[1].add((metric, tuple(label_values)))
+        return self._new_child(metric, label_values, section)
+
+    def bind(self, key, labels, bound_specs):
+        section = SCOPE_SECTIONS[key[0]]
+        children = []
+        series = []
+        for metric, value in bound_specs:
+            label_values = tuple(labels[name] for name in metric._labelnames)
+            children.append(
+                (self._new_child(metric, label_values, section), value)
+            )
+            series.append((metric, label_values))
+        self.children[key] = children
+        self.series[key] = series
+        return children
+
+    def start_section(self, section):
+        if self.samples is not None:
+            # Series that aren't set again drop out with the old samples
+            self.samples[section] = {}
+        elif self.emitted is not None:
+            self.current = (set(), set())
+
+    def finish_section(self, section):
+        """Series the section emitted last time but not this time"""
+        current = self.current
+        self.current = None
+        if current is None:
+            return set()
+        previous = self.emitted.get(section)
+        self.emitted[section] = current
+        if previous is None or previous == current:
+            return set()
+        stale = self._get_series(*previous) - self._get_series(*current)
+        for key in previous[0] - current[0]:
+            # A key that comes back later must bind a new child
+            self.children.pop(key, None)
+            self.series.pop(key, None)
+        return stale
+
+    def get_emitted_series(self):
+        if self.emitted is None:
+            return {}
+        return {
+            section: self._get_series(*emitted)
+            for section, emitted in self.emitted.items()
+        }
+
+    def _get_series(self, keys, series):
+        series = set(series)
+        for key in keys:
+            series.update(self.series.get(key, ()))
+        return series
+
+    def get_snapshot_samples(self):
+        samples = {}
+        for section_samples in self.samples.values():
+            for (metric, label_values), value in section_samples.items():
+                samples.setdefault(metric, []).append((label_values, value))
+        return {metric: tuple(values) for metric, values in samples.items()}
+
+    def invalidate(self, *scopes):
+        for key in [key for key in self.children if key[0] in scopes]:
+            del self.children[key]
+
+
+class MetricExtractor(object):
+    """Compiled metric specs, run in one pass over a device payload"""
+
+    @classmethod
+    def get_disabled_families(cls):
+        return _parse_families(
+            os.environ.get("WLED_DISABLED_METRIC_FAMILIES", "")
+        )
+
+    @classmethod
+    def is_eviction_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_STALE_SERIES_EVICTION", "false")
+
+    @classmethod
+    def get_stale_device_seconds(cls):
+        return EnvHelper.get_float("WLED_STALE_DEVICE_SECONDS", 180, minimum=1)
+
+    @classmethod
+    def get_series_budgets(cls):
+        """Series a device may export per family, like `presets=300`"""
+        return _parse_budgets(os.environ.get("WLED_SERIES_BUDGETS", ""))
+
+    @classmethod
+    def get_extractor(cls):
+        return _compiled_extractor(
+            cls.get_disabled_families(),
+            DeviceSnapshotStore.is_enabled(),
+            cls.is_eviction_enabled(),
+            cls.get_series_budgets(),
+        )
+
+    def __init__(
+        self,
+        specs=METRIC_SPECS,
+        disabled_families=(),
+        snapshots=None,
+        evict_series=False,
+        series_budgets=(),
+        clock=time.monotonic,
+    ):
+        # Specs whose labels only come from the scope can bind their child
+        self._bound_specs = {scope: [] for scope in MetricScope}
+        self._extractors = {scope: [] for scope in MetricScope}
+        # Series per scope item (a segment, a color slot...) by family
+        self._family_counts = {
+            scope: collections.Counter() for scope in MetricScope
+        }
+        for spec in specs:
+            if spec.family in disabled_families:
+                continue
+            self._family_counts[spec.scope][spec.family] += 1
+            if spec.labels:
+                self._extractors[spec.scope].append(compile_spec(spec))
+            else:
+                self._bound_specs[spec.scope].append(
+                    (spec.metric, compile_value(spec))
+                )
+        self._snapshots = snapshots
+        # Snapshots drop stale series by themselves, gauges must remove them
+        self._evict_series = evict_series and snapshots is None
+        self._clock = clock
+        self._devices = {}
+        self._active_series = collections.Counter()
+        self._item_families = {}
+        self._item_limits = {}
+        series_budgets = dict(series_budgets)
+        for scope in BUDGETED_SCOPES:
+            for family, count in self._family_counts[scope].items():
+                self._item_families[scope] = family
+                if family in series_budgets:
+                    self._item_limits[scope] = series_budgets[family] // count
+
+    def forget(self, device_ip):
+        device = self._devices.pop(device_ip, None)
+        if device is not None:
+            self._forget_active_series(device)
+
+    def reset(self):
+        for device in self._devices.values():
+            self._forget_active_series(device)
+        self._devices.clear()
+
+    def _forget_active_series(self, device):
+        for active_series in device.active_series.values():
+            self._update_active_series(active_series, {})
+        device.active_series.clear()
+        device.active_items.clear()
+
+    def get_bound_device(self, labels):
+        device = self._devices.get(labels["ip"])
+        if device is None or device.name != labels["name"]:
+            if device is not None:
+                # Series of the old name would be exported forever
+                self._evict_device(device)
+            # A renamed device gets all its children bound again
+            device = self._devices[labels["ip"]] = BoundDevice(
+                labels["name"],
+                snapshot=self._snapshots is not None,
+                track_series=self._evict_series,
+            )
+        return device
+
+    def finish_device(self, device_ip, scrape_ip=None):
+        """Called once all sections of a device were set, publishes its
+        snapshot in snapshot mode"""
+        device = self._devices.get(device_ip)
+        if device is None:
+            return None
+        device.scrape_ip = scrape_ip
+        device.finished_at = self._clock()
+        exposition_cache.invalidate()
+        if self._snapshots is None:
+            return None
+        return self._snapshots.publish(
+            device_ip, device.get_snapshot_samples()
+        )
+
+    def evict_stale_devices(self):
+        """Drop the devices that missed a few of their scrapes, and at
+        least WLED_STALE_DEVICE_SECONDS"""
+        now = self._clock()
+        minimum = self.get_stale_device_seconds()
+        stale_ips = [
+            device_ip
+            for device_ip, device in self._devices.items()
+            if device.finished_at is not None
+            and now - device.finished_at
+            > scrape_intervals.get_max_age(
+                device.scrape_ip or device_ip, minimum
+            )
+        ]
+        for device_ip in stale_ips:
+            log.info(f"Evicting series of stale device {device_ip}")
+            self._drop_device(device_ip)
+        return stale_ips
+
+    def evict_device(self, device_ip):
+        """Drop a device no longer scraped, by its reported or scrape ip.
+        Returns the reported ips that were dropped"""
+        dropped_ips = [
+            reported_ip
+            for reported_ip, device in self._devices.items()
+            if device_ip in (reported_ip, device.scrape_ip)
+        ]
+        for reported_ip in dropped_ips:
+            log.info(f"Evicting series of removed device {reported_ip}")
+            self._drop_device(reported_ip)
+        return dropped_ips
+
+    def _drop_device(self, device_ip):
+        device = self._devices.pop(device_ip)
+        self._evict_device(device)
+        if device.scrape_ip is not None:
+            # Its sections must be set again if it ever comes back
+            section_hashes.forget(device.scrape_ip)
+
+    def _evict_device(self, device):
+        self._forget_active_series(device)
+        for section, series in device.get_emitted_series().items():
+            self._evict(section, series)
+
+    def _evict(self, section, series):
+        if not series:
+            return
+        for metric, label_values in series:
+            metric.remove(*label_values)
+        Metrics.WLED_SCRAPER_SERIES_EVICTED.labels(
+            section=section.value,
+        ).inc(len(series))
+
+    def extract_section(self, section, info, state, presets):
+        labels = {
+            "ip": info.get("ip", ""),
+            "name": info.get("name", "WLED Light"),
+        }
+        device = self.get_bound_device(labels)
+        device.start_section(section)
+        if section == PayloadSection.INFO:
+            self._run(
+                MetricScope.INFO, device, (MetricScope.INFO,), labels, info
+            )
+            self._set_active_series(device, section, {MetricScope.INFO: 1})
+        elif section == PayloadSection.STATE:
+            self._run(
+                MetricScope.STATE, device, (MetricScope.STATE,), labels, state
+            )
+            self._set_active_series(device, section, {MetricScope.STATE: 1})
+        elif section == PayloadSection.SEGMENTS:
+            self._extract_segments(device, labels, state)
+        elif section == PayloadSection.PRESETS:
+            self._extract_presets(device, labels, presets)
+        if self._evict_series:
+            self._evict(section, device.finish_section(section))
+
+    def _run(self, scope, device, key, labels, data):
+        if device.current is not None:
+            device.current[0].add(key)
+        children = device.children.get(key)
+        if children is None:
+            children = device.bind(key, labels, self._bound_specs[scope])
+        for child, get_value in children:
+            child.set(get_value(labels, data))
+        for extract in self._extractors[scope]:
+            extract(labels, data, device)
+
+    def _extract_segments(self, device, device_labels, state):
+        segments = state.get("seg") or []
+        # Payloads carry a list, serialized models a dict keyed by position
+        if isinstance(segments, dict):
+            segments = list(segments.items())
+        else:
+            segments = list(enumerate(segments))
+        segments = self._apply_budget(
+            device_labels, MetricScope.SEGMENT, segments
+        )
+        segment_ids = tuple(segment_id for segment_id, _ in segments)
+        if segment_ids != device.segment_ids:
+            device.invalidate(MetricScope.SEGMENT, MetricScope.COLOR)
+            device.segment_ids = segment_ids
+        extract_colors = bool(self._family_counts[MetricScope.COLOR])
+        color_slots = []
+        for segment_id, segment in segments:
+            labels = dict(device_labels, segment=segment_id)
+            self._run(
+                MetricScope.SEGMENT,
+                device,
+                (MetricScope.SEGMENT, segment_id),
+                labels,
+                segment,
+            )
+            if extract_colors and segment.get("col"):
+                color_slots.extend(
+                    self._get_color_slots(labels, segment["col"])
+                )
+        color_slots = self._apply_budget(
+            device_labels, MetricScope.COLOR, color_slots
+        )
+        for key, labels, color_value in color_slots:
+            self._run(MetricScope.COLOR, device, key, labels, color_value)
+        self._set_active_series(
+            device,
+            PayloadSection.SEGMENTS,
+            {
+                MetricScope.SEGMENT: len(segments),
+                MetricScope.COLOR: len(color_slots),
+            },
+        )
+
+    @classmethod
+    def _get_color_slots(cls, segment_labels, colors):
+        segment_id = segment_labels["segment"]
+        for color_priority, color in zip(COLOR_PRIORITIES, colors):
+            if isinstance(color, str):
+                # Newer firmware can report colors as hex strings
+                color = [int(color[i : i + 2], 16) for i in (1, 3, 5)]
+            for color_position, color_value in enumerate(color):
+                key = (
+                    MetricScope.COLOR,
+                    segment_id,
+                    color_priority,
+                    color_position,
+                )
+                labels = dict(
+                    segment_labels,
+                    color_priority=color_priority,
+                    color_tuple_position=color_position,
+                )
+                yield key, labels, color_value
+
+    def _extract_presets(self, device, device_labels, presets):
+        preset_list = []
+        for preset_id, preset in presets.items():
+            preset_id = int(preset_id)
+            playlist = preset.get("playlist")
+            if preset_id == 0 or (playlist and playlist.get("ps")):
+                # Preset 0 is a placeholder and playlists aren't presets
+                continue
+            preset_list.append(
+                (preset_id, preset.get("n") or str(preset_id), preset)
+            )
+        # The count covers every preset, even those over the budget
+        self._run(
+            MetricScope.PRESETS,
+            device,
+            (MetricScope.PRESETS,),
+            device_labels,
+            preset_list,
+        )
+        preset_list.sort(key=lambda item: item[0])
+        preset_list = self._apply_budget(
+            device_labels, MetricScope.PRESET, preset_list
+        )
+        preset_keys = tuple(item[:2] for item in preset_list)
+        if preset_keys != device.preset_keys:
+            device.invalidate(MetricScope.PRESET)
+            device.preset_keys = preset_keys
+        for preset_id, preset_name, preset in preset_list:
+            labels = dict(
+                device_labels,
+                preset_id=preset_id,
+                preset_name=preset_name,
+            )
+            self._run(
+                MetricScope.PRESET,
+                device,
+                (MetricScope.PRESET, preset_id, preset_name),
+                labels,
+                preset,
+            )
+        self._set_active_series(
+            device,
+            PayloadSection.PRESETS,
+            {MetricScope.PRESETS: 1, MetricScope.PRESET: len(preset_list)},
+        )
+
+    def _apply_budget(self, device_labels, scope, items):
+        """Truncate the items of a scope to the budget of its family"""
+        limit = self._item_limits.get(scope)
+        if limit is None or len(items) <= limit:
+            return items
+        family = self._item_families[scope]
+        dropped = (len(items) - limit) * self._family_counts[scope][family]
+        log.debug(
+            f"{device_labels['ip']} is over its {family} series budget, "
+            f"dropping {dropped} series"
+        )
+        Metrics.WLED_CARDINALITY_LIMITED.labels(
+            ip=device_labels["ip"],
+            family=family,
+        ).inc(dropped)
+        return items[:limit]
+
+    def _set_active_series(self, device, section, item_counts):
+        if device.active_items.get(section) == item_counts:
+            return
+        device.active_items[section] = item_counts
+        active_series = collections.Counter()
+        for scope, item_count in item_counts.items():
+            for family, count in self._family_counts[scope].items():
+                active_series[family] += item_count * count
+        previous = device.active_series.get(section)
+        device.active_series[section] = active_series
+        self._update_active_series(previous, active_series)
+
+    def _update_active_series(self, previous, current):
+        families = set(current)
+        if previous:
+            families.update(previous)
+            self._active_series.subtract(previous)
+        self._active_series.update(current)
+        for family in families:
+            Metrics.WLED_ACTIVE_SERIES.labels(
+                family=family,
+            ).set(self._active_series[family])
+
+
+# Parsed once per setting value, so errors are only logged once
+@lru_cache(maxsize=8)
+def _parse_families(raw_families):
+    families = frozenset(
+        family.strip() for family in raw_families.split(",") if family.strip()
+    )
+    for family in families - set(METRIC_FAMILIES):
+        log.error(f"Unknown metric family: {family}")
+    return families
+
+
+@lru_cache(maxsize=8)
+def _parse_budgets(raw_budgets):
+    budgets = {}
+    for entry in raw_budgets.split(","):
+        if not entry.strip():
+            continue
+        family, _, budget = entry.partition("=")
+        family = family.strip()
+        try:
+            budgets[family] = max(0, int(budget))
+        except ValueError:
+            log.error(f"Invalid series budget: {entry}")
+            continue
+        if family not in BUDGETED_FAMILIES:
+            log.error(f"Series budgets only apply to {BUDGETED_FAMILIES}")
+            del budgets[family]
+    return tuple(sorted(budgets.items()))
+
+
+@lru_cache(maxsize=8)
+def _compiled_extractor(
+    disabled_families, snapshot_mode, evict_series, series_budgets
+):
+    log.info(
+        f"Compiling metric extractors without {sorted(disabled_families)}"
+    )
+    return MetricExtractor(
+        disabled_families=disabled_families,
+        snapshots=device_snapshots if snapshot_mode else None,
+        evict_series=evict_series,
+        series_budgets=series_budgets,
+    )
@@ -0,0 +1,237 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import orjson
+import yaml
+
+from .metrics import Metrics
+from .utils import LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+BACKUP_POLICIES = ("all", "config", "presets", "none")
+
+
+class InventoryException(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class InventoryDevice:
+    """A WLED instance of the inventory file"""
+
+    ip: str
+    name: Optional[str] = None
+    tags: tuple = ()
+    interval: Optional[float] = None
+    enabled: bool = True
+    backup: str = "all"
+
+    @classmethod
+    def from_entry(cls, entry):
+        """Build from a bare `ip` string or a mapping of attributes"""
+        if isinstance(entry, str):
+            entry = {"ip": entry}
+        if not isinstance(entry, dict) or not entry.get("ip"):
+            raise InventoryException(f"Inventory device without ip: {entry}")
+        unknown = set(entry) - {field for field in cls.__dataclass_fields__}
+        if unknown:
+            raise InventoryException(
+                f"Unknown attributes {sorted(unknown)} of {entry['ip']}"
+            )
+        backup = entry.get("backup", "all")
+        if backup not in BACKUP_POLICIES:
+            raise InventoryException(
+                f"Invalid backup policy {backup} of {entry['ip']}, "
+                f"expected one of {BACKUP_POLICIES}"
+            )
+        interval = entry.get("interval")
+        try:
+            interval = None if interval is None else float(interval)
+        except (TypeError, ValueError):
+            raise InventoryException(
+                f"Invalid interval {interval} of {entry['ip']}"
+            )
+        if interval is not None and interval <= 0:
+            raise InventoryException(
+                f"Invalid interval {interval} of {entry['ip']}"
+            )
+        tags = entry.get("tags") or ()
+        if isinstance(tags, str):
+            tags = (tags,)
+        return cls(
+            ip=str(entry["ip"]).strip(),
+            name=entry.get("name"),
+            tags=tuple(str(tag) for tag in tags),
+            interval=interval,
+            enabled=bool(entry.get("enabled", True)),
+            backup=backup,
+        )
+
+    def backs_up(self, backup_type):
+        """Whether `config` or `presets` backups include this instance"""
+        return self.enabled and self.backup in ("all", backup_type)
+
+
+@dataclass(frozen=True)
+class InventoryChange:
+    """Instances a reload added, removed or changed the attributes of"""
+
+    added: tuple = ()
+    removed: tuple = ()
+    changed: tuple = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+
+def parse_inventory(path, body):
+    """Devices of a YAML or JSON inventory, either a list of devices or a
+    mapping with a `devices` list"""
+    if path.endswith(".json"):
+        data = orjson.loads(body)
+    else:
+        data = yaml.safe_load(body)
+    if isinstance(data, dict):
+        data = data.get("devices")
+    if data is None:
+        data = []
+    if not isinstance(data, list):
+        raise InventoryException("Inventory devices must be a list")
+    devices = {}
+    for entry in data:
+        device = InventoryDevice.from_entry(entry)
+        if device.ip in devices:
+            raise InventoryException(f"Duplicate inventory device {device.ip}")
+        devices[device.ip] = device
+    return devices
+
+
+class DeviceInventory(object):
+    """WLED instances of the inventory file, read again whenever the file
+    changes so devices can be added or removed without a restart"""
+
+    @classmethod
+    def get_path(cls):
+        return os.environ.get("WLED_INVENTORY_FILE") or None
+
+    @classmethod
+    def is_enabled(cls):
+        return cls.get_path() is not None
+
+    def __init__(self, path=None):
+        self._path = path
+        self._file_key = None
+        self._devices = None
+
+    @property
+    def path(self):
+        return self._path or self.get_path()
+
+    @property
+    def loaded(self):
+        return self._devices is not None
+
+    @property
+    def devices(self):
+        return dict(self._devices or {})
+
+    def get(self, device_ip):
+        return (self._devices or {}).get(device_ip)
+
+    def refresh(self):
+        """Read the file again if it changed since the last call, a stat
+        per call otherwise. Returns the InventoryChange, or None"""
+        path = self.path
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            if self._file_key is not None:
+                log.error(f"Inventory file {path} unavailable: {e}")
+                self._file_key = None
+            return None
+        file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_key == self._file_key:
+            return None
+        # A broken file is only reported once, not on every cycle
+        self._file_key = file_key
+        try:
+            with open(path, "rb") as inventory_file:
+                devices = parse_inventory(path, inventory_file.read())
+        except (OSError, ValueError, yaml.YAMLError, InventoryException) as e:
+            log.error(
+                f"Keeping the previous inventory, {path} is invalid: {e}"
+            )
+            Metrics.INVENTORY_RELOADS.labels(result="error").inc()
+            return None
+        Metrics.INVENTORY_RELOADS.labels(result="success").inc()
+        return self.apply(devices)
+
+    def apply(self, devices):
+        """Swap in the devices, only touching the ones that differ"""
+        previous = self._devices or {}
+        change = InventoryChange(
+            added=tuple(ip for ip in devices if ip not in previous),
+            removed=tuple(ip for ip in previous if ip not in devices),
+            changed=tuple(
+                ip
+                for ip, device in devices.items()
+                if ip in previous and previous[ip] != device
+            ),
+        )
+        self._devices = devices
+        for device_ip in change.removed + change.changed:
+            self._remove_info_metric(previous[device_ip])
+        for device_ip in change.added + change.changed:
+            self._set_info_metric(devices[device_ip])
+        if change:
+            log.info(
+                f"Inventory reloaded: {len(change.added)} added, "
+                f"{len(change.removed)} removed, "
+                f"{len(change.changed)} changed"
+            )
+        return change
+
+    def get_ip_list(self):
+        return [ip for ip, device in self.devices.items() if device.enabled]
+
+    def get_backup_ip_list(self, backup_type):
+        return [
+            ip
+            for ip, device in self.devices.items()
+            if device.backs_up(backup_type)
+        ]
+
+    def get_intervals(self):
+        return {
+            ip: device.interval
+            for ip, device in self.devices.items()
+            if device.interval is not None
+        }
+
+    def reset(self):
+        for device in self.devices.values():
+            self._remove_info_metric(device)
+        self._file_key = None
+        self._devices = None
+
+    @classmethod
+    def _info_labels(cls, device):
+        return (device.ip, device.name or "", ",".join(device.tags))
+
+    def _set_info_metric(self, device):
+        if device.enabled:
+            Metrics.INVENTORY_DEVICE_INFO.labels(
+                *self._info_labels(device)
+            ).set(1)
+
+    def _remove_info_metric(self, device):
+        try:
+            Metrics.INVENTORY_DEVICE_INFO.remove(*self._info_labels(device))
+        except KeyError:
+            pass
+
+
+# Global device inventory instance
+device_inventory = DeviceInventory()
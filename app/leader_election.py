@@ -0,0 +1,147 @@
+import asyncio
+import contextlib
+import os
+import socket
+import time
+
+from .lock_manager import lock_manager
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+class LeaderElection(object):
+    """Scraper leadership through a short lease that the leader renews in
+    the background. The leader keeps it across scrape cycles, and when it
+    dies another process takes over once the lease ran out"""
+
+    LEASE_NAME = "scraper"
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_LEADER_ELECTION", "false")
+
+    @classmethod
+    def get_lease_ttl_seconds(cls):
+        return EnvHelper.get_float("LEADER_LEASE_TTL_SECONDS", 15, minimum=1)
+
+    @classmethod
+    def get_renew_interval_seconds(cls):
+        # A few renewals per TTL, so one slow renewal doesn't lose the lease
+        default = cls.get_lease_ttl_seconds() / 3
+        return EnvHelper.get_float(
+            "LEADER_LEASE_RENEW_SECONDS", default, minimum=0.1
+        )
+
+    @classmethod
+    def get_holder_id(cls):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def __init__(self, locks=lock_manager, holder=None, clock=time.time):
+        self._locks = locks
+        self.holder = holder or self.get_holder_id()
+        self._clock = clock
+        self._lease = None
+        self._last_token = None
+        self._valid_until = 0
+        self._leader_holder = None
+        self._task = None
+
+    @property
+    def token(self):
+        """Fencing token of the lease while this process holds it"""
+        return self._lease["token"] if self._lease else None
+
+    @property
+    def is_leader(self):
+        # Only trust the lease until it could have expired without renewal
+        return self._lease is not None and self._clock() < self._valid_until
+
+    def renew(self):
+        """Take or renew the lease, returns whether this process leads"""
+        ttl = self.get_lease_ttl_seconds()
+        renewed_at = self._clock()
+        previous = None
+        if self._lease is None:
+            # Who held it before tells a failover from a handover
+            previous = self._locks.get_lease_info(self.LEASE_NAME)
+        lease = self._locks.acquire_lease(self.LEASE_NAME, self.holder, ttl)
+        if lease is None:
+            if self._lease is not None:
+                log.warning(f"👑 {self.holder} lost the scraper leadership")
+                previous = self._locks.get_lease_info(self.LEASE_NAME)
+            self._lease = None
+            self._set_metrics(previous)
+            return False
+        if lease["token"] != self._last_token:
+            log.info(
+                f"👑 {self.holder} is the scraper leader "
+                f"(token: {lease['token']})"
+            )
+            if self.is_failover(previous, lease):
+                Metrics.LEADER_FAILOVERS.inc()
+        self._lease = lease
+        self._last_token = lease["token"]
+        self._valid_until = renewed_at + ttl
+        self._set_metrics(dict(lease, holder=self.holder))
+        return True
+
+    def is_failover(self, previous, lease):
+        """Whether the lease was taken over from another holder whose
+        lease ran out. Released leases expire at 0, that's a handover"""
+        return (
+            previous is not None
+            and previous["holder"] != self.holder
+            and 0 < previous["expires_at"] <= lease["acquired_at"]
+        )
+
+    def is_current(self):
+        """Fencing check before acting as leader, e.g. before publishing.
+        False once another holder took over, even if this process stalled
+        and hasn't noticed yet"""
+        token = self.token
+        if token is None:
+            return False
+        return self._locks.check_lease(self.LEASE_NAME, self.holder, token)
+
+    def _set_metrics(self, lease):
+        now = self._clock()
+        holder = None
+        if lease and lease["expires_at"] >= now:
+            holder = lease["holder"]
+        if holder != self._leader_holder:
+            Metrics.LEADER_INFO.clear()
+            if holder:
+                Metrics.LEADER_INFO.labels(holder).set(1)
+            self._leader_holder = holder
+        if holder:
+            Metrics.LEADER_LEASE_AGE.set(now - lease["acquired_at"])
+            Metrics.LEADER_FENCING_TOKEN.set(lease["token"])
+        else:
+            Metrics.LEADER_LEASE_AGE.set(0)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.get_renew_interval_seconds())
+            try:
+                self.renew()
+            except Exception as e:
+                log.error(f"Error renewing the scraper lease: {e}")
+
+    def start(self):
+        """Try for the lease now, then keep renewing in the background"""
+        self.renew()
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        """Stop renewing and hand the lease over right away"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._lease is not None:
+            self._locks.release_lease(self.LEASE_NAME, self.holder)
+            self._lease = None
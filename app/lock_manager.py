@@ -1,6 +1,10 @@
+import contextlib
+import fcntl
+import json
 import logging
 import os
 import sqlite3
+import threading
 import time
 from typing import Optional
 
@@ -12,9 +16,39 @@ class SQLiteLockManager:
 
     def __init__(self, db_path: str = "/tmp/wargos_locks.db"):
         self.db_path = db_path
+        self._conn = None
+        self._conn_pid = None
+        self._conn_lock = threading.Lock()
         self._ensure_db_directory()
         self._init_db()
 
+    @contextlib.contextmanager
+    def _connection(self):
+        """The connection of this process, opened once and reused"""
+        with self._conn_lock:
+            # A connection must not cross a fork, workers open their own
+            if self._conn is None or self._conn_pid != os.getpid():
+                self._conn = sqlite3.connect(
+                    self.db_path,
+                    timeout=5,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+                self._conn_pid = os.getpid()
+            try:
+                yield self._conn
+            except sqlite3.Error as e:
+                if not isinstance(e, sqlite3.IntegrityError):
+                    # Reconnect next time, e.g. after the file was replaced
+                    self._close_connection()
+                raise
+
+    def _close_connection(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._conn_pid = None
+
     def _ensure_db_directory(self):
         """Ensure the database directory exists"""
         try:
@@ -25,6 +59,30 @@ class SQLiteLockManager:
         except Exception as e:
             log.error(f"Failed to create database directory: {e}")
 
+    def _create_tables(self, conn):
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS locks (
+                lock_name TEXT PRIMARY KEY,
+                worker_pid INTEGER,
+                acquired_at REAL,
+                expires_at REAL
+            )
+        """
+        )
+        # token grows whenever another holder takes the lease over
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                lease_name TEXT PRIMARY KEY,
+                holder TEXT,
+                token INTEGER,
+                acquired_at REAL,
+                expires_at REAL
+            )
+        """
+        )
+
     def _init_db(self):
         """Initialize the SQLite database with the locks table"""
         try:
@@ -32,16 +90,7 @@ class SQLiteLockManager:
                 # Enable WAL mode for better concurrency
                 conn.execute("PRAGMA journal_mode=WAL")
 
-                conn.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS locks (
-                        lock_name TEXT PRIMARY KEY,
-                        worker_pid INTEGER,
-                        acquired_at REAL,
-                        expires_at REAL
-                    )
-                """
-                )
+                self._create_tables(conn)
                 conn.commit()
                 log.info(f"Initialized SQLite lock database: {self.db_path}")
         except Exception as e:
@@ -55,16 +104,7 @@ class SQLiteLockManager:
                     )
                 with sqlite3.connect(self.db_path) as conn:
                     conn.execute("PRAGMA journal_mode=WAL")
-                    conn.execute(
-                        """
-                        CREATE TABLE IF NOT EXISTS locks (
-                            lock_name TEXT PRIMARY KEY,
-                            worker_pid INTEGER,
-                            acquired_at REAL,
-                            expires_at REAL
-                        )
-                    """
-                    )
+                    self._create_tables(conn)
                     conn.commit()
                     log.info(f"Recreated SQLite lock database: {self.db_path}")
             except Exception as recreate_error:
@@ -72,21 +112,6 @@ class SQLiteLockManager:
                     f"Failed to recreate SQLite lock database: {recreate_error}"
                 )
 
-    def _cleanup_expired_locks(self):
-        """Clean up expired locks"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                current_time = time.time()
-                cursor = conn.execute(
-                    "DELETE FROM locks WHERE expires_at < ?", (current_time,)
-                )
-                deleted_count = cursor.rowcount
-                conn.commit()
-                if deleted_count > 0:
-                    log.debug(f"Cleaned up {deleted_count} expired locks")
-        except Exception as e:
-            log.error(f"Failed to cleanup expired locks: {e}")
-
     def try_acquire_lock(
         self, lock_name: str, worker_pid: int, timeout_seconds: int = 300
     ) -> bool:
@@ -102,28 +127,39 @@ class SQLiteLockManager:
             True if lock was acquired, False otherwise
         """
         try:
-            self._cleanup_expired_locks()
-
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 current_time = time.time()
                 expires_at = current_time + timeout_seconds
 
-                # Try to insert the lock (will fail if it already exists)
-                conn.execute(
-                    "INSERT INTO locks (lock_name, worker_pid, acquired_at, expires_at) VALUES (?, ?, ?, ?)",
-                    (lock_name, worker_pid, current_time, expires_at),
+                # Insert the lock, or take it over only once it expired
+                cursor = conn.execute(
+                    """
+                    INSERT INTO locks
+                        (lock_name, worker_pid, acquired_at, expires_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (lock_name) DO UPDATE SET
+                        worker_pid = excluded.worker_pid,
+                        acquired_at = excluded.acquired_at,
+                        expires_at = excluded.expires_at
+                    WHERE locks.expires_at < ?
+                """,
+                    (
+                        lock_name,
+                        worker_pid,
+                        current_time,
+                        expires_at,
+                        current_time,
+                    ),
                 )
-                conn.commit()
 
+            if cursor.rowcount > 0:
                 log.info(f"Worker {worker_pid} acquired lock '{lock_name}'")
                 return True
-
-        except sqlite3.IntegrityError:
-            # Lock already exists
             log.debug(
                 f"Worker {worker_pid} failed to acquire lock '{lock_name}' - already held"
             )
             return False
+
         except Exception as e:
             log.error(f"Error acquiring lock '{lock_name}': {e}")
             return False
@@ -140,12 +176,11 @@ class SQLiteLockManager:
             True if lock was released, False otherwise
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.execute(
                     "DELETE FROM locks WHERE lock_name = ? AND worker_pid = ?",
                     (lock_name, worker_pid),
                 )
-                conn.commit()
 
                 if cursor.rowcount > 0:
                     log.info(
@@ -162,13 +197,120 @@ class SQLiteLockManager:
             log.error(f"Error releasing lock '{lock_name}': {e}")
             return False
 
+    def acquire_lease(
+        self, lease_name: str, holder: str, ttl_seconds: float
+    ) -> Optional[dict]:
+        """
+        Take or renew a lease in one statement
+
+        The holder renews its own lease, anyone else only gets it once it
+        expired, which bumps the fencing token
+
+        Returns:
+            The lease (token, acquired_at, expires_at) if it is held by
+            holder now, None otherwise
+        """
+        try:
+            with self._connection() as conn:
+                current_time = time.time()
+                row = conn.execute(
+                    """
+                    INSERT INTO leases
+                        (lease_name, holder, token, acquired_at, expires_at)
+                    VALUES (?, ?, 1, ?, ?)
+                    ON CONFLICT (lease_name) DO UPDATE SET
+                        token = CASE WHEN leases.holder = excluded.holder
+                            THEN leases.token ELSE leases.token + 1 END,
+                        acquired_at = CASE WHEN leases.holder = excluded.holder
+                            THEN leases.acquired_at
+                            ELSE excluded.acquired_at END,
+                        holder = excluded.holder,
+                        expires_at = excluded.expires_at
+                    WHERE leases.holder = excluded.holder
+                        OR leases.expires_at < excluded.acquired_at
+                    RETURNING token, acquired_at, expires_at
+                """,
+                    (
+                        lease_name,
+                        holder,
+                        current_time,
+                        current_time + ttl_seconds,
+                    ),
+                ).fetchone()
+                if row is None:
+                    return None
+                return {
+                    "token": row[0],
+                    "acquired_at": row[1],
+                    "expires_at": row[2],
+                }
+
+        except Exception as e:
+            log.error(f"Error acquiring lease '{lease_name}': {e}")
+            return None
+
+    def check_lease(self, lease_name: str, holder: str, token: int) -> bool:
+        """Whether holder still has the lease under the same token"""
+        try:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "SELECT 1 FROM leases WHERE lease_name = ? AND holder = ? "
+                    "AND token = ? AND expires_at >= ?",
+                    (lease_name, holder, token, time.time()),
+                ).fetchone()
+                return row is not None
+
+        except Exception as e:
+            log.error(f"Error checking lease '{lease_name}': {e}")
+            return False
+
+    def release_lease(self, lease_name: str, holder: str) -> bool:
+        """Give up a lease right away, so another holder takes over"""
+        try:
+            with self._connection() as conn:
+                # Expire instead of delete, the token must keep growing
+                cursor = conn.execute(
+                    "UPDATE leases SET expires_at = 0 "
+                    "WHERE lease_name = ? AND holder = ?",
+                    (lease_name, holder),
+                )
+                return cursor.rowcount > 0
+
+        except Exception as e:
+            log.error(f"Error releasing lease '{lease_name}': {e}")
+            return False
+
+    def get_lease_info(self, lease_name: str) -> Optional[dict]:
+        """Get information about a lease"""
+        try:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "SELECT holder, token, acquired_at, expires_at "
+                    "FROM leases WHERE lease_name = ?",
+                    (lease_name,),
+                ).fetchone()
+                if row:
+                    return {
+                        "holder": row[0],
+                        "token": row[1],
+                        "acquired_at": row[2],
+                        "expires_at": row[3],
+                    }
+                return None
+
+        except Exception as e:
+            log.error(f"Error getting lease info for '{lease_name}': {e}")
+            return None
+
     def get_lock_info(self, lock_name: str) -> Optional[dict]:
         """Get information about a lock"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
+                # An expired lock is free, the next acquire takes it over
                 cursor = conn.execute(
-                    "SELECT worker_pid, acquired_at, expires_at FROM locks WHERE lock_name = ?",
-                    (lock_name,),
+                    "SELECT worker_pid, acquired_at, expires_at FROM locks "
+                    "WHERE lock_name = ? AND expires_at >= ?",
+                    (lock_name, time.time()),
                 )
                 row = cursor.fetchone()
 
@@ -186,5 +328,223 @@ class SQLiteLockManager:
             return None
 
 
+class FlockLockManager:
+    """fcntl.flock based lock manager for workers on a single host. The
+    kernel drops the lock of a process that dies, so locks never have to
+    expire, and acquiring one takes no database round trip"""
+
+    def __init__(self, lock_dir: str = "/tmp/wargos_locks"):
+        self.lock_dir = lock_dir
+        # lock name -> (file descriptor, worker pid) of the locks held here
+        self._held = {}
+        self._lease_fds = {}
+        self._fds_pid = os.getpid()
+        self._guard = threading.Lock()
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def _path(self, name: str, suffix: str) -> str:
+        return os.path.join(self.lock_dir, f"{name}.{suffix}")
+
+    def _check_fork(self):
+        # Locks and descriptors inherited over a fork belong to the parent
+        if self._fds_pid != os.getpid():
+            self._held = {}
+            self._lease_fds = {}
+            self._fds_pid = os.getpid()
+
+    @staticmethod
+    def _read_json(fd: int) -> Optional[dict]:
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 4096)
+        return json.loads(data) if data else None
+
+    @staticmethod
+    def _write_json(fd: int, value: dict):
+        data = json.dumps(value).encode("utf-8")
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, data)
+
+    def try_acquire_lock(
+        self, lock_name: str, worker_pid: int, timeout_seconds: int = 300
+    ) -> bool:
+        """Try to acquire a lock without blocking, timeout_seconds is only
+        recorded, the lock is held until released or the process exits"""
+        try:
+            with self._guard:
+                self._check_fork()
+                if lock_name in self._held:
+                    return False
+                fd = os.open(
+                    self._path(lock_name, "lock"), os.O_RDWR | os.O_CREAT
+                )
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    log.debug(
+                        f"Worker {worker_pid} failed to acquire lock '{lock_name}' - already held"
+                    )
+                    return False
+                current_time = time.time()
+                self._write_json(
+                    fd,
+                    {
+                        "worker_pid": worker_pid,
+                        "acquired_at": current_time,
+                        "expires_at": current_time + timeout_seconds,
+                    },
+                )
+                self._held[lock_name] = (fd, worker_pid)
+                log.info(f"Worker {worker_pid} acquired lock '{lock_name}'")
+                return True
+
+        except Exception as e:
+            log.error(f"Error acquiring lock '{lock_name}': {e}")
+            return False
+
+    def release_lock(self, lock_name: str, worker_pid: int) -> bool:
+        """Release a lock held by worker_pid in this process"""
+        try:
+            with self._guard:
+                self._check_fork()
+                fd, holder_pid = self._held.get(lock_name, (None, None))
+                if fd is None or holder_pid != worker_pid:
+                    log.warning(
+                        f"Worker {worker_pid} tried to release lock '{lock_name}' but didn't hold it"
+                    )
+                    return False
+                del self._held[lock_name]
+                os.ftruncate(fd, 0)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+                log.info(f"Worker {worker_pid} released lock '{lock_name}'")
+                return True
+
+        except Exception as e:
+            log.error(f"Error releasing lock '{lock_name}': {e}")
+            return False
+
+    def get_lock_info(self, lock_name: str) -> Optional[dict]:
+        """Get information about a lock, None unless someone holds it"""
+        try:
+            fd = os.open(self._path(lock_name, "lock"), os.O_RDWR | os.O_CREAT)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    info = self._read_json(fd)
+                else:
+                    # Nobody holds it
+                    return None
+            finally:
+                os.close(fd)
+            if not info:
+                return None
+            info["age_seconds"] = time.time() - info["acquired_at"]
+            return info
+
+        except Exception as e:
+            log.error(f"Error getting lock info for '{lock_name}': {e}")
+            return None
+
+    @contextlib.contextmanager
+    def _lease_file(self, lease_name: str, operation: int):
+        with self._guard:
+            self._check_fork()
+            fd = self._lease_fds.get(lease_name)
+            if fd is None:
+                fd = self._lease_fds[lease_name] = os.open(
+                    self._path(lease_name, "lease"), os.O_RDWR | os.O_CREAT
+                )
+            fcntl.flock(fd, operation)
+            try:
+                yield fd
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def acquire_lease(
+        self, lease_name: str, holder: str, ttl_seconds: float
+    ) -> Optional[dict]:
+        """Same lease semantics as SQLiteLockManager.acquire_lease"""
+        try:
+            with self._lease_file(lease_name, fcntl.LOCK_EX) as fd:
+                current_time = time.time()
+                lease = self._read_json(fd)
+                if lease is None:
+                    lease = {
+                        "holder": holder,
+                        "token": 1,
+                        "acquired_at": current_time,
+                    }
+                elif lease["holder"] != holder:
+                    if lease["expires_at"] >= current_time:
+                        return None
+                    # Taking an expired lease over fences the old holder
+                    lease = {
+                        "holder": holder,
+                        "token": lease["token"] + 1,
+                        "acquired_at": current_time,
+                    }
+                lease["expires_at"] = current_time + ttl_seconds
+                self._write_json(fd, lease)
+                return {
+                    "token": lease["token"],
+                    "acquired_at": lease["acquired_at"],
+                    "expires_at": lease["expires_at"],
+                }
+
+        except Exception as e:
+            log.error(f"Error acquiring lease '{lease_name}': {e}")
+            return None
+
+    def check_lease(self, lease_name: str, holder: str, token: int) -> bool:
+        """Whether holder still has the lease under the same token"""
+        lease = self.get_lease_info(lease_name)
+        return (
+            lease is not None
+            and lease["holder"] == holder
+            and lease["token"] == token
+            and lease["expires_at"] >= time.time()
+        )
+
+    def release_lease(self, lease_name: str, holder: str) -> bool:
+        """Give up a lease right away, so another holder takes over"""
+        try:
+            with self._lease_file(lease_name, fcntl.LOCK_EX) as fd:
+                lease = self._read_json(fd)
+                if not lease or lease["holder"] != holder:
+                    return False
+                lease["expires_at"] = 0
+                self._write_json(fd, lease)
+                return True
+
+        except Exception as e:
+            log.error(f"Error releasing lease '{lease_name}': {e}")
+            return False
+
+    def get_lease_info(self, lease_name: str) -> Optional[dict]:
+        """Get information about a lease"""
+        try:
+            with self._lease_file(lease_name, fcntl.LOCK_SH) as fd:
+                return self._read_json(fd)
+
+        except Exception as e:
+            log.error(f"Error getting lease info for '{lease_name}': {e}")
+            return None
+
+
+def create_lock_manager():
+    """The lock manager of the configured LOCK_MANAGER_BACKEND"""
+    backend = os.environ.get("LOCK_MANAGER_BACKEND", "sqlite").lower()
+    if backend == "flock":
+        return FlockLockManager(
+            os.environ.get("LOCK_MANAGER_DIR", "/tmp/wargos_locks")
+        )
+    if backend != "sqlite":
+        log.warning(f"Unknown lock manager backend '{backend}', using sqlite")
+    return SQLiteLockManager()
+
+
 # Global lock manager instance
-lock_manager = SQLiteLockManager()
+lock_manager = create_lock_manager()
@@ -1,16 +1,35 @@
 import os
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
-from fastapi.responses import Response
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
 from fastapi_utils.tasks import repeat_every
-from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST
 from prometheus_fastapi_instrumentator import Instrumentator
 
+from .device_history import HISTORY_FIELDS, device_histories
+from .device_store import device_states, http_date, is_not_modified
+from .discovery import SubnetDiscovery, subnet_discovery
+from .exposition_cache import (
+    ExpositionCache,
+    accepts_gzip,
+    exposition_cache,
+)
+from .leader_election import LeaderElection
 from .lock_manager import lock_manager
+from .scheduler import ScrapeScheduler
+from .scrape_intervals import scrape_intervals
 from .scraper import Scraper
+from .scraper_daemon import ScraperDaemon
+from .shared_metrics import (
+    SharedMetricsFile,
+    render_exposition,
+    shared_metrics,
+)
+from .single_flight import coalesce
 from .utils import LogHelper
 from .version import version
+from .websocket_push import WebSocketPushManager
 from .wled_client import WLEDClient
 
 log = LogHelper.get_env_logger(__name__)
@@ -23,15 +42,101 @@ async def lifespan(app: FastAPI):
     log.info("🚀 Starting up FastAPI application")
     log.debug("Starting up FastAPI application")
 
+    # One pooled session for all device and backup traffic, so connections
+    # and DNS lookups are reused across scrapes instead of rebuilt each time
+    http_session = WLEDClient.create_session()
+    WLEDClient.set_shared_session(http_session)
+    app.state.http_session = http_session
+
     # Check if we should enable background tasks (disable during testing)
     enable_background_tasks = os.environ.get(
         "ENABLE_BACKGROUND_TASKS", "true"
     ).lower() in ("true", "1", "yes", "on")
 
-    if enable_background_tasks:
+    # A separate `python -m app.scraper_daemon` process scrapes and
+    # publishes the shared metrics, workers then only serve requests
+    scraper_daemon_mode = ScraperDaemon.is_enabled()
+
+    # With the adaptive scheduler the loop ticks often and only scrapes
+    # the instances that are due, otherwise every tick scrapes everything
+    scrape_scheduler = None
+    scrape_loop_interval = Scraper.get_default_scrape_interval()
+    if ScrapeScheduler.is_enabled():
+        scrape_scheduler = ScrapeScheduler.get_scheduler(
+            Scraper.get_default_scrape_interval()
+        )
+        scrape_loop_interval = ScrapeScheduler.get_tick_seconds()
+        log.info(
+            f"🗓️ Adaptive scrape scheduler enabled (tick: {scrape_loop_interval}s)"
+        )
+    app.state.scrape_scheduler = scrape_scheduler
+    # Devices are only stale after missing a few of their own scrapes
+    scrape_intervals.use_scheduler(scrape_scheduler)
+
+    # In push mode the worker that scrapes also holds a WebSocket per
+    # instance, polling then only covers what WLED doesn't push (presets)
+    push_manager = None
+    if WebSocketPushManager.is_enabled() and not scraper_daemon_mode:
+        WLEDClient.set_push_session(WLEDClient.create_push_session())
+        push_manager = WebSocketPushManager.get_manager(
+            Scraper.get_client(session=http_session)
+        )
+        log.info("📡 WebSocket push mode enabled")
+    app.state.push_manager = push_manager
+
+    # With leader election one worker keeps the scraper role through a
+    # renewed lease, instead of racing for the lock on every tick
+    leader_election = None
+    if (
+        enable_background_tasks
+        and not scraper_daemon_mode
+        and LeaderElection.is_enabled()
+    ):
+        leader_election = LeaderElection()
+        leader_election.start()
+    app.state.leader_election = leader_election
+
+    if SharedMetricsFile.is_requested() and not (
+        scraper_daemon_mode or SharedMetricsFile.can_run_in_workers()
+    ):
+        log.error(
+            "📄 Shared metrics disabled, with more than one worker they "
+            "need ENABLE_LEADER_ELECTION or ENABLE_SCRAPER_DAEMON"
+        )
+
+    # Discovery sweeps from the worker that scrapes, growing its scrape set
+    discovery = None
+    if (
+        enable_background_tasks
+        and not scraper_daemon_mode
+        and SubnetDiscovery.is_enabled()
+    ):
+        if not SubnetDiscovery.can_run_in_workers(leader_election):
+            log.error(
+                "🔭 Subnet discovery not started, with more than one worker "
+                "it needs ENABLE_LEADER_ELECTION or ENABLE_SCRAPER_DAEMON"
+            )
+        else:
+            discovery = subnet_discovery
+            # A single worker always sweeps, otherwise only the leader does
+            # since its scrape set is the one that is used
+            is_active = (
+                None
+                if leader_election is None
+                else (lambda: leader_election.is_leader)
+            )
+            discovery.start(
+                is_active=is_active, on_change=Scraper.forget_undiscovered
+            )
+            log.info("🔭 Subnet discovery enabled")
+    app.state.discovery = discovery
+
+    if enable_background_tasks and scraper_daemon_mode:
+        log.info("🛰️ Scraping runs in the scraper daemon, serving reads only")
+    elif enable_background_tasks:
         # Start the background task
         @repeat_every(
-            seconds=Scraper.get_default_scrape_interval(),
+            seconds=scrape_loop_interval,
             wait_first=Scraper.get_default_wait_first_interval(),
             logger=log,
         )
@@ -40,10 +145,14 @@ async def lifespan(app: FastAPI):
 
             log.info(f"🔄 Background task triggered for worker {worker_pid}")
 
-            # Try to acquire the scraper lock using SQLite
-            if lock_manager.try_acquire_lock(
-                "scraper", worker_pid, timeout_seconds=300
-            ):
+            if leader_election is not None:
+                acquired = leader_election.is_leader
+            else:
+                # Try to acquire the scraper lock using SQLite
+                acquired = lock_manager.try_acquire_lock(
+                    "scraper", worker_pid, timeout_seconds=300
+                )
+            if acquired:
                 try:
                     log.info(
                         f"🔒 Worker {worker_pid}: Acquired scraper lock - performing full scrape"
@@ -57,20 +166,38 @@ async def lifespan(app: FastAPI):
                         f"=========>"
                     )
 
+                    if SharedMetricsFile.is_enabled():
+                        # The lock moves between workers, start from the
+                        # device states the previous holder published
+                        Scraper.refresh_device_stores()
                     # Only set worker-specific metrics when this worker is responsible for metrics
-                    await Scraper.get_client().perform_full_scrape(
-                        set_instance_info=True, set_metrics=True
+                    await Scraper.get_client(
+                        session=http_session, push_manager=push_manager
+                    ).perform_full_scrape(
+                        set_instance_info=True,
+                        set_metrics=True,
+                        scheduler=scrape_scheduler,
                     )
                     log.info(
                         f"✅ Worker {worker_pid}: Full scrape completed successfully"
                     )
+                    # A leader that was replaced meanwhile must not publish
+                    fenced = (
+                        leader_election is not None
+                        and not leader_election.is_current()
+                    )
+                    if SharedMetricsFile.is_enabled() and not fenced:
+                        # The other workers serve what this one scraped
+                        shared_metrics.publish()
+                        Scraper.publish_device_stores()
                 except Exception as e:
                     log.error(
                         f"❌ Worker {worker_pid}: Error during full scrape: {e}"
                     )
                 finally:
-                    # Always release the lock
-                    lock_manager.release_lock("scraper", worker_pid)
+                    # Always release the lock, a lease is kept for next time
+                    if leader_election is None:
+                        lock_manager.release_lock("scraper", worker_pid)
             else:
                 # Another worker already has the lock
                 log.debug(
@@ -111,6 +238,34 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         log.debug(f"Error during task cleanup: {e}")
 
+    if leader_election is not None:
+        try:
+            await leader_election.stop()
+            log.info("🛑 Released the scraper leader lease")
+        except Exception as e:
+            log.error(f"Error releasing the scraper leader lease: {e}")
+
+    if discovery is not None:
+        try:
+            await discovery.stop()
+            log.info("🛑 Stopped subnet discovery")
+        except Exception as e:
+            log.error(f"Error stopping subnet discovery: {e}")
+
+    if push_manager is not None:
+        try:
+            await push_manager.stop()
+            log.info("🛑 Closed WebSocket push connections")
+        except Exception as e:
+            log.error(f"Error closing WebSocket push connections: {e}")
+
+    # Close the shared connection pool last, after scrapes were cancelled
+    try:
+        await WLEDClient.close_shared_session()
+        log.info("🛑 Closed shared HTTP session")
+    except Exception as e:
+        log.error(f"Error closing shared HTTP session: {e}")
+
 
 app = FastAPI(lifespan=lifespan)
 
@@ -135,15 +290,30 @@ def configure_prometheus():
 
     # Add metrics endpoint
     @app.get("/metrics")
-    async def metrics():
+    async def metrics(request: Request):
         """Metrics endpoint"""
         try:
+            headers = {"Cache-Control": "no-cache, no-store, must-revalidate"}
+            if not ExpositionCache.is_enabled():
+                return Response(
+                    render_exposition(),
+                    media_type=CONTENT_TYPE_LATEST,
+                    headers=headers,
+                )
+            if SharedMetricsFile.is_enabled() and shared_metrics.refresh():
+                # The scraping worker published, possibly from another process
+                exposition_cache.invalidate()
+            # Device metrics only change with a scrape, serve the rendering
+            body, is_gzip = exposition_cache.get(
+                use_gzip=accepts_gzip(request.headers.get("accept-encoding"))
+            )
+            headers["Vary"] = "Accept-Encoding"
+            if is_gzip:
+                headers["Content-Encoding"] = "gzip"
             return Response(
-                generate_latest(),
+                body,
                 media_type=CONTENT_TYPE_LATEST,
-                headers={
-                    "Cache-Control": "no-cache, no-store, must-revalidate"
-                },
+                headers=headers,
             )
         except Exception as e:
             log.error(f"Error generating metrics: {e}")
@@ -190,20 +360,117 @@ async def simple_releases_test():
 
 @app.get("/prometheus/default")
 async def prometheus_default():
-    await Scraper.get_client().scrape_default_instance()
+    scraper = Scraper.get_client()
+    await coalesce(
+        "scrape_instance",
+        scraper.default_wled_ip(),
+        scraper.scrape_default_instance,
+    )
     return {"message": "Hello World"}
 
 
 @app.get("/prometheus/all")
 async def prometheus_scrape_all():
-    await Scraper.get_client().scrape_all_instances()
+    await coalesce(
+        "scrape_all", "all", Scraper.get_client().scrape_all_instances
+    )
     return {"message": "Hello World"}
 
 
+def refresh_device_stores():
+    """Workers that don't scrape serve what the scraping one published"""
+    if SharedMetricsFile.is_enabled():
+        Scraper.refresh_device_stores()
+
+
+def device_state_response(request, body, etag, modified_at):
+    """Serve stored device state, or 304 when the client has this version"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if modified_at:
+        headers["Last-Modified"] = http_date(modified_at)
+    if is_not_modified(request.headers, etag, modified_at):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.get("/devices")
+async def list_devices(request: Request):
+    """Summary of every WLED instance as last scraped, without querying them"""
+    refresh_device_stores()
+    body, etag, modified_at = device_states.get_listing()
+    return device_state_response(request, body, etag, modified_at)
+
+
+@app.get("/devices/{device_ip}")
+async def get_device(device_ip: str, request: Request):
+    """Last scraped info, state and presets of a WLED instance"""
+    refresh_device_stores()
+    record = device_states.get(device_ip)
+    if record is None:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "error": f"No scraped state for device {device_ip}",
+                "device_ip": device_ip,
+                "status": "not_found",
+            },
+        )
+    return device_state_response(
+        request, record.body, record.etag, record.modified_at
+    )
+
+
+@app.get("/devices/{device_ip}/history")
+async def get_device_history(
+    device_ip: str,
+    fields: str = None,
+    since: float = None,
+    max_points: int = 120,
+):
+    """Recent samples of a WLED instance, averaged down to max_points"""
+    refresh_device_stores()
+    history = device_histories.get(device_ip)
+    if history is None:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "error": f"No history for device {device_ip}",
+                "device_ip": device_ip,
+                "status": "not_found",
+            },
+        )
+    field_names = list(HISTORY_FIELDS)
+    if fields:
+        field_names = [
+            name.strip() for name in fields.split(",") if name.strip()
+        ]
+    unknown = [name for name in field_names if name not in HISTORY_FIELDS]
+    if unknown or max_points < 1:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": "Unknown history fields or max_points below 1",
+                "unknown_fields": unknown,
+                "fields": list(HISTORY_FIELDS),
+                "status": "bad_request",
+            },
+        )
+    return {
+        "device_ip": device_ip,
+        "samples": len(history),
+        **history.query(field_names, since=since, max_points=max_points),
+    }
+
+
 @app.get("/config/backup/all")
 async def backup_configs_all():
     """Backup configs from all WLED instances"""
-    results = await Scraper.get_client().backup_configs_from_all_instances()
+    scraper = Scraper.get_client()
+    results = await coalesce(
+        "config_backup_all",
+        scraper.get_config_backup_dir(),
+        scraper.backup_configs_from_all_instances,
+    )
     return {
         "message": "Config backup completed",
         "results": results,
@@ -225,7 +492,12 @@ async def backup_config_single(device_ip: str):
 @app.get("/presets/backup/all")
 async def backup_presets_all():
     """Backup presets from all WLED instances"""
-    results = await Scraper.get_client().backup_presets_from_all_instances()
+    scraper = Scraper.get_client()
+    results = await coalesce(
+        "presets_backup_all",
+        scraper.get_config_backup_dir(),
+        scraper.backup_presets_from_all_instances,
+    )
     return {
         "message": "Preset backup completed",
         "results": results,
@@ -247,7 +519,12 @@ async def backup_presets_single(device_ip: str):
 @app.get("/backup/all")
 async def backup_all_all():
     """Backup both configs and presets from all WLED instances"""
-    results = await Scraper.get_client().backup_all_from_all_instances()
+    scraper = Scraper.get_client()
+    results = await coalesce(
+        "backup_all",
+        scraper.get_config_backup_dir(),
+        scraper.backup_all_from_all_instances,
+    )
     return {
         "message": "All backup completed",
         "results": results,
@@ -258,8 +535,11 @@ async def backup_all_all():
 @app.get("/config/backup/all/custom")
 async def backup_configs_all_custom(backup_dir: str):
     """Backup configs from all WLED instances to a custom directory"""
-    results = await Scraper.get_client().backup_configs_from_all_instances(
-        backup_dir
+    scraper = Scraper.get_client()
+    results = await coalesce(
+        "config_backup_all",
+        backup_dir,
+        lambda: scraper.backup_configs_from_all_instances(backup_dir),
     )
     return {
         "message": "Config backup completed",
@@ -1,6 +1,12 @@
 from enum import Enum
 
-from prometheus_client import Counter, Gauge, Summary
+from prometheus_client import REGISTRY, Counter, Gauge, Summary
+
+from .snapshot import (
+    DeviceSnapshotCollector,
+    DeviceSnapshotStore,
+    device_snapshots,
+)
 
 
 class MetricsLabels(Enum):
@@ -26,6 +32,13 @@ class MetricsLabels(Enum):
     STABLE = "stable"
     BETA = "beta"
     PID = "pid"
+    TIER = "tier"
+    SECTION = "section"
+    FAMILY = "family"
+    HOLDER = "holder"
+    OPERATION = "operation"
+    TAGS = "tags"
+    RESULT = "result"
 
     @classmethod
     def releases_labels(cls):
@@ -134,6 +147,90 @@ class MetricsLabels(Enum):
             ]
         )
 
+    @classmethod
+    def scheduler_instance_labels(cls):
+        return list(
+            [
+                cls.IP.value,
+            ]
+        )
+
+    @classmethod
+    def scrape_tier_labels(cls):
+        return list(
+            [
+                cls.IP.value,
+                cls.TIER.value,
+            ]
+        )
+
+    @classmethod
+    def metric_family_labels(cls):
+        return list(
+            [
+                cls.FAMILY.value,
+            ]
+        )
+
+    @classmethod
+    def coalesced_request_labels(cls):
+        return list(
+            [
+                cls.OPERATION.value,
+            ]
+        )
+
+    @classmethod
+    def inventory_device_labels(cls):
+        return list(
+            [
+                cls.IP.value,
+                cls.NAME.value,
+                cls.TAGS.value,
+            ]
+        )
+
+    @classmethod
+    def inventory_reload_labels(cls):
+        return list(
+            [
+                cls.RESULT.value,
+            ]
+        )
+
+    @classmethod
+    def discovery_probe_labels(cls):
+        return list(
+            [
+                cls.RESULT.value,
+            ]
+        )
+
+    @classmethod
+    def leader_labels(cls):
+        return list(
+            [
+                cls.HOLDER.value,
+            ]
+        )
+
+    @classmethod
+    def cardinality_limited_labels(cls):
+        return list(
+            [
+                cls.IP.value,
+                cls.FAMILY.value,
+            ]
+        )
+
+    @classmethod
+    def payload_section_labels(cls):
+        return list(
+            [
+                cls.SECTION.value,
+            ]
+        )
+
     @classmethod
     def instance_scraper_exception_labels(cls):
         return list(
@@ -280,6 +377,42 @@ class Metrics(object):
         MetricsLabels.basic_client_labels(),
     )
 
+    WLED_CLIENT_CIRCUIT_BREAKER_STATE = Gauge(
+        "wargos_wled_client_circuit_breaker_state",
+        "Circuit breaker state per WLED instance (0 closed, 1 open, 2 half-open)",
+        MetricsLabels.basic_client_labels(),
+    )
+
+    WLED_CLIENT_CIRCUIT_BREAKER_REJECTED = Counter(
+        "wargos_wled_client_circuit_breaker_rejected_total",
+        "Count of WLED instance connections skipped by an open circuit",
+        MetricsLabels.basic_client_labels(),
+    )
+
+    WLED_CLIENT_TIER_FETCHES = Counter(
+        "wargos_wled_client_tier_fetches_total",
+        "Count of tiered fetches per WLED instance (state, info, catalog)",
+        MetricsLabels.scrape_tier_labels(),
+    )
+
+    WLED_PUSH_CONNECTED = Gauge(
+        "wargos_wled_push_connected",
+        "Whether a WebSocket to the WLED instance is open (1) or not (0)",
+        MetricsLabels.basic_client_labels(),
+    )
+
+    WLED_PUSH_MESSAGES = Counter(
+        "wargos_wled_push_messages_total",
+        "Count of state updates pushed by a WLED instance over its WebSocket",
+        MetricsLabels.basic_client_labels(),
+    )
+
+    WLED_PUSH_RECONNECTS = Counter(
+        "wargos_wled_push_reconnects_total",
+        "Count of reconnect attempts after a WLED WebSocket was lost",
+        MetricsLabels.basic_client_labels(),
+    )
+
     WLED_RELEASES_CONNECT_EXCEPTIONS = Counter(
         "wargos_wled_releases_connect_exceptions_total",
         "Counts any exceptions attempting to connect to a WLED releases check",
@@ -348,6 +481,116 @@ class Metrics(object):
         MetricsLabels.basic_instance_scraper_labels(),
     )
 
+    WLED_SCRAPER_SECTIONS_SKIPPED = Counter(
+        "wargos_wled_scraper_sections_skipped_total",
+        "Count of unchanged WLED payload sections whose metrics were not re-set",
+        MetricsLabels.payload_section_labels(),
+    )
+
+    WLED_SCRAPER_SERIES_EVICTED = Counter(
+        "wargos_wled_scraper_series_evicted_total",
+        "Count of labelled series removed because WLED stopped reporting them",
+        MetricsLabels.payload_section_labels(),
+    )
+
+    WLED_CARDINALITY_LIMITED = Counter(
+        "wargos_cardinality_limited_total",
+        "Count of series dropped because an instance exceeded its series budget",
+        MetricsLabels.cardinality_limited_labels(),
+    )
+
+    WLED_ACTIVE_SERIES = Gauge(
+        "wargos_active_series",
+        "Number of WLED instance series currently exported, per metric family",
+        MetricsLabels.metric_family_labels(),
+    )
+
+    REQUESTS_COALESCED = Counter(
+        "wargos_requests_coalesced_total",
+        "Count of requests that waited on an identical operation in flight",
+        MetricsLabels.coalesced_request_labels(),
+    )
+
+    DEVICE_HISTORY_MEMORY_BYTES = Gauge(
+        "wargos_device_history_memory_bytes",
+        "Bytes allocated for the sample history ring buffers of all instances",
+    )
+
+    INVENTORY_DEVICE_INFO = Gauge(
+        "wargos_inventory_device_info",
+        "Enabled WLED instances of the inventory file, with their attributes",
+        MetricsLabels.inventory_device_labels(),
+    )
+
+    INVENTORY_RELOADS = Counter(
+        "wargos_inventory_reloads_total",
+        "Count of times the changed inventory file was read, by result",
+        MetricsLabels.inventory_reload_labels(),
+    )
+
+    DISCOVERY_SWEEP_TIME = Summary(
+        "wargos_discovery_sweep_time_seconds",
+        "Tracks the timing for sweeping the discovery ranges",
+    )
+
+    DISCOVERY_PROBES = Counter(
+        "wargos_discovery_probes_total",
+        "Count of addresses probed by discovery, by result",
+        MetricsLabels.discovery_probe_labels(),
+    )
+
+    DISCOVERY_RANGE_HIT_RATIO = Gauge(
+        "wargos_discovery_range_hit_ratio",
+        "Share of the addresses in the discovery ranges that are WLED",
+    )
+
+    DISCOVERY_DEVICES = Gauge(
+        "wargos_discovery_devices",
+        "Number of WLED instances currently found by discovery",
+    )
+
+    LEADER_INFO = Gauge(
+        "wargos_leader_info",
+        "The holder of the scraper leader lease, as seen by this process",
+        MetricsLabels.leader_labels(),
+    )
+
+    LEADER_LEASE_AGE = Gauge(
+        "wargos_leader_lease_age_seconds",
+        "How long the current leader has held the scraper leader lease",
+    )
+
+    LEADER_FENCING_TOKEN = Gauge(
+        "wargos_leader_fencing_token",
+        "Fencing token of the scraper leader lease, grows on every takeover",
+    )
+
+    LEADER_FAILOVERS = Counter(
+        "wargos_leader_failovers_total",
+        "Count of times this process took the leader lease over from another",
+    )
+
+    WLED_SCRAPER_SCRAPE_INSTANCES_IN_FLIGHT = Gauge(
+        "wargos_wled_scraper_scrape_instances_in_flight",
+        "Number of WLED instances currently being scraped concurrently",
+    )
+
+    SCHEDULER_QUEUE_DEPTH = Gauge(
+        "wargos_scrape_scheduler_queue_depth",
+        "Number of WLED instances that were due at the last scheduler tick",
+    )
+
+    SCHEDULER_LATENESS = Summary(
+        "wargos_scrape_scheduler_lateness_seconds",
+        "How long past its due time a WLED instance was picked up",
+    )
+
+    SCHEDULER_INSTANCE_INTERVAL = Gauge(
+        "wargos_scrape_scheduler_instance_interval_seconds",
+        "Current scrape interval of a WLED instance, including backoff",
+        MetricsLabels.scheduler_instance_labels(),
+    )
+
     WLED_SCRAPER_SCRAPE_INSTANCE_BY_TYPE_EXCEPTIONS = Counter(
         "wargos_wled_scraper_scrape_instance_by_type_exceptions_total",
         "Counts exceptions by type while scraping a single WLED instance",
@@ -708,3 +951,78 @@ class Metrics(object):
         "Total number of connection errors during backup operations",
         MetricsLabels.backup_connection_errors_labels(),
     )
+
+    @classmethod
+    def device_metrics(cls):
+        """The per instance gauges that are set from WLED payloads"""
+        return list(
+            value
+            for name, value in vars(cls).items()
+            if name.startswith("INSTANCE_")
+        )
+
+    @classmethod
+    def scraper_metrics(cls):
+        """The metrics set by the scrape loop. With shared metrics the
+        scraping worker publishes them, the others set their own request
+        metrics (coalesced requests, backups) and serve those"""
+        return cls.device_metrics() + [
+            cls.WARGOS_INSTANCE_INFO,
+            cls.WLED_CLIENT_CONNECT_EXCEPTIONS,
+            cls.WLED_CLIENT_CONNECT_TIME,
+            cls.WLED_CLIENT_CIRCUIT_BREAKER_STATE,
+            cls.WLED_CLIENT_CIRCUIT_BREAKER_REJECTED,
+            cls.WLED_CLIENT_TIER_FETCHES,
+            cls.WLED_PUSH_CONNECTED,
+            cls.WLED_PUSH_MESSAGES,
+            cls.WLED_PUSH_RECONNECTS,
+            cls.WLED_RELEASES_CONNECT_EXCEPTIONS,
+            cls.WLED_RELEASES_CONNECT_TIME,
+            cls.SCRAPER_SCRAPE_RELEASES_EXCEPTIONS,
+            cls.SCRAPER_SCRAPE_RELEASES_TIME,
+            cls.WLED_RELEASES_INFO,
+            cls.SCRAPER_FULL_SCRAPE_EXCEPTIONS,
+            cls.SCRAPER_FULL_SCRAPE_TIME,
+            cls.WLED_SCRAPER_SCRAPE_SELF_EXCEPTIONS,
+            cls.WLED_SCRAPER_SCRAPE_SELF_TIME,
+            cls.WLED_SCRAPER_SCRAPE_ALL_EXCEPTIONS,
+            cls.WLED_SCRAPER_SCRAPE_ALL_TIME,
+            cls.WLED_SCRAPER_SCRAPE_INSTANCE_EXCEPTIONS,
+            cls.WLED_SCRAPER_SCRAPE_INSTANCE_TIME,
+            cls.WLED_SCRAPER_SECTIONS_SKIPPED,
+            cls.WLED_SCRAPER_SERIES_EVICTED,
+            cls.WLED_CARDINALITY_LIMITED,
+            cls.WLED_ACTIVE_SERIES,
+            cls.DEVICE_HISTORY_MEMORY_BYTES,
+            cls.INVENTORY_DEVICE_INFO,
+            cls.INVENTORY_RELOADS,
+            cls.DISCOVERY_SWEEP_TIME,
+            cls.DISCOVERY_PROBES,
+            cls.DISCOVERY_RANGE_HIT_RATIO,
+            cls.DISCOVERY_DEVICES,
+            cls.LEADER_INFO,
+            cls.LEADER_LEASE_AGE,
+            cls.LEADER_FENCING_TOKEN,
+            cls.LEADER_FAILOVERS,
+            cls.WLED_SCRAPER_SCRAPE_INSTANCES_IN_FLIGHT,
+            cls.SCHEDULER_QUEUE_DEPTH,
+            cls.SCHEDULER_LATENESS,
+            cls.SCHEDULER_INSTANCE_INTERVAL,
+            cls.WLED_SCRAPER_SCRAPE_INSTANCE_BY_TYPE_EXCEPTIONS,
+            cls.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER,
+            cls.WLED_INSTANCE_ONLINE,
+        ]
+
+
+def register_snapshot_collector(store, registry=REGISTRY):
+    """Export the device metrics from snapshots instead of the gauges"""
+    device_metrics = Metrics.device_metrics()
+    for metric in device_metrics:
+        registry.unregister(metric)
+    collector = DeviceSnapshotCollector(store, device_metrics)
+    registry.register(collector)
+    return collector
+
+
+if DeviceSnapshotStore.is_enabled():
+    register_snapshot_collector(device_snapshots)
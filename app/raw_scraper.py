@@ -0,0 +1,61 @@
+from dataclasses import dataclass, field
+
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+# Leds isn't a mashumaro model, so it serializes with its field names
+LEDS_PAYLOAD_KEYS = (
+    ("max_power", "maxpwr"),
+    ("max_segments", "maxseg"),
+    ("power", "pwr"),
+)
+
+
+class RawJsonException(Exception):
+    pass
+
+
+@dataclass
+class RawDevice:
+    """Plain `/json` and `/presets.json` payloads of a WLED instance"""
+
+    info: dict
+    state: dict
+    presets: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_payloads(cls, data, presets=None):
+        if not data or "info" not in data or "state" not in data:
+            raise RawJsonException("WLED returned an incomplete /json payload")
+        return cls(
+            info=data["info"], state=data["state"], presets=presets or {}
+        )
+
+    @classmethod
+    def from_device(cls, device):
+        """Payloads of a `wled.Device`, so models share the raw extraction"""
+        data = device.to_dict()
+        leds = data["info"].get("leds")
+        if leds:
+            for field_name, key in LEDS_PAYLOAD_KEYS:
+                if field_name in leds:
+                    leds[key] = leds.pop(field_name)
+        return cls(
+            info=data["info"],
+            state=data["state"],
+            presets=data.get("presets", {}),
+        )
+
+
+class RawScraper(object):
+    """Settings of the raw JSON scrape path, which feeds the decoded
+    payloads straight into the metric extractor"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_RAW_JSON_SCRAPE", "false")
+
+    @classmethod
+    def get_labels(cls, info):
+        return info.get("ip", ""), info.get("name", "WLED Light")
@@ -0,0 +1,198 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+@dataclass
+class ScheduleEntry:
+    """Scheduling state for a single WLED instance"""
+
+    next_due: float
+    consecutive_failures: int = 0
+    interval_override: Optional[float] = None
+
+
+class ScrapeScheduler(object):
+    """Keeps a next-due time per WLED instance and backs off offline ones"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_ADAPTIVE_SCHEDULER", "false")
+
+    @classmethod
+    def get_tick_seconds(cls):
+        """How often the scheduler checks for due instances"""
+        return EnvHelper.get_float(
+            "WLED_SCHEDULER_TICK_SECONDS", 5, minimum=0.1
+        )
+
+    @classmethod
+    def get_max_backoff_seconds(cls):
+        """Upper bound for the interval of a failing instance"""
+        return EnvHelper.get_float(
+            "WLED_SCRAPE_MAX_BACKOFF_SECONDS", 900, minimum=0
+        )
+
+    @classmethod
+    def parse_env_interval_overrides(cls):
+        """Parse `ip=seconds` pairs from WLED_SCRAPE_INTERVAL_OVERRIDES"""
+        raw_overrides = os.environ.get("WLED_SCRAPE_INTERVAL_OVERRIDES", "")
+        overrides = {}
+        for raw_override in raw_overrides.split(","):
+            if not raw_override.strip():
+                continue
+            try:
+                device_ip, seconds = raw_override.split("=", 1)
+                overrides[device_ip.strip()] = float(seconds)
+            except ValueError:
+                log.error(f"Invalid scrape interval override: {raw_override}")
+        return overrides
+
+    @classmethod
+    def get_scheduler(cls, base_interval):
+        return cls(
+            base_interval,
+            max_backoff=cls.get_max_backoff_seconds(),
+            interval_overrides=cls.parse_env_interval_overrides(),
+        )
+
+    def __init__(
+        self,
+        base_interval,
+        max_backoff=900,
+        interval_overrides=None,
+        clock=time.monotonic,
+    ):
+        self._base_interval = float(base_interval)
+        self._max_backoff = float(max_backoff)
+        self._interval_overrides = dict(interval_overrides or {})
+        self._clock = clock
+        self._entries = {}
+        self._next_releases_check = None
+
+    @property
+    def base_interval(self):
+        return self._base_interval
+
+    @property
+    def devices(self):
+        return list(self._entries.keys())
+
+    def get_entry(self, device_ip):
+        return self._entries.get(device_ip)
+
+    def sync_devices(self, device_ips, intervals=None):
+        """Start tracking new instances (due now) and drop removed ones,
+        `intervals` of the inventory take precedence over the overrides"""
+        now = self._clock()
+        wanted = set(device_ips)
+        for device_ip in list(self._entries.keys()):
+            if device_ip not in wanted:
+                log.info(f"Scheduler no longer tracking {device_ip}")
+                del self._entries[device_ip]
+                try:
+                    Metrics.SCHEDULER_INSTANCE_INTERVAL.remove(device_ip)
+                except KeyError:
+                    pass
+        for device_ip in device_ips:
+            interval = self._interval_overrides.get(device_ip)
+            if intervals and device_ip in intervals:
+                interval = intervals[device_ip]
+            entry = self._entries.get(device_ip)
+            if entry is None:
+                self._entries[device_ip] = ScheduleEntry(
+                    next_due=now,
+                    interval_override=interval,
+                )
+            elif intervals is not None and entry.interval_override != interval:
+                # Keeps its schedule, unless the new interval is due sooner
+                entry.interval_override = interval
+                entry.next_due = min(
+                    entry.next_due, now + self.get_backoff_interval(device_ip)
+                )
+
+    def set_interval_override(self, device_ip, seconds):
+        """Set (or clear with None) the normal interval of an instance"""
+        if seconds is None:
+            self._interval_overrides.pop(device_ip, None)
+        else:
+            self._interval_overrides[device_ip] = float(seconds)
+        entry = self._entries.get(device_ip)
+        if entry:
+            entry.interval_override = self._interval_overrides.get(device_ip)
+
+    def get_interval(self, device_ip):
+        """Normal interval of an instance, ignoring any backoff"""
+        entry = self._entries.get(device_ip)
+        if entry and entry.interval_override is not None:
+            return entry.interval_override
+        return self._interval_overrides.get(device_ip, self._base_interval)
+
+    def get_backoff_interval(self, device_ip):
+        """Interval until the next scrape, doubled for each failure"""
+        interval = self.get_interval(device_ip)
+        entry = self._entries.get(device_ip)
+        if not entry or not entry.consecutive_failures:
+            return interval
+        backoff = interval * (2**entry.consecutive_failures)
+        return min(backoff, max(self._max_backoff, interval))
+
+    def pop_due(self):
+        """Instances that are due now, most overdue first"""
+        now = self._clock()
+        due = [
+            (entry.next_due, device_ip)
+            for device_ip, entry in self._entries.items()
+            if entry.next_due <= now
+        ]
+        due.sort()
+        Metrics.SCHEDULER_QUEUE_DEPTH.set(len(due))
+        for next_due, _ in due:
+            Metrics.SCHEDULER_LATENESS.observe(now - next_due)
+        return [device_ip for _, device_ip in due]
+
+    def record_success(self, device_ip):
+        entry = self._entries.get(device_ip)
+        if not entry:
+            return
+        if entry.consecutive_failures:
+            log.info(
+                f"Scheduler: {device_ip} recovered after "
+                f"{entry.consecutive_failures} failures"
+            )
+        entry.consecutive_failures = 0
+        self._reschedule(device_ip, entry)
+
+    def record_failure(self, device_ip):
+        entry = self._entries.get(device_ip)
+        if not entry:
+            return
+        entry.consecutive_failures += 1
+        self._reschedule(device_ip, entry)
+        log.debug(
+            f"Scheduler: {device_ip} failed "
+            f"{entry.consecutive_failures} times in a row, next scrape in "
+            f"{self.get_backoff_interval(device_ip)}s"
+        )
+
+    def _reschedule(self, device_ip, entry):
+        interval = self.get_backoff_interval(device_ip)
+        entry.next_due = self._clock() + interval
+        Metrics.SCHEDULER_INSTANCE_INTERVAL.labels(
+            ip=device_ip,
+        ).set(interval)
+
+    def claim_releases_check(self):
+        """Whether the releases check is due, releases run at base rate"""
+        now = self._clock()
+        if self._next_releases_check is not None:
+            if now < self._next_releases_check:
+                return False
+        self._next_releases_check = now + self._base_interval
+        return True
@@ -0,0 +1,40 @@
+from .utils import EnvHelper
+
+
+class ScrapeIntervals(object):
+    """Expected time between two scrapes of each WLED instance, so the
+    series of slow or backed off instances aren't dropped between two of
+    their scrapes"""
+
+    # Missed scrapes before an instance counts as stale
+    STALE_INTERVALS = 3
+
+    @classmethod
+    def get_default_interval(cls):
+        return EnvHelper.get_float(
+            "DEFAULT_WLED_INSTANCE_SCRAPE_INTERVAL_SECONDS", 60, minimum=1
+        )
+
+    def __init__(self):
+        self._scheduler = None
+
+    def use_scheduler(self, scheduler):
+        """Take the per instance intervals of the adaptive scheduler, or
+        the default interval again with None"""
+        self._scheduler = scheduler
+
+    def get_interval(self, device_ip):
+        scheduler = self._scheduler
+        if scheduler is not None and scheduler.get_entry(device_ip):
+            return scheduler.get_backoff_interval(device_ip)
+        return self.get_default_interval()
+
+    def get_max_age(self, device_ip, minimum):
+        """Seconds since its last scrape before an instance is stale"""
+        return max(
+            minimum, self.STALE_INTERVALS * self.get_interval(device_ip)
+        )
+
+
+# Global scrape intervals instance
+scrape_intervals = ScrapeIntervals()
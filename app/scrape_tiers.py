@@ -0,0 +1,176 @@
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Optional
+
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+class ScrapeTier(Enum):
+    STATE = "state"
+    INFO = "info"
+    CATALOG = "catalog"
+
+
+@dataclass
+class TierEntry:
+    """Cached device of a WLED instance and when each tier was fetched"""
+
+    device: Any
+    state_fetched_at: float
+    info_fetched_at: float
+    catalog_fetched_at: float
+    presets_modified: Optional[Any] = None
+    catalog_key: Optional[tuple] = None
+
+
+class TieredDeviceCache(object):
+    """Refreshes state, info and the preset/effect/palette catalog of each
+    WLED instance at their own pace instead of downloading all of it on
+    every scrape"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_TIERED_SCRAPE", "false")
+
+    @classmethod
+    def get_state_interval_seconds(cls):
+        """Min time between state fetches, 0 fetches it on every scrape"""
+        return EnvHelper.get_float(
+            "WLED_STATE_SCRAPE_INTERVAL_SECONDS", 0, minimum=0
+        )
+
+    @classmethod
+    def get_info_interval_seconds(cls):
+        """Min time between info fetches"""
+        return EnvHelper.get_float(
+            "WLED_INFO_SCRAPE_INTERVAL_SECONDS", 60, minimum=0
+        )
+
+    @classmethod
+    def get_catalog_interval_seconds(cls):
+        """Max time between preset, effect and palette fetches"""
+        return EnvHelper.get_float(
+            "WLED_CATALOG_SCRAPE_INTERVAL_SECONDS", 3600, minimum=0
+        )
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._entries = {}
+
+    def get_entry(self, device_ip):
+        return self._entries.get(device_ip)
+
+    def remove(self, device_ip):
+        self._entries.pop(device_ip, None)
+
+    def reset(self):
+        self._entries.clear()
+
+    async def update(self, led, device_ip):
+        """Update the cached device of an instance with the due tiers only"""
+        entry = self._entries.get(device_ip)
+        now = self._clock()
+        if entry is None:
+            # Nothing cached yet, a full update fills every tier at once
+            device = await led.update()
+            self._entries[device_ip] = TierEntry(
+                device=device,
+                state_fetched_at=now,
+                info_fetched_at=now,
+                catalog_fetched_at=now,
+                presets_modified=self._get_presets_modified(device),
+                catalog_key=self._get_catalog_key(device),
+            )
+            return device
+
+        device = entry.device
+        due_tiers = self.get_due_tiers(entry, now)
+        if ScrapeTier.STATE in due_tiers and ScrapeTier.INFO in due_tiers:
+            device.update_from_dict(await led.request("/json/si"))
+        elif ScrapeTier.STATE in due_tiers:
+            device.update_from_dict(
+                {"state": await led.request("/json/state")}
+            )
+        elif ScrapeTier.INFO in due_tiers:
+            device.update_from_dict({"info": await led.request("/json/info")})
+        if ScrapeTier.STATE in due_tiers:
+            entry.state_fetched_at = now
+            self._count_fetch(device_ip, ScrapeTier.STATE)
+        if ScrapeTier.INFO in due_tiers:
+            entry.info_fetched_at = now
+            self._count_fetch(device_ip, ScrapeTier.INFO)
+
+        catalog_due = ScrapeTier.CATALOG in due_tiers
+        presets_modified = self._get_presets_modified(device)
+        if catalog_due or presets_modified != entry.presets_modified:
+            log.debug(f"tiered scrape: fetching presets of {device_ip}")
+            presets = await led.request("/presets.json")
+            if presets:
+                device.update_from_dict({"presets": presets})
+            entry.presets_modified = presets_modified
+            self._count_fetch(device_ip, ScrapeTier.CATALOG)
+        catalog_key = self._get_catalog_key(device)
+        if catalog_due or catalog_key != entry.catalog_key:
+            log.debug(f"tiered scrape: fetching effects of {device_ip}")
+            device.update_from_dict(
+                {
+                    "effects": await led.request("/json/eff"),
+                    "palettes": await led.request("/json/pal"),
+                }
+            )
+            entry.catalog_key = catalog_key
+            self._count_fetch(device_ip, ScrapeTier.CATALOG)
+        if catalog_due:
+            entry.catalog_fetched_at = now
+        return device
+
+    def get_due_tiers(self, entry, now):
+        due_tiers = set()
+        intervals = (
+            (
+                ScrapeTier.STATE,
+                entry.state_fetched_at,
+                self.get_state_interval_seconds(),
+            ),
+            (
+                ScrapeTier.INFO,
+                entry.info_fetched_at,
+                self.get_info_interval_seconds(),
+            ),
+            (
+                ScrapeTier.CATALOG,
+                entry.catalog_fetched_at,
+                self.get_catalog_interval_seconds(),
+            ),
+        )
+        for tier, fetched_at, interval in intervals:
+            if now - fetched_at >= interval:
+                due_tiers.add(tier)
+        return due_tiers
+
+    @classmethod
+    def _count_fetch(cls, device_ip, tier):
+        Metrics.WLED_CLIENT_TIER_FETCHES.labels(
+            ip=device_ip,
+            tier=tier.value,
+        ).inc()
+
+    @classmethod
+    def _get_presets_modified(cls, device):
+        # WLED bumps the presets file time (`fs.pmt`) on every preset save
+        filesystem = device.info.filesystem
+        return filesystem.last_modified if filesystem else None
+
+    @classmethod
+    def _get_catalog_key(cls, device):
+        # The effect and palette lists only change with the firmware
+        info = device.info
+        return (str(info.version), info.effect_count, info.palette_count)
+
+
+# Global tiered device cache instance
+tiered_devices = TieredDeviceCache()
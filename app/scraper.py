@@ -1,12 +1,25 @@
+import asyncio
 import json
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
 
 import aiohttp
 
+from .change_detection import PayloadSection, SectionHashCache, section_hashes
+from .circuit_breaker import CircuitBreakerOpenException, circuit_breakers
+from .device_history import DeviceHistoryStore, device_histories
+from .device_store import DeviceStateStore, device_states
+from .discovery import SubnetDiscovery, subnet_discovery
+from .exposition_cache import exposition_cache
+from .extraction import MetricExtractor
+from .inventory import DeviceInventory, device_inventory
 from .metrics import Metrics
-from .utils import LogHelper
+from .raw_scraper import RawDevice, RawScraper
+from .scrape_tiers import tiered_devices
+from .single_flight import coalesce
+from .utils import EnvHelper, LogHelper
 from .version import version
 from .wled_client import WLEDClient
 
@@ -19,6 +32,11 @@ DEFAULT_WLED_INSTANCE_SCRAPE_INTERVAL_SECONDS = int(
 DEFAULT_WLED_FIRST_WAIT_SECONDS = int(
     os.environ.get("DEFAULT_WLED_FIRST_WAIT_SECONDS", 30)
 )
+PUSHED_SECTIONS = (
+    PayloadSection.INFO,
+    PayloadSection.STATE,
+    PayloadSection.SEGMENTS,
+)
 
 
 class ScraperException(Exception):
@@ -35,8 +53,10 @@ class ConfigBackupException(ScraperException):
 
 class Scraper(object):
     @classmethod
-    def get_client(cls):
-        return cls(WLEDClient.get_client())
+    def get_client(cls, session=None, push_manager=None):
+        return cls(
+            WLEDClient.get_client(session=session), push_manager=push_manager
+        )
 
     def default_wled_ip(self):
         return self.wled_client.default_wled_ip()
@@ -59,6 +79,21 @@ class Scraper(object):
             "on",
         )
 
+    @classmethod
+    def get_scrape_max_concurrency(cls):
+        """Max number of WLED instances scraped at the same time (1 is serial)"""
+        return EnvHelper.get_int("WLED_SCRAPE_MAX_CONCURRENCY", 10, minimum=1)
+
+    @classmethod
+    def get_scrape_cycle_deadline_seconds(cls):
+        """Budget for scraping all instances, 80% of the interval by default"""
+        deadline = EnvHelper.get_float(
+            "WLED_SCRAPE_CYCLE_DEADLINE_SECONDS", 0, minimum=0
+        )
+        if deadline:
+            return deadline
+        return cls.get_default_scrape_interval() * 0.8
+
     @classmethod
     def get_env_wled_ip_list(cls):
         try:
@@ -75,18 +110,138 @@ class Scraper(object):
             return None
         return raw_ip_list.split(",")
 
+    @classmethod
+    def get_wled_ip_list(cls):
+        """Configured instances, followed by the discovered ones"""
+        wled_ip_list = cls.get_configured_ip_list()
+        if not SubnetDiscovery.is_enabled():
+            return wled_ip_list
+        configured_ips = cls._get_configured_ips(wled_ip_list)
+        discovered = [
+            device_ip
+            for device_ip in subnet_discovery.devices
+            if device_ip not in configured_ips
+        ]
+        if not wled_ip_list and not discovered:
+            return wled_ip_list
+        return list(wled_ip_list or []) + discovered
+
+    @classmethod
+    def _get_configured_ips(cls, wled_ip_list):
+        # Disabled inventory devices must not come back through discovery
+        configured_ips = set(wled_ip_list or [])
+        if DeviceInventory.is_enabled() and device_inventory.loaded:
+            configured_ips.update(device_inventory.devices)
+        return configured_ips
+
+    @classmethod
+    def forget_undiscovered(cls, change):
+        """Drop the devices discovery lost, unless they are configured"""
+        configured_ips = cls._get_configured_ips(cls.get_configured_ip_list())
+        cls.forget_devices(
+            tuple(
+                device_ip
+                for device_ip in change.removed
+                if device_ip not in configured_ips
+            )
+        )
+
+    @classmethod
+    def get_configured_ip_list(cls):
+        """Enabled instances of the inventory file, or of WLED_IP_LIST"""
+        if DeviceInventory.is_enabled():
+            change = device_inventory.refresh()
+            if change:
+                cls.forget_devices(
+                    change.removed
+                    + tuple(
+                        device_ip
+                        for device_ip in change.changed
+                        if not device_inventory.get(device_ip).enabled
+                    )
+                )
+            if device_inventory.loaded:
+                return device_inventory.get_ip_list()
+        return cls.parse_env_wled_ip_list()
+
+    @classmethod
+    def get_backup_ip_list(cls, backup_type):
+        """Instances whose backup policy includes `config` or `presets`"""
+        wled_ip_list = cls.get_wled_ip_list()
+        if DeviceInventory.is_enabled() and device_inventory.loaded:
+            # Discovered devices have the default policy, back up all
+            inventory_ips = set(device_inventory.devices)
+            return device_inventory.get_backup_ip_list(backup_type) + [
+                device_ip
+                for device_ip in wled_ip_list or []
+                if device_ip not in inventory_ips
+            ]
+        return wled_ip_list
+
+    @classmethod
+    def get_inventory_intervals(cls):
+        if DeviceInventory.is_enabled() and device_inventory.loaded:
+            return device_inventory.get_intervals()
+        return None
+
+    @classmethod
+    def forget_devices(cls, device_ips):
+        """Drop what is kept in memory about instances no longer scraped,
+        the instances that stay keep theirs"""
+        if not device_ips:
+            return
+        extractor = MetricExtractor.get_extractor()
+        for device_ip in device_ips:
+            for reported_ip in extractor.evict_device(device_ip) + [device_ip]:
+                device_states.remove(reported_ip)
+                device_histories.remove(reported_ip)
+            section_hashes.forget(device_ip)
+            tiered_devices.remove(device_ip)
+            circuit_breakers.remove_breaker(device_ip)
+
+    @classmethod
+    def publish_device_stores(cls):
+        """Share what this worker scraped with the other workers"""
+        if DeviceStateStore.is_enabled():
+            device_states.publish()
+        if DeviceHistoryStore.is_enabled():
+            device_histories.publish()
+
+    @classmethod
+    def refresh_device_stores(cls):
+        """Load what another worker scraped, before scraping or serving"""
+        if DeviceStateStore.is_enabled():
+            device_states.refresh()
+        if DeviceHistoryStore.is_enabled():
+            device_histories.refresh()
+
     @classmethod
     def get_config_backup_dir(cls):
         """Get the config backup directory from environment variable"""
         return os.environ.get("CONFIG_BACKUP_DIR", "/backups/")
 
-    def __init__(self, wled_client):
+    def __init__(self, wled_client, push_manager=None):
         self._wled_client = wled_client
+        self._push_manager = push_manager
 
     @property
     def wled_client(self):
         return self._wled_client
 
+    @property
+    def push_manager(self):
+        return self._push_manager
+
+    @asynccontextmanager
+    async def _http_session(self):
+        """Use the pooled client session, or a throwaway one without it"""
+        session = self.wled_client.session if self.wled_client else None
+        if session:
+            yield session
+            return
+        async with aiohttp.ClientSession() as session:
+            yield session
+
     async def backup_config_from_instance(self, device_ip, backup_dir=None):
         """Backup config from a single WLED instance"""
         if backup_dir is None:
@@ -107,8 +262,10 @@ class Scraper(object):
         start_time = datetime.now()
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(config_url, timeout=10) as response:
+            async with self._http_session() as session:
+                async with session.get(
+                    config_url, timeout=WLEDClient.get_client_timeout()
+                ) as response:
                     if response.status == 200:
                         config_data = await response.json()
 
@@ -236,8 +393,10 @@ class Scraper(object):
         start_time = datetime.now()
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(presets_url, timeout=10) as response:
+            async with self._http_session() as session:
+                async with session.get(
+                    presets_url, timeout=WLEDClient.get_client_timeout()
+                ) as response:
                     if response.status == 200:
                         presets_data = await response.json()
 
@@ -376,7 +535,7 @@ class Scraper(object):
 
     async def backup_configs_from_all_instances(self, backup_dir=None):
         """Backup configs from all WLED instances"""
-        wled_ip_list = self.parse_env_wled_ip_list()
+        wled_ip_list = self.get_backup_ip_list("config")
         if not wled_ip_list:
             e_m = "missing wled ip list! must provide with env var to use this method"
             log.error(e_m)
@@ -451,7 +610,7 @@ class Scraper(object):
 
     async def backup_presets_from_all_instances(self, backup_dir=None):
         """Backup presets from all WLED instances"""
-        wled_ip_list = self.parse_env_wled_ip_list()
+        wled_ip_list = self.get_backup_ip_list("presets")
         if not wled_ip_list:
             e_m = "missing wled ip list! must provide with env var to use this method"
             log.error(e_m)
@@ -526,7 +685,7 @@ class Scraper(object):
 
     async def backup_all_from_all_instances(self, backup_dir=None):
         """Backup both configs and presets from all WLED instances"""
-        wled_ip_list = self.parse_env_wled_ip_list()
+        wled_ip_list = self.get_wled_ip_list()
         if not wled_ip_list:
             e_m = "missing wled ip list! must provide with env var to use this method"
             log.error(e_m)
@@ -562,340 +721,91 @@ class Scraper(object):
             "total_devices": len(wled_ip_list),
         }
 
-    def scrape_device_sync(self, device_info, device_state):
-        if not device_info:
-            return
-        if not device_state:
-            return
-        sync_state = device_state.sync
-        log.debug(f"sync_state: {sync_state}")
-        Metrics.INSTANCE_SYNC_RECEIVE_STATE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(sync_state.receive or 0)
-        Metrics.INSTANCE_SYNC_RECEIVE_GROUPS.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(sync_state.receive_groups or 0)
-        Metrics.INSTANCE_SYNC_SEND_STATE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(sync_state.send or 0)
-        Metrics.INSTANCE_SYNC_SEND_GROUPS.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(sync_state.send_groups or 0)
-
-    def scrape_device_wifi(self, device_info):
-        if not device_info:
-            return
-        wifi_info = device_info.wifi
-        log.debug(f"wifi_info: {wifi_info}")
-        Metrics.INSTANCE_WIFI_CHANNEL.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(wifi_info.channel or 0)
-        Metrics.INSTANCE_WIFI_RSSI.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(wifi_info.rssi or 0)
-        Metrics.INSTANCE_WIFI_SIGNAL.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(wifi_info.signal or 0)
-        Metrics.INSTANCE_WIFI_BSSID.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-            bssid=wifi_info.bssid,
-        ).set(1)
+    def scrape_device_metrics(self, device, sections=None, device_ip=None):
+        self.scrape_raw_device_metrics(
+            RawDevice.from_device(device),
+            sections=sections,
+            device_ip=device_ip,
+        )
 
-    def scrape_device_presets(self, device_info, device):
-        if not device_info:
-            return
-        presets = device.presets
-        preset_info_list = list(presets.values())
-        preset_count = len(preset_info_list)
-        log.debug(f"found preset_count: {preset_count} => presets: {presets}")
-        Metrics.INSTANCE_PRESET_COUNT_VALUE.labels(
-            name=device_info.name,
-            ip=device_info.ip,
-        ).set(preset_count or 0)
-        for preset_info in preset_info_list:
-            log.debug(f"found preset_info: {preset_info}")
-            preset_id = preset_info.preset_id
-            preset_name = preset_info.name
-            final_quick_label = preset_info.quick_label or "missing"
-            Metrics.INSTANCE_PRESET_IS_ON_VALUE.labels(
-                name=device_info.name,
-                ip=device_info.ip,
-                preset_id=preset_id,
-                preset_name=preset_name,
-            ).set(preset_info.on or 0)
-            Metrics.INSTANCE_PRESET_TRANSITION_VALUE.labels(
-                name=device_info.name,
-                ip=device_info.ip,
-                preset_id=preset_id,
-                preset_name=preset_name,
-            ).set(preset_info.transition or 0)
-            Metrics.INSTANCE_PRESET_QUICK_LABEL_INFO.labels(
-                name=device_info.name,
-                ip=device_info.ip,
-                preset_id=preset_id,
-                preset_name=preset_name,
-                preset_quick_label=final_quick_label,
-            ).set(1)
-
-    def scrape_uptime(self, device_info):
-        Metrics.INSTANCE_UPTIME_SECONDS.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_info.uptime.total_seconds() or 0)
-
-    def scrape_websocket_clients(self, device_info):
-        Metrics.INSTANCE_WEBSOCKET_CLIENTS.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_info.websocket or 0)
-
-    def scrape_udp_port(self, device_info):
-        Metrics.INSTANCE_UDP_PORT.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_info.udp_port or 0)
-
-    def scrape_state_nightlight(self, device_info, device_state):
-        dev_nightlight = device_state.nightlight
-        log.debug(f"got dev_nightlight: {dev_nightlight}")
-        Metrics.INSTANCE_NIGHTLIGHT_DURATION_MINUTES.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_nightlight.duration or 0)
-        Metrics.INSTANCE_NIGHTLIGHT_ON_VALUE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_nightlight.on or 0)
-        Metrics.INSTANCE_NIGHTLIGHT_TARGET_BRIGHTNESS_VALUE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_nightlight.target_brightness or 0)
-
-    def _scrape_single_priority_color(
-        self, device_info, segment_name, color_priority, colors
+    def scrape_raw_device_metrics(
+        self, raw_device, sections=None, device_ip=None
     ):
-        if not colors:
-            return
-        color_position = 0
-        for color_value in colors:
-            log.debug(
-                f"color_priority ({color_priority}) ==> at "
-                f"color_position: {color_position} "
-                f"color_value: {color_value}"
+        extractor = MetricExtractor.get_extractor()
+        info = raw_device.info
+        state = raw_device.state
+        presets = raw_device.presets
+        # Sections that didn't change since the last scrape are skipped
+        if not SectionHashCache.is_enabled():
+            device_ip = None
+        labels = RawScraper.get_labels(info)
+        if DeviceStateStore.is_enabled():
+            self._store_device_state(labels[0], raw_device, sections)
+        section_parts = {
+            PayloadSection.PRESETS: (labels, presets),
+            PayloadSection.INFO: (info,),
+            PayloadSection.STATE: (
+                labels,
+                [item for item in state.items() if item[0] != "seg"],
+            ),
+            PayloadSection.SEGMENTS: (labels, state.get("seg")),
+        }
+        for section, parts in section_parts.items():
+            if sections is not None and section not in sections:
+                continue
+            self._scrape_section(
+                device_ip,
+                section,
+                parts,
+                lambda section=section: extractor.extract_section(
+                    section, info, state, presets
+                ),
             )
-            Metrics.INSTANCE_SEGMENT_COLOR_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-                color_priority=color_priority,
-                color_tuple_position=color_position,
-            ).set(color_value)
-            color_position += 1
-
-    def scrape_state_segment_colors(
-        self, device_info, segment_name, segment_info
-    ):
-        dev_colors = segment_info.color
-        log.debug(f"got dev_colors: {dev_colors}")
-        if not dev_colors:
+        extractor.finish_device(labels[0], scrape_ip=device_ip)
+
+    def _store_device_state(self, device_ip, raw_device, sections):
+        if sections is None:
+            sections = tuple(PayloadSection)
+        parts = {}
+        if PayloadSection.INFO in sections:
+            parts["info"] = raw_device.info
+        if {PayloadSection.STATE, PayloadSection.SEGMENTS} & set(sections):
+            parts["state"] = raw_device.state
+        if PayloadSection.PRESETS in sections:
+            parts["presets"] = raw_device.presets
+        device_states.update(device_ip, **parts)
+
+    def _scrape_section(self, device_ip, section, parts, scrape):
+        if device_ip is None:
+            scrape()
             return
-        primary_colors = dev_colors.primary
-        self._scrape_single_priority_color(
-            device_info, segment_name, "primary", primary_colors
-        )
-        secondary_colors = dev_colors.secondary
-        self._scrape_single_priority_color(
-            device_info, segment_name, "secondary", secondary_colors
-        )
-        tertiary_colors = dev_colors.tertiary
-        self._scrape_single_priority_color(
-            device_info, segment_name, "tertiary", tertiary_colors
-        )
+        digest = section_hashes.get_digest(*parts)
+        if section_hashes.is_unchanged(device_ip, section, digest):
+            log.debug(f"{section.value} of {device_ip} unchanged, skipping")
+            return
+        scrape()
+        section_hashes.remember(device_ip, section, digest)
 
-    def scrape_state_segments(self, device_info, device_state):
-        dev_segments_list = device_state.segments
-        log.debug(f"got dev_segments_list: {dev_segments_list}")
-        for segment_name, segment_info in dev_segments_list.items():
-            Metrics.INSTANCE_SEGMENT_BRIGHTNESS_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.brightness or 0)
-            Metrics.INSTANCE_SEGMENT_CLONES_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.clones or 0)
-            Metrics.INSTANCE_SEGMENT_EFFECT_ID_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.effect_id or 0)
-            Metrics.INSTANCE_SEGMENT_INTENSITY_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.intensity or 0)
-            Metrics.INSTANCE_SEGMENT_LENGTH_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.length or 0)
-            Metrics.INSTANCE_SEGMENT_ON_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.on or 0)
-            Metrics.INSTANCE_SEGMENT_PALETTE_ID_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.palette_id or 0)
-            Metrics.INSTANCE_SEGMENT_REVERSE_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.reverse or 0)
-            Metrics.INSTANCE_SEGMENT_SEGMENT_ID_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.segment_id or 0)
-            Metrics.INSTANCE_SEGMENT_SELECTED_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.selected or 0)
-            Metrics.INSTANCE_SEGMENT_SPEED_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.speed or 0)
-            Metrics.INSTANCE_SEGMENT_CCT_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.cct or 0)
-            Metrics.INSTANCE_SEGMENT_START_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.start or 0)
-            Metrics.INSTANCE_SEGMENT_STOP_VALUE.labels(
-                ip=device_info.ip,
-                name=device_info.name,
-                segment=segment_name,
-            ).set(segment_info.stop or 0)
-            log.debug(
-                f"Now try and scrape colors "
-                f"from segment_name: {segment_name}"
-            )
-            self.scrape_state_segment_colors(
-                device_info, segment_name, segment_info
+    def scrape_pushed_device(self, device_ip, device):
+        """Update metrics from a WebSocket push, presets are never pushed"""
+        self.scrape_device_metrics(
+            device, sections=PUSHED_SECTIONS, device_ip=device_ip
+        )
+        if DeviceHistoryStore.is_enabled():
+            # Pushes come with every change, sample them at the poll rate
+            # so the buffer spans the same time as for polled devices
+            device_histories.record_device(
+                device,
+                default_ip=device_ip,
+                min_interval=self.get_default_scrape_interval(),
             )
-
-    def scrape_info_filesystem(self, device_info):
-        dev_fs = device_info.filesystem
-        log.debug(f"got dev_fs: {dev_fs}")
-        Metrics.INSTANCE_FILESYSTEM_SPACE_TOTAL.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_fs.total or 0)
-        Metrics.INSTANCE_FILESYSTEM_SPACE_USED.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_fs.used or 0)
-
-    def scrape_info_leds(self, device_info):
-        dev_leds = device_info.leds
-        log.debug(f"got dev_leds: {dev_leds}")
-        Metrics.INSTANCE_LED_COUNT_VALUE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_leds.count or 0)
-        Metrics.INSTANCE_LED_FPS_VALUE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_leds.fps or 0)
-        Metrics.INSTANCE_LED_MAX_SEGMENTS.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_leds.max_segments or 0)
-        Metrics.INSTANCE_LED_MAX_POWER.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_leds.max_power or 0)
-        Metrics.INSTANCE_LED_CURRENT_POWER.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(dev_leds.power or 0)
-
-    def scrape_device_info(self, device_info):
-        if not device_info:
-            return
-        log.debug(f"dev_info.version: {device_info.version}")
-        log.debug(f"dev_info: {device_info}")
-
-        Metrics.INSTANCE_INFO.labels(
-            architecture=device_info.architecture,
-            arduino_core_version=device_info.arduino_core_version,
-            brand=device_info.brand,
-            build=device_info.build,
-            ip=device_info.ip,
-            mac_address=device_info.mac_address,
-            name=device_info.name,
-            product=device_info.product,
-            version=str(device_info.version),
+        Metrics.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER.labels(
+            ip=device_ip,
+            scrape_event="pushed",
+        ).inc()
+        Metrics.WLED_INSTANCE_ONLINE.labels(
+            ip=device_ip,
         ).set(1)
-        Metrics.INSTANCE_FREE_HEAP.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_info.free_heap or 0)
-        Metrics.INSTANCE_PALETTE_COUNT_VALUE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_info.palette_count or 0)
-        Metrics.INSTANCE_EFFECT_COUNT_VALUE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_info.effect_count or 0)
-        Metrics.INSTANCE_LIVE_STATE.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_info.live or 0)
-
-    def scrape_device_state(self, device_info, device_state):
-        if not device_info:
-            return
-
-        Metrics.INSTANCE_STATE_BRIGHTNESS.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_state.brightness or 0)
-        Metrics.INSTANCE_STATE_TRANSITION.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_state.transition or 0)
-        Metrics.INSTANCE_STATE_ON.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_state.on or 0)
-        Metrics.INSTANCE_STATE_PLAYLIST_ID.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_state.playlist_id or 0)
-        Metrics.INSTANCE_STATE_PRESET_ID.labels(
-            ip=device_info.ip,
-            name=device_info.name,
-        ).set(device_state.preset_id or 0)
 
     async def scrape_default_instance(self):
         device_ip = self.default_wled_ip()
@@ -932,7 +842,24 @@ class Scraper(object):
                 ip=device_ip,
                 # name=dev_info.name,
             ).set(0)
-        device = await self.wled_client.get_wled_instance_device(device_ip)
+        raw_mode = RawScraper.is_enabled()
+        try:
+            if raw_mode:
+                device = await self.wled_client.get_wled_instance_raw(
+                    device_ip
+                )
+            else:
+                device = await self.wled_client.get_wled_instance_device(
+                    device_ip
+                )
+        except CircuitBreakerOpenException:
+            # Device is known dead, it stays reported as offline
+            if set_metrics:
+                Metrics.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER.labels(
+                    ip=device_ip,
+                    scrape_event="circuit_open",
+                ).inc()
+            raise
         if set_metrics:
             Metrics.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER.labels(
                 ip=device_ip,
@@ -942,22 +869,11 @@ class Scraper(object):
         log.debug(f"wled got device: {device}")
 
         try:
-            dev_info = device.info
-            dev_state = device.state
             # Always scrape all device metrics when this worker has the lock
-            if set_metrics:
-                self.scrape_device_presets(dev_info, device)
-                self.scrape_device_info(dev_info)
-                self.scrape_uptime(dev_info)
-                self.scrape_websocket_clients(dev_info)
-                self.scrape_udp_port(dev_info)
-                self.scrape_info_leds(dev_info)
-                self.scrape_info_filesystem(dev_info)
-                self.scrape_device_wifi(dev_info)
-                self.scrape_device_state(dev_info, dev_state)
-                self.scrape_device_sync(dev_info, dev_state)
-                self.scrape_state_nightlight(dev_info, dev_state)
-                self.scrape_state_segments(dev_info, dev_state)
+            if set_metrics and raw_mode:
+                self.scrape_raw_device_metrics(device, device_ip=device_ip)
+            elif set_metrics:
+                self.scrape_device_metrics(device, device_ip=device_ip)
         except Exception as unexp:
             log.error(
                 f"Unexpected issue for device_ip: {device_ip} "
@@ -985,6 +901,8 @@ class Scraper(object):
                     # name=dev_info.name,
                 ).set(0)
         else:
+            if set_metrics and DeviceHistoryStore.is_enabled():
+                device_histories.record_device(device, default_ip=device_ip)
             if set_metrics:
                 Metrics.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER.labels(
                     ip=device_ip,
@@ -1006,19 +924,25 @@ class Scraper(object):
                         version=current_version,
                     ).set(1)
 
-    async def scrape_all_instances(self, set_metrics=True):
+    async def scrape_all_instances(self, set_metrics=True, scheduler=None):
         # Only set timing and exception metrics if this worker is responsible for metrics
         if set_metrics:
             with Metrics.WLED_SCRAPER_SCRAPE_ALL_EXCEPTIONS.count_exceptions():
                 with Metrics.WLED_SCRAPER_SCRAPE_ALL_TIME.time():
-                    await self._scrape_all_instances_internal(set_metrics=True)
+                    await self._scrape_all_instances_internal(
+                        set_metrics=True, scheduler=scheduler
+                    )
         else:
             # Just do the scraping without any metrics
-            await self._scrape_all_instances_internal(set_metrics=False)
+            await self._scrape_all_instances_internal(
+                set_metrics=False, scheduler=scheduler
+            )
 
-    async def _scrape_all_instances_internal(self, set_metrics=True):
+    async def _scrape_all_instances_internal(
+        self, set_metrics=True, scheduler=None
+    ):
         """Internal method for scraping all instances"""
-        wled_ip_list = self.parse_env_wled_ip_list()
+        wled_ip_list = self.get_wled_ip_list()
         if not wled_ip_list:
             e_m = (
                 "missing wled ip list! must provide "
@@ -1026,16 +950,101 @@ class Scraper(object):
             )
             log.error(e_m)
             raise MissingIPListScraperException(e_m)
-        for device_ip in wled_ip_list:
-            log.debug(f"scraping metrics for device_ip: {device_ip}")
-            try:
-                await self.scrape_instance(device_ip, set_metrics=set_metrics)
-            # TODO: why does it throw up here and not within function?
-            except Exception as unexp:
-                u_m = (
-                    f"Scrape all device_ip: {device_ip} " f"got unexp: {unexp}"
+
+        if self.push_manager is not None:
+            # Keep one WebSocket per instance, (re)started as the list changes
+            self.push_manager.sync_devices(wled_ip_list)
+
+        if scheduler is not None:
+            # Only scrape the instances whose next-due time has passed
+            scheduler.sync_devices(
+                wled_ip_list, intervals=self.get_inventory_intervals()
+            )
+            wled_ip_list = scheduler.pop_due()
+            log.debug(f"scheduler has {len(wled_ip_list)} due instances")
+
+        pending = set(wled_ip_list)
+        deadline = self.get_scrape_cycle_deadline_seconds()
+        try:
+            # Hard budget so one slow cycle never runs into the next one
+            async with asyncio.timeout(deadline):
+                await self._scrape_instances_bounded(
+                    wled_ip_list, pending, set_metrics, scheduler
                 )
-                log.error(u_m)
+        except TimeoutError:
+            log.warning(
+                f"Scrape cycle deadline of {deadline}s exceeded, "
+                f"cancelled {len(pending)} remaining instances"
+            )
+            if set_metrics:
+                for device_ip in pending:
+                    Metrics.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER.labels(
+                        ip=device_ip,
+                        scrape_event="deadline_exceeded",
+                    ).inc()
+        if set_metrics and MetricExtractor.is_eviction_enabled():
+            # The last known state and history of an offline device stay
+            # served, they are only dropped when it leaves the scrape set
+            MetricExtractor.get_extractor().evict_stale_devices()
+
+    async def _scrape_instances_bounded(
+        self, wled_ip_list, pending, set_metrics=True, scheduler=None
+    ):
+        """Scrape instances with bounded fan-out, discarding done ones from pending"""
+        max_concurrency = self.get_scrape_max_concurrency()
+        if max_concurrency <= 1:
+            for device_ip in wled_ip_list:
+                await self._scrape_instance_isolated(
+                    device_ip, set_metrics=set_metrics, scheduler=scheduler
+                )
+                pending.discard(device_ip)
+            return
+
+        # Bound the fan-out so a big fleet doesn't open every socket at once
+        semaphore = asyncio.Semaphore(max_concurrency)
+        in_flight = Metrics.WLED_SCRAPER_SCRAPE_INSTANCES_IN_FLIGHT
+
+        async def bounded_scrape(device_ip):
+            async with semaphore:
+                if not set_metrics:
+                    await self._scrape_instance_isolated(
+                        device_ip, set_metrics=False, scheduler=scheduler
+                    )
+                else:
+                    with in_flight.track_inprogress():
+                        await self._scrape_instance_isolated(
+                            device_ip, set_metrics=True, scheduler=scheduler
+                        )
+            pending.discard(device_ip)
+
+        async with asyncio.TaskGroup() as task_group:
+            for device_ip in wled_ip_list:
+                task_group.create_task(bounded_scrape(device_ip))
+
+    async def _scrape_instance_isolated(
+        self, device_ip, set_metrics=True, scheduler=None
+    ):
+        """Scrape a single instance without letting its failure escape"""
+        log.debug(f"scraping metrics for device_ip: {device_ip}")
+        try:
+            push_manager = self.push_manager
+            if push_manager is not None and push_manager.is_connected(
+                device_ip
+            ):
+                # State and info arrive over the WebSocket, only poll presets
+                await push_manager.refresh_presets(device_ip)
+            else:
+                await self.scrape_instance(device_ip, set_metrics=set_metrics)
+        # TODO: why does it throw up here and not within function?
+        except Exception as unexp:
+            u_m = f"Scrape all device_ip: {device_ip} " f"got unexp: {unexp}"
+            log.error(u_m)
+            if scheduler is not None:
+                scheduler.record_failure(device_ip)
+            return False
+        if scheduler is not None:
+            scheduler.record_success(device_ip)
+        return True
 
     async def scrape_releases(self):
         with Metrics.SCRAPER_SCRAPE_RELEASES_EXCEPTIONS.count_exceptions():
@@ -1047,7 +1056,7 @@ class Scraper(object):
                 ).set(1)
 
     async def perform_full_scrape(
-        self, set_instance_info=True, set_metrics=True
+        self, set_instance_info=True, set_metrics=True, scheduler=None
     ):
         # first scrape self info for this app
         log.debug("perform_full_scrape")
@@ -1055,12 +1064,24 @@ class Scraper(object):
             with Metrics.SCRAPER_FULL_SCRAPE_TIME.time():
                 self.scrape_self(set_instance_info=set_instance_info)
                 log.debug("done with scrape self, next all wled instances")
-                # then scrape all wled instances
-                await self.scrape_all_instances(set_metrics=set_metrics)
+                # then scrape all wled instances, a full round is shared
+                # with /prometheus/all requests arriving meanwhile
+                if scheduler is None and set_metrics:
+                    await coalesce(
+                        "scrape_all", "all", self.scrape_all_instances
+                    )
+                else:
+                    await self.scrape_all_instances(
+                        set_metrics=set_metrics, scheduler=scheduler
+                    )
                 log.debug("done scraping all wled instances, now releases")
-                if self.should_scrape_releases():
+                if not self.should_scrape_releases():
+                    log.debug("release checking disabled - skipping releases")
+                elif scheduler and not scheduler.claim_releases_check():
+                    log.debug("release check not due yet - skipping releases")
+                else:
                     log.debug("release checking enabled - scraping releases")
                     await self.scrape_releases()
-                else:
-                    log.debug("release checking disabled - skipping releases")
+                # Counters and online gauges changed along with the devices
+                exposition_cache.invalidate()
                 log.debug("done with perform_full_scrape")
@@ -0,0 +1,170 @@
+"""Scraper daemon, run with `python -m app.scraper_daemon`
+
+Runs the scrape loop in its own process and publishes the exporter
+metrics to the shared metrics file. The HTTP workers, started with
+ENABLE_SCRAPER_DAEMON, then only serve reads.
+"""
+
+import asyncio
+import os
+import signal
+
+from .discovery import SubnetDiscovery, subnet_discovery
+from .leader_election import LeaderElection
+from .lock_manager import lock_manager
+from .scheduler import ScrapeScheduler
+from .scrape_intervals import scrape_intervals
+from .scraper import Scraper
+from .shared_metrics import shared_metrics
+from .utils import EnvHelper, LogHelper
+from .websocket_push import WebSocketPushManager
+from .wled_client import WLEDClient
+
+log = LogHelper.get_env_logger(__name__)
+
+
+class ScraperDaemon(object):
+    """Scrape loop of a dedicated process, outside of the HTTP workers"""
+
+    @classmethod
+    def is_enabled(cls):
+        # Read by the HTTP workers, they skip their own scrape loop
+        return EnvHelper.get_bool("ENABLE_SCRAPER_DAEMON", "false")
+
+    def __init__(self, shared=shared_metrics):
+        self._shared = shared
+        self._stopping = asyncio.Event()
+        self.scraper = None
+        self.scheduler = None
+        self.leader_election = None
+        self.discovery = None
+        self.loop_interval = Scraper.get_default_scrape_interval()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def start(self):
+        """Set up the pooled session, scheduler and push connections"""
+        http_session = WLEDClient.create_session()
+        WLEDClient.set_shared_session(http_session)
+        if ScrapeScheduler.is_enabled():
+            self.scheduler = ScrapeScheduler.get_scheduler(
+                Scraper.get_default_scrape_interval()
+            )
+            self.loop_interval = ScrapeScheduler.get_tick_seconds()
+            scrape_intervals.use_scheduler(self.scheduler)
+        push_manager = None
+        if WebSocketPushManager.is_enabled():
+            WLEDClient.set_push_session(WLEDClient.create_push_session())
+            push_manager = WebSocketPushManager.get_manager(
+                Scraper.get_client(session=http_session)
+            )
+        self.scraper = Scraper.get_client(
+            session=http_session, push_manager=push_manager
+        )
+        if LeaderElection.is_enabled():
+            # Standby daemons wait for the lease instead of the lock
+            self.leader_election = LeaderElection()
+            self.leader_election.start()
+        if SubnetDiscovery.is_enabled():
+            self.discovery = subnet_discovery
+            self.discovery.start(
+                is_active=self._is_active,
+                on_change=Scraper.forget_undiscovered,
+            )
+
+    def _is_active(self):
+        # Standby daemons don't sweep, the leader's scrape set is used
+        return self.leader_election is None or self.leader_election.is_leader
+
+    async def close(self):
+        if self.discovery is not None:
+            await self.discovery.stop()
+        if self.leader_election is not None:
+            await self.leader_election.stop()
+        if self.scraper is not None and self.scraper.push_manager:
+            await self.scraper.push_manager.stop()
+        await WLEDClient.close_shared_session()
+
+    async def run_once(self):
+        """One full scrape, published for the HTTP workers"""
+        if self.leader_election is not None:
+            return await self._run_once_as_leader()
+        pid = os.getpid()
+        # Still take the scraper lock, so a second daemon (or workers
+        # started without ENABLE_SCRAPER_DAEMON) never scrape alongside
+        if not lock_manager.try_acquire_lock(
+            "scraper", pid, timeout_seconds=300
+        ):
+            log.debug(f"🔒 Daemon {pid}: Scraper lock held elsewhere")
+            return False
+        try:
+            await self.scraper.perform_full_scrape(
+                set_instance_info=True,
+                set_metrics=True,
+                scheduler=self.scheduler,
+            )
+            self._shared.publish()
+            Scraper.publish_device_stores()
+            return True
+        except Exception as e:
+            log.error(f"❌ Daemon {pid}: Error during full scrape: {e}")
+            return False
+        finally:
+            lock_manager.release_lock("scraper", pid)
+
+    async def _run_once_as_leader(self):
+        election = self.leader_election
+        if not election.is_leader:
+            log.debug(f"👑 Daemon {election.holder}: Standing by")
+            return False
+        try:
+            await self.scraper.perform_full_scrape(
+                set_instance_info=True,
+                set_metrics=True,
+                scheduler=self.scheduler,
+            )
+        except Exception as e:
+            log.error(f"❌ Daemon {election.holder}: Error during scrape: {e}")
+            return False
+        # A leader that was replaced meanwhile must not publish
+        if not election.is_current():
+            log.warning(f"👑 Daemon {election.holder}: Fenced off")
+            return False
+        self._shared.publish()
+        Scraper.publish_device_stores()
+        return True
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        await self.start()
+        log.info(
+            f"🚀 Scraper daemon {os.getpid()} started "
+            f"(interval: {self.loop_interval}s, "
+            f"publishing to {self._shared.path})"
+        )
+        try:
+            await self._sleep(Scraper.get_default_wait_first_interval())
+            while not self._stopping.is_set():
+                await self.run_once()
+                await self._sleep(self.loop_interval)
+        finally:
+            await self.close()
+            log.info("🛑 Scraper daemon stopped")
+
+
+async def run_daemon():
+    daemon = ScraperDaemon()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, daemon.stop)
+    await daemon.run()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_daemon())
@@ -0,0 +1,171 @@
+import os
+import tempfile
+
+from prometheus_client import REGISTRY
+
+from .exposition import render_collectors, render_metrics
+from .leader_election import LeaderElection
+from .metrics import Metrics
+from .snapshot import DeviceSnapshotCollector
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+SHARED_METRICS_FILE_NAME = "wargos_shared_metrics.prom"
+# Only what the scrape loop sets is shared, the rest (process, platform,
+# HTTP request, coalescing and backup metrics) belongs to the worker
+# serving /metrics
+SCRAPER_METRIC_NAMES = frozenset(
+    metric._name for metric in Metrics.scraper_metrics()
+)
+
+
+def split_collectors(registry=REGISTRY):
+    """The (shared, worker local) collectors of a registry"""
+    with registry._lock:
+        collectors = list(registry._collector_to_names)
+    shared = []
+    local = []
+    for collector in collectors:
+        if isinstance(collector, DeviceSnapshotCollector) or (
+            getattr(collector, "_name", None) in SCRAPER_METRIC_NAMES
+        ):
+            shared.append(collector)
+        else:
+            local.append(collector)
+    return shared, local
+
+
+def write_atomically(path, body):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as temp_file:
+        temp_file.write(body)
+    # Readers see either the old or the new file, never a partial one
+    os.replace(temp_path, path)
+
+
+def get_file_key(path):
+    """What changes whenever the file is replaced, None if it's missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class SharedFile(object):
+    """A file next to the shared metrics, written by the scraping worker
+    and read again by the others only when it was replaced"""
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._file_key = None
+
+    @property
+    def path(self):
+        directory = os.path.dirname(SharedMetricsFile.get_path())
+        return os.path.join(directory, self._file_name)
+
+    def write(self, body):
+        path = self.path
+        write_atomically(path, body)
+        # The writer already has what it wrote, it mustn't read it back
+        self._file_key = get_file_key(path)
+
+    def read_changed(self):
+        """The body if the file was replaced since the last call, or None"""
+        path = self.path
+        file_key = get_file_key(path)
+        if file_key is None or file_key == self._file_key:
+            return None
+        with open(path, "rb") as shared_file:
+            body = shared_file.read()
+        self._file_key = file_key
+        return body
+
+
+class SharedMetricsFile(object):
+    """Exporter metrics rendered by the scraping worker into a file that
+    every worker serves /metrics from. The file is replaced atomically
+    and only read again when it changed, so a request costs one stat"""
+
+    @classmethod
+    def is_enabled(cls):
+        # Workers can only see what a scraper daemon scraped through the file
+        if EnvHelper.get_bool("ENABLE_SCRAPER_DAEMON", "false"):
+            return True
+        if not cls.is_requested():
+            return False
+        return cls.can_run_in_workers()
+
+    @classmethod
+    def is_requested(cls):
+        return EnvHelper.get_bool("ENABLE_SHARED_METRICS", "false")
+
+    @classmethod
+    def can_run_in_workers(cls):
+        """Without leader election the scraper lock moves between workers,
+        each publishing its own counters over the previous holder's, so the
+        shared series would jump back and forth"""
+        return LeaderElection.is_enabled() or EnvHelper.get_worker_count() == 1
+
+    @classmethod
+    def get_path(cls):
+        path = os.environ.get("SHARED_METRICS_PATH")
+        if path:
+            return path
+        # Gunicorn deployments already share this directory between workers
+        directory = os.environ.get(
+            "PROMETHEUS_MULTIPROC_DIR", tempfile.gettempdir()
+        )
+        return os.path.join(directory, SHARED_METRICS_FILE_NAME)
+
+    def __init__(self, path=None):
+        self._path = path
+        self._body = b""
+        self._file_key = None
+
+    @property
+    def path(self):
+        return self._path or self.get_path()
+
+    def publish(self, registry=REGISTRY):
+        """Write the exporter metrics of this worker for all workers"""
+        shared, _ = split_collectors(registry)
+        body = render_collectors(shared)
+        path = self.path
+        write_atomically(path, body)
+        log.debug(f"Published {len(body)} bytes of metrics to {path}")
+        return body
+
+    def refresh(self):
+        """Reload the file if it was replaced, returns whether it was"""
+        file_key = get_file_key(self.path)
+        if file_key is None:
+            changed = self._file_key is not None
+            self._body = b""
+            self._file_key = None
+            return changed
+        if file_key == self._file_key:
+            return False
+        with open(self.path, "rb") as shared_file:
+            self._body = shared_file.read()
+        self._file_key = file_key
+        return True
+
+    def render(self, registry=REGISTRY):
+        """This worker's own metrics followed by the shared ones"""
+        self.refresh()
+        _, local = split_collectors(registry)
+        return render_collectors(local) + self._body
+
+
+# Global shared metrics file instance
+shared_metrics = SharedMetricsFile()
+
+
+def render_exposition():
+    """The /metrics body, with the shared exporter metrics when enabled"""
+    if SharedMetricsFile.is_enabled():
+        return shared_metrics.render()
+    return render_metrics()
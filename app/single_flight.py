@@ -0,0 +1,53 @@
+import asyncio
+
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+class SingleFlight(object):
+    """Runs one operation per key at a time. Callers arriving while it is
+    in flight wait for that run and all get its result (or exception)"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_REQUEST_COALESCING", "false")
+
+    def __init__(self):
+        # (operation, target) -> task of the run in flight
+        self._in_flight = {}
+
+    def is_in_flight(self, operation, target):
+        return (operation, target) in self._in_flight
+
+    async def run(self, operation, target, make_coroutine):
+        key = (operation, target)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_coroutine())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            log.debug(f"Joining {operation} for {target} already in flight")
+            Metrics.REQUESTS_COALESCED.labels(operation=operation).inc()
+        # A caller that goes away must not cancel the run for the others
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Retrieved here too, in case every caller went away
+            task.exception()
+
+
+async def coalesce(operation, target, make_coroutine):
+    """Await make_coroutine(), shared with identical calls in flight"""
+    if not SingleFlight.is_enabled():
+        return await make_coroutine()
+    return await single_flight.run(operation, target, make_coroutine)
+
+
+# Global single flight instance
+single_flight = SingleFlight()
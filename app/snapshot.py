@@ -0,0 +1,110 @@
+import time
+from dataclasses import dataclass
+
+from prometheus_client.core import GaugeMetricFamily
+
+from .scrape_intervals import scrape_intervals
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+@dataclass(frozen=True)
+class DeviceSnapshot:
+    """Every device metric sample of one WLED instance, as of one scrape"""
+
+    device_ip: str
+    published_at: float
+    # metric -> tuple of (label values, value)
+    samples: dict
+
+
+class DeviceSnapshotStore(object):
+    """Latest snapshot of each WLED instance. Records are replaced whole
+    when a device finishes its scrape, so readers never see half of one"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_SNAPSHOT_METRICS", "false")
+
+    @classmethod
+    def get_max_age_seconds(cls):
+        return EnvHelper.get_float(
+            "WLED_SNAPSHOT_MAX_AGE_SECONDS", 180, minimum=1
+        )
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._records = {}
+
+    def publish(self, device_ip, samples):
+        snapshot = DeviceSnapshot(
+            device_ip=device_ip,
+            published_at=self._clock(),
+            samples=samples,
+        )
+        # Copy on write, a collect iterating the old dict is unaffected
+        self._records = {**self._records, device_ip: snapshot}
+        return snapshot
+
+    def get(self, device_ip):
+        return self._records.get(device_ip)
+
+    def get_fresh_records(self):
+        """Snapshots of the devices that didn't miss a few of their
+        scrapes, kept at least WLED_SNAPSHOT_MAX_AGE_SECONDS"""
+        now = self._clock()
+        minimum = self.get_max_age_seconds()
+        return [
+            snapshot
+            for snapshot in self._records.values()
+            if now - snapshot.published_at
+            <= scrape_intervals.get_max_age(snapshot.device_ip, minimum)
+        ]
+
+    def remove(self, device_ip):
+        records = dict(self._records)
+        records.pop(device_ip, None)
+        self._records = records
+
+    def reset(self):
+        self._records = {}
+
+
+class DeviceSnapshotCollector(object):
+    """Renders the device metrics from the snapshot store at collect time"""
+
+    def __init__(self, store, metrics):
+        self._store = store
+        self._metrics = list(metrics)
+
+    def _new_family(self, metric):
+        return GaugeMetricFamily(
+            metric._name,
+            metric._documentation,
+            labels=metric._labelnames,
+        )
+
+    def describe(self):
+        return [self._new_family(metric) for metric in self._metrics]
+
+    def collect_samples(self):
+        """(metric, [(label values, value)]) of every metric with samples"""
+        records = self._store.get_fresh_records()
+        for metric in self._metrics:
+            samples = []
+            for snapshot in records:
+                samples.extend(snapshot.samples.get(metric, ()))
+            if samples:
+                yield metric, samples
+
+    def collect(self):
+        for metric, samples in self.collect_samples():
+            family = self._new_family(metric)
+            for label_values, value in samples:
+                family.add_metric(label_values, value)
+            yield family
+
+
+# Global device snapshot store instance
+device_snapshots = DeviceSnapshotStore()
@@ -41,3 +41,45 @@ class LogHelper(object):
         if is_debug:
             return cls.get_debug_logger(name)
         return cls.get_info_logger(name)
+
+
+class EnvHelper(object):
+    TRUTHY_VALUES = ("true", "1", "yes", "on")
+
+    @classmethod
+    def get_bool(cls, name, default="true"):
+        return os.environ.get(name, default).lower() in cls.TRUTHY_VALUES
+
+    @classmethod
+    def get_int(cls, name, default, minimum=None):
+        """Read an int env var, falling back to the default when invalid"""
+        try:
+            value = int(os.environ.get(name, default))
+        except ValueError:
+            logging.getLogger(__name__).error(
+                f"Invalid value for {name}, using default: {default}"
+            )
+            value = int(default)
+        if minimum is not None:
+            value = max(minimum, value)
+        return value
+
+    @classmethod
+    def get_float(cls, name, default, minimum=None):
+        """Read a float env var, falling back to the default when invalid"""
+        try:
+            value = float(os.environ.get(name, default))
+        except ValueError:
+            logging.getLogger(__name__).error(
+                f"Invalid value for {name}, using default: {default}"
+            )
+            value = float(default)
+        if minimum is not None:
+            value = max(minimum, value)
+        return value
+
+    @classmethod
+    def get_worker_count(cls):
+        """Server workers, from WORKERS or else WEB_CONCURRENCY"""
+        workers = cls.get_int("WEB_CONCURRENCY", 1, minimum=1)
+        return cls.get_int("WORKERS", workers, minimum=1)
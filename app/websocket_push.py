@@ -0,0 +1,152 @@
+import asyncio
+
+from .change_detection import PayloadSection
+from .metrics import Metrics
+from .utils import EnvHelper, LogHelper
+
+log = LogHelper.get_env_logger(__name__)
+
+
+class WebSocketPushManager(object):
+    """Keeps one WebSocket per WLED instance and scrapes every pushed state"""
+
+    @classmethod
+    def is_enabled(cls):
+        return EnvHelper.get_bool("ENABLE_WEBSOCKET_PUSH", "false")
+
+    @classmethod
+    def get_reconnect_min_seconds(cls):
+        """Delay before the first reconnect after a WebSocket was lost"""
+        return EnvHelper.get_float(
+            "WLED_PUSH_RECONNECT_MIN_SECONDS", 1, minimum=0
+        )
+
+    @classmethod
+    def get_reconnect_max_seconds(cls):
+        """Upper bound for the reconnect delay of an unreachable instance"""
+        return EnvHelper.get_float(
+            "WLED_PUSH_RECONNECT_MAX_SECONDS", 60, minimum=0
+        )
+
+    @classmethod
+    def get_manager(cls, scraper):
+        return cls(
+            scraper,
+            reconnect_min=cls.get_reconnect_min_seconds(),
+            reconnect_max=cls.get_reconnect_max_seconds(),
+        )
+
+    def __init__(
+        self, scraper, reconnect_min=1, reconnect_max=60, sleep=asyncio.sleep
+    ):
+        self._scraper = scraper
+        self._reconnect_min = float(reconnect_min)
+        self._reconnect_max = float(reconnect_max)
+        self._sleep = sleep
+        self._tasks = {}
+        self._devices = {}
+
+    @property
+    def devices(self):
+        return list(self._tasks.keys())
+
+    def is_connected(self, device_ip):
+        return device_ip in self._devices
+
+    def get_reconnect_delay(self, consecutive_failures):
+        """Exponential delay for the nth failed connection in a row"""
+        if consecutive_failures <= 0:
+            return 0
+        delay = self._reconnect_min * (2 ** (consecutive_failures - 1))
+        return min(delay, max(self._reconnect_max, self._reconnect_min))
+
+    def sync_devices(self, device_ips):
+        """Start listening to new instances and stop removed ones"""
+        wanted = set(device_ips)
+        for device_ip in list(self._tasks.keys()):
+            if device_ip not in wanted:
+                log.info(f"Push: no longer listening to {device_ip}")
+                self._tasks.pop(device_ip).cancel()
+                self._mark_disconnected(device_ip)
+        for device_ip in device_ips:
+            task = self._tasks.get(device_ip)
+            if task is None or task.done():
+                self._tasks[device_ip] = asyncio.create_task(
+                    self._listen_forever(device_ip),
+                    name=f"wled-push-{device_ip}",
+                )
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for device_ip in list(self._devices.keys()):
+            self._mark_disconnected(device_ip)
+
+    async def refresh_presets(self, device_ip):
+        """Poll the presets of a connected instance over HTTP"""
+        device = self._devices.get(device_ip)
+        if device is None:
+            return False
+        wled_client = self._scraper.wled_client
+        presets = await wled_client.get_wled_instance_presets(device_ip)
+        if presets:
+            device.update_from_dict({"presets": presets})
+        self._scraper.scrape_device_metrics(
+            device, sections=(PayloadSection.PRESETS,)
+        )
+        return True
+
+    async def _listen_forever(self, device_ip):
+        consecutive_failures = 0
+        while True:
+            try:
+                await self._scraper.wled_client.listen_wled_instance(
+                    device_ip,
+                    lambda device: self._on_device(device_ip, device),
+                )
+                log.info(f"Push: WebSocket to {device_ip} was closed")
+            except asyncio.CancelledError:
+                self._mark_disconnected(device_ip)
+                raise
+            except Exception as unexp:
+                log.warning(f"Push: WebSocket to {device_ip} lost: {unexp}")
+            if self.is_connected(device_ip):
+                # We had a working connection, start the backoff over
+                consecutive_failures = 0
+            self._mark_disconnected(device_ip)
+            consecutive_failures += 1
+            delay = self.get_reconnect_delay(consecutive_failures)
+            log.debug(f"Push: reconnecting to {device_ip} in {delay}s")
+            await self._sleep(delay)
+            Metrics.WLED_PUSH_RECONNECTS.labels(
+                ip=device_ip,
+            ).inc()
+
+    def _on_device(self, device_ip, device):
+        if device_ip not in self._devices:
+            log.info(f"Push: listening to {device_ip}")
+            Metrics.WLED_PUSH_CONNECTED.labels(
+                ip=device_ip,
+            ).set(1)
+        self._devices[device_ip] = device
+        Metrics.WLED_PUSH_MESSAGES.labels(
+            ip=device_ip,
+        ).inc()
+        try:
+            self._scraper.scrape_pushed_device(device_ip, device)
+        except Exception as unexp:
+            # A bad message must not tear down a healthy connection
+            log.error(f"Push: failed to scrape {device_ip}: {unexp}")
+
+    def _mark_disconnected(self, device_ip):
+        if self._devices.pop(device_ip, None) is None:
+            return
+        Metrics.WLED_PUSH_CONNECTED.labels(
+            ip=device_ip,
+        ).set(0)
+        Metrics.WLED_INSTANCE_ONLINE.labels(
+            ip=device_ip,
+        ).set(0)
@@ -1,34 +1,165 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
 
+import aiohttp
+import orjson
 from wled import WLED, WLEDReleases
 
+from .circuit_breaker import CircuitBreakerOpenException, circuit_breakers
 from .metrics import Metrics
-from .utils import LogHelper
+from .raw_scraper import RawDevice, RawJsonException
+from .scrape_tiers import TieredDeviceCache, tiered_devices
+from .utils import EnvHelper, LogHelper
 
 log = LogHelper.get_env_logger(__name__)
 
 
 class WLEDClient(object):
+    # Pooled session shared by every client, owned by the app lifespan
+    _shared_session = None
+    # WebSockets hold their connection, so they get a pool of their own
+    _push_session = None
+
+    @classmethod
+    def get_client(cls, session=None, push_session=None):
+        return cls(
+            session=session or cls._shared_session,
+            push_session=push_session or cls._push_session,
+        )
+
+    @classmethod
+    def get_http_connection_limit(cls):
+        """Max number of open connections across all WLED instances"""
+        return EnvHelper.get_int("WLED_HTTP_CONNECTION_LIMIT", 100, minimum=0)
+
+    @classmethod
+    def get_http_connection_limit_per_host(cls):
+        """Max number of open connections to a single WLED instance"""
+        return EnvHelper.get_int(
+            "WLED_HTTP_CONNECTION_LIMIT_PER_HOST", 2, minimum=0
+        )
+
+    @classmethod
+    def get_http_keepalive_seconds(cls):
+        """How long idle keep-alive connections stay in the pool"""
+        return EnvHelper.get_float(
+            "WLED_HTTP_KEEPALIVE_SECONDS", 30, minimum=0
+        )
+
+    @classmethod
+    def get_http_dns_cache_ttl_seconds(cls):
+        """How long resolved hostnames are cached by the pool"""
+        return EnvHelper.get_int(
+            "WLED_HTTP_DNS_CACHE_TTL_SECONDS", 300, minimum=0
+        )
+
+    @classmethod
+    def get_connect_timeout_seconds(cls):
+        """Max time to establish a connection to a WLED instance"""
+        return EnvHelper.get_float(
+            "WLED_CONNECT_TIMEOUT_SECONDS", 3, minimum=0.1
+        )
+
+    @classmethod
+    def get_read_timeout_seconds(cls):
+        """Max time between reads from a WLED instance"""
+        return EnvHelper.get_float("WLED_READ_TIMEOUT_SECONDS", 5, minimum=0.1)
+
+    @classmethod
+    def get_total_timeout_seconds(cls):
+        """Max time for a single request to a WLED instance"""
+        return EnvHelper.get_float(
+            "WLED_TOTAL_TIMEOUT_SECONDS", 8, minimum=0.1
+        )
+
+    @classmethod
+    def get_client_timeout(cls):
+        return aiohttp.ClientTimeout(
+            total=cls.get_total_timeout_seconds(),
+            connect=cls.get_connect_timeout_seconds(),
+            sock_read=cls.get_read_timeout_seconds(),
+        )
+
+    @classmethod
+    def create_session(cls, limit=None, limit_per_host=None):
+        """Build a pooled session, must be called with a running loop"""
+        if limit is None:
+            limit = cls.get_http_connection_limit()
+        if limit_per_host is None:
+            limit_per_host = cls.get_http_connection_limit_per_host()
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=cls.get_http_keepalive_seconds(),
+            ttl_dns_cache=cls.get_http_dns_cache_ttl_seconds(),
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=cls.get_client_timeout(),
+        )
+
+    @classmethod
+    def create_push_session(cls):
+        """Session for the WebSocket of each pushing instance. A WebSocket
+        keeps its connection until it closes, in the pooled session they
+        would take every slot the HTTP requests wait for"""
+        return cls.create_session(limit=0, limit_per_host=0)
+
+    @classmethod
+    def get_shared_session(cls):
+        return cls._shared_session
+
+    @classmethod
+    def set_shared_session(cls, session):
+        cls._shared_session = session
+
     @classmethod
-    def get_client(cls, session=None):
-        return cls(session=session)
+    def get_push_session(cls):
+        return cls._push_session
+
+    @classmethod
+    def set_push_session(cls, session):
+        cls._push_session = session
+
+    @classmethod
+    async def close_shared_session(cls):
+        sessions = (cls._shared_session, cls._push_session)
+        cls._shared_session = None
+        cls._push_session = None
+        for session in sessions:
+            if session and not session.closed:
+                await session.close()
 
     @classmethod
     def default_wled_ip(cls):
         return os.environ.get("DEFAULT_WLED_IP", "10.0.1.179")
 
-    def __init__(self, session=None):
+    def __init__(self, session=None, push_session=None):
         super().__init__()
         self._session = session
+        self._push_session = push_session
 
     @property
     def session(self):
         return self._session
 
-    def _connecting_device(self, ip_address):
-        if self.session:
-            return WLED(host=ip_address, session=self.session)
-        return WLED(host=ip_address)
+    @property
+    def push_session(self):
+        return self._push_session or self._session
+
+    def _connecting_device(self, ip_address, session=None):
+        # The session timeout covers connect and read, the wled library
+        # enforces the total per request on its own
+        request_timeout = self.get_total_timeout_seconds()
+        session = session or self.session
+        if session:
+            return WLED(
+                host=ip_address,
+                session=session,
+                request_timeout=request_timeout,
+            )
+        return WLED(host=ip_address, request_timeout=request_timeout)
 
     def _connecting_releases(self):
         if self.session:
@@ -36,6 +167,39 @@ class WLEDClient(object):
         return WLEDReleases()
 
     async def get_wled_instance_device(self, ip_address):
+        return await self._call_with_breaker(
+            ip_address, self._get_wled_instance_device
+        )
+
+    async def get_wled_instance_raw(self, ip_address):
+        """Fetch the plain JSON payloads of an instance as a RawDevice"""
+        return await self._call_with_breaker(
+            ip_address, self._get_wled_instance_raw
+        )
+
+    async def _call_with_breaker(self, ip_address, fetch):
+        breaker = circuit_breakers.get_breaker(ip_address)
+        if not breaker.allow_request():
+            # Fail fast instead of paying a full timeout for a dead host
+            Metrics.WLED_CLIENT_CIRCUIT_BREAKER_REJECTED.labels(
+                ip=ip_address,
+            ).inc()
+            raise CircuitBreakerOpenException(
+                f"Circuit open for {ip_address}, skipping connection"
+            )
+        try:
+            device = await fetch(ip_address)
+        except asyncio.CancelledError:
+            # Cancelled by the cycle deadline, not the device's fault
+            breaker.release_probe()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return device
+
+    async def _get_wled_instance_device(self, ip_address):
         log.debug(f"wled connecting to ip_address: {ip_address}")
         with Metrics.WLED_CLIENT_CONNECT_EXCEPTIONS.labels(
             ip=ip_address,
@@ -44,11 +208,82 @@ class WLEDClient(object):
                 ip=ip_address,
             ).time():
                 async with self._connecting_device(ip_address) as led:
-                    device = await led.update()
+                    if TieredDeviceCache.is_enabled():
+                        device = await tiered_devices.update(led, ip_address)
+                    else:
+                        device = await led.update()
                     log.debug(f"wled got device: {device}")
 
                     return device
 
+    async def listen_wled_instance(self, ip_address, callback):
+        """Hold a WebSocket open to an instance, calling back on each push
+
+        The first callback gets the full HTTP update, later ones only carry
+        what the device pushes (state and info). Returns or raises once the
+        connection is lost.
+        """
+        log.debug(f"wled listening to ip_address: {ip_address}")
+        async with self._connecting_device(
+            ip_address, session=self.push_session
+        ) as led:
+            device = await led.update()
+            await led.connect()
+            callback(device)
+            try:
+                await led.listen(callback)
+            finally:
+                await led.disconnect()
+
+    async def get_wled_instance_presets(self, ip_address):
+        """Fetch the raw presets of an instance, they are never pushed"""
+        log.debug(f"wled fetching presets from ip_address: {ip_address}")
+        async with self._connecting_device(ip_address) as led:
+            return await led.request("/presets.json")
+
+    @asynccontextmanager
+    async def _http_session(self):
+        if self.session:
+            yield self.session
+            return
+        async with aiohttp.ClientSession() as session:
+            yield session
+
+    @classmethod
+    async def _fetch_json(cls, session, url):
+        async with session.get(
+            url, timeout=cls.get_client_timeout()
+        ) as response:
+            response.raise_for_status()
+            body = await response.read()
+        if not body:
+            raise RawJsonException(f"Empty response from {url}")
+        return orjson.loads(body)
+
+    async def get_wled_instance_info(self, ip_address):
+        """Fetch only /json/info, enough to tell a WLED instance apart"""
+        async with self._http_session() as session:
+            return await self._fetch_json(
+                session, f"http://{ip_address}/json/info"
+            )
+
+    async def _get_wled_instance_raw(self, ip_address):
+        log.debug(f"wled fetching raw json from ip_address: {ip_address}")
+        with Metrics.WLED_CLIENT_CONNECT_EXCEPTIONS.labels(
+            ip=ip_address,
+        ).count_exceptions():
+            with Metrics.WLED_CLIENT_CONNECT_TIME.labels(
+                ip=ip_address,
+            ).time():
+                async with self._http_session() as session:
+                    data = await self._fetch_json(
+                        session, f"http://{ip_address}/json"
+                    )
+                    presets = await self._fetch_json(
+                        session, f"http://{ip_address}/presets.json"
+                    )
+                return RawDevice.from_payloads(data, presets)
+
     async def simple_wled_test(self):
         """Don't overcomplicate this one. Simple usage like the dep docs"""
         device_ip = self.default_wled_ip()
@@ -7,6 +7,8 @@ TIMEOUT=${TIMEOUT:-120}
 KEEPALIVE=${KEEPALIVE:-2}
 MAX_REQUESTS=${MAX_REQUESTS:-1000}
 MAX_REQUESTS_JITTER=${MAX_REQUESTS_JITTER:-50}
+# The app checks the worker count for the features that need one scraper
+export WORKERS
 
 echo "Starting Wargos with Gunicorn..."
 echo "Port: $PORT"
@@ -0,0 +1,56 @@
+"""Benchmark of the fast exposition writer
+
+Run with `python -m tests.benchmark_exposition`. Fills the global registry
+with 500 fake devices and compares generate_latest() to the writer, both
+rendering the same registry to the same bytes.
+"""
+
+import time
+
+from prometheus_client import (
+    GC_COLLECTOR,
+    PLATFORM_COLLECTOR,
+    PROCESS_COLLECTOR,
+    REGISTRY,
+    generate_latest,
+)
+
+from app.exposition import ExpositionWriter
+from app.extraction import MetricExtractor
+from tests.benchmark_metric_children import build_devices, scrape_pass
+
+DEVICE_COUNT = 500
+SEGMENT_COUNT = 4
+RENDERS = 10
+
+
+def time_renders(render, renders=RENDERS):
+    render()
+    start = time.perf_counter()
+    for _ in range(renders):
+        render()
+    return (time.perf_counter() - start) / renders
+
+
+def run_benchmark():
+    # Process stats change between renders and are not what is measured
+    for collector in (GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR):
+        REGISTRY.unregister(collector)
+    scrape_pass(MetricExtractor(), build_devices(DEVICE_COUNT, SEGMENT_COUNT))
+    writer = ExpositionWriter()
+    body = generate_latest(REGISTRY)
+    assert writer.render(REGISTRY) == body
+    baseline = time_renders(lambda: generate_latest(REGISTRY))
+    fast = time_renders(lambda: writer.render(REGISTRY))
+    return len(body), baseline, fast
+
+
+if __name__ == "__main__":
+    size, baseline, fast = run_benchmark()
+    print(
+        f"{DEVICE_COUNT} devices x {SEGMENT_COUNT} segments, "
+        f"{size / 1024:.0f} KiB per render:"
+    )
+    print(f"  generate_latest(): {baseline * 1000:.2f} ms")
+    print(f"  ExpositionWriter:  {fast * 1000:.2f} ms")
+    print(f"  speedup:           {baseline / fast:.2f}x")
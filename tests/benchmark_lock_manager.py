@@ -0,0 +1,71 @@
+"""Contention benchmark of the lock manager backends
+
+Run with `python -m tests.benchmark_lock_manager`. Forks PROCESSES
+workers that try to acquire and release the same lock in a loop, and
+reports the attempts per second of all workers together for each
+backend.
+"""
+
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from app.lock_manager import FlockLockManager, SQLiteLockManager
+
+PROCESSES = 8
+SECONDS = 2.0
+
+
+def hammer(create_locks, start, results):
+    locks = create_locks()
+    pid = os.getpid()
+    start.wait()
+    attempts = 0
+    acquired = 0
+    deadline = time.monotonic() + SECONDS
+    while time.monotonic() < deadline:
+        attempts += 1
+        if locks.try_acquire_lock("bench", pid, 60):
+            acquired += 1
+            locks.release_lock("bench", pid)
+    results.put((attempts, acquired))
+
+
+def run_backend(create_locks, processes=PROCESSES):
+    context = multiprocessing.get_context("fork")
+    start = context.Event()
+    results = context.Queue()
+    workers = [
+        context.Process(target=hammer, args=(create_locks, start, results))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    start.set()
+    totals = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    attempts = sum(total[0] for total in totals)
+    acquired = sum(total[1] for total in totals)
+    return attempts / SECONDS, acquired / SECONDS
+
+
+if __name__ == "__main__":
+    # Every acquire and release logs at info level
+    logging.getLogger("app.lock_manager").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "locks.db")
+        lock_dir = os.path.join(directory, "locks")
+        backends = {
+            "sqlite": lambda: SQLiteLockManager(db_path=db_path),
+            "flock": lambda: FlockLockManager(lock_dir),
+        }
+        print(f"{PROCESSES} processes, {SECONDS:.0f}s per backend:")
+        for name, create_locks in backends.items():
+            attempts, acquired = run_backend(create_locks)
+            print(
+                f"  {name:<7} {attempts:>10,.0f} acquire attempts/s, "
+                f"{acquired:>9,.0f} acquire+release/s"
+            )
@@ -0,0 +1,73 @@
+"""Micro-benchmark of the pre-bound metric children
+
+Run with `python -m tests.benchmark_metric_children`. Scrapes 100 fake
+devices with 10 segments each, once binding every child through
+`labels()` on each pass (as without the cache) and once through the
+children bound on the first pass.
+"""
+
+import copy
+import time
+
+from app.change_detection import PayloadSection
+from app.extraction import MetricExtractor
+from app.raw_scraper import RawDevice
+from tests.test_websocket_push import FAKE_JSON, FAKE_PRESETS
+
+DEVICE_COUNT = 100
+SEGMENT_COUNT = 10
+PASSES = 20
+
+
+def build_devices(device_count=DEVICE_COUNT, segment_count=SEGMENT_COUNT):
+    devices = []
+    for index in range(device_count):
+        data = copy.deepcopy(FAKE_JSON)
+        data["info"]["name"] = f"Bench {index}"
+        data["info"]["ip"] = f"10.1.{index // 256}.{index % 256}"
+        segment = data["state"]["seg"][0]
+        data["state"]["seg"] = [
+            dict(segment, id=segment_id) for segment_id in range(segment_count)
+        ]
+        devices.append(
+            RawDevice.from_payloads(data, copy.deepcopy(FAKE_PRESETS))
+        )
+    return devices
+
+
+def scrape_pass(extractor, devices):
+    for device in devices:
+        for section in PayloadSection:
+            extractor.extract_section(
+                section, device.info, device.state, device.presets
+            )
+
+
+def run_benchmark(passes=PASSES):
+    devices = build_devices()
+    extractor = MetricExtractor()
+    scrape_pass(extractor, devices)
+
+    start = time.perf_counter()
+    for _ in range(passes):
+        extractor.reset()
+        scrape_pass(extractor, devices)
+    unbound = (time.perf_counter() - start) / passes
+
+    scrape_pass(extractor, devices)
+    start = time.perf_counter()
+    for _ in range(passes):
+        scrape_pass(extractor, devices)
+    bound = (time.perf_counter() - start) / passes
+    return unbound, bound
+
+
+if __name__ == "__main__":
+    unbound, bound = run_benchmark()
+    print(
+        f"{DEVICE_COUNT} devices x {SEGMENT_COUNT} segments, "
+        f"per scrape pass:"
+    )
+    print(f"  labels() on every set: {unbound * 1000:.2f} ms")
+    print(f"  pre-bound children:    {bound * 1000:.2f} ms")
+    print(f"  speedup:               {unbound / bound:.2f}x")
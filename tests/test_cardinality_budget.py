@@ -0,0 +1,126 @@
+import os
+from unittest.mock import patch
+
+from app.extraction import BUDGETED_FAMILIES, MetricExtractor, MetricScope
+from app.metrics import Metrics
+from tests.test_extraction import build_raw_device, extract_all
+from tests.test_series_eviction import series_of
+
+PRESETS = {
+    "0": {},
+    "3": {"n": "Three"},
+    "1": {"n": "One"},
+    "2": {"n": "Two"},
+}
+
+
+def limited(family, ip="10.0.0.50"):
+    return Metrics.WLED_CARDINALITY_LIMITED.labels(
+        ip=ip, family=family
+    )._value.get()
+
+
+def active(family):
+    return Metrics.WLED_ACTIVE_SERIES.labels(family=family)._value.get()
+
+
+class TestSeriesBudgets:
+    """Tests for the per family series budget of each device"""
+
+    def test_budgets_default_to_unlimited(self):
+        """Test that no family is limited without the setting"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert MetricExtractor.get_series_budgets() == ()
+
+    def test_parse_budgets(self):
+        """Test invalid and fixed size families are ignored"""
+        env = {"WLED_SERIES_BUDGETS": "presets=30, info=5,segments=x"}
+        with patch.dict(os.environ, env):
+            assert MetricExtractor.get_series_budgets() == (("presets", 30),)
+        assert BUDGETED_FAMILIES == ("presets", "segment_colors", "segments")
+
+    def test_invalid_settings_logged_once(self):
+        """Test the settings are parsed once, not on every scrape"""
+        env = {
+            "WLED_SERIES_BUDGETS": "presets=once,info=5",
+            "WLED_DISABLED_METRIC_FAMILIES": "presets,once",
+        }
+        with patch.dict(os.environ, env), patch(
+            "app.extraction.log.error"
+        ) as error:
+            for _ in range(3):
+                MetricExtractor.get_extractor()
+        assert error.call_count == 3
+
+    def test_presets_over_budget_are_truncated(self):
+        """Test only the lowest preset ids fit, the count covers all"""
+        extractor = MetricExtractor(series_budgets=(("presets", 7),))
+        raw_device = build_raw_device("BudgetPresets")
+        raw_device.presets = dict(PRESETS)
+        before = limited("presets")
+
+        extract_all(extractor, raw_device)
+
+        preset_names = {
+            key[3]
+            for key in series_of(
+                Metrics.INSTANCE_PRESET_IS_ON_VALUE, "BudgetPresets"
+            )
+        }
+        # Three series per preset, two presets fit in seven
+        assert preset_names == {"One", "Two"}
+        assert limited("presets") == before + 3
+        count = Metrics.INSTANCE_PRESET_COUNT_VALUE.labels(
+            name="BudgetPresets", ip="10.0.0.50"
+        )
+        assert count._value.get() == 3
+
+    def test_colors_over_budget_are_truncated(self):
+        """Test color slots are cut across segments"""
+        extractor = MetricExtractor(series_budgets=(("segment_colors", 10),))
+        raw_device = build_raw_device("BudgetColors")
+        raw_device.state["seg"].append({"id": 1, "col": [[1, 2, 3]]})
+        before = limited("segment_colors")
+
+        extract_all(extractor, raw_device)
+
+        colors = series_of(
+            Metrics.INSTANCE_SEGMENT_COLOR_VALUE, "BudgetColors"
+        )
+        assert len(colors) == 10
+        assert limited("segment_colors") == before + 2
+
+    def test_segments_over_budget_are_truncated(self):
+        """Test whole segments are dropped, never part of one"""
+        extractor = MetricExtractor(series_budgets=(("segments", 20),))
+        raw_device = build_raw_device("BudgetSegments")
+        raw_device.state["seg"].append({"id": 1})
+
+        extract_all(extractor, raw_device)
+
+        speed = series_of(
+            Metrics.INSTANCE_SEGMENT_SPEED_VALUE, "BudgetSegments"
+        )
+        assert [key[2] for key in speed] == ["0"]
+
+    def test_active_series_follow_devices(self):
+        """Test the gauge counts the series of every exported device"""
+        extractor = MetricExtractor()
+
+        extract_all(extractor, build_raw_device("ActiveOne"))
+        extract_all(extractor, build_raw_device("ActiveOne"))
+        # Preset count plus three series for the single preset
+        assert active("presets") == 4
+        assert active("wifi") == 4
+
+        extractor.forget("10.0.0.50")
+        assert active("presets") == 0
+        assert active("wifi") == 0
+
+    def test_get_extractor_follows_budgets(self):
+        """Test a budget change compiles a new extractor"""
+        first = MetricExtractor.get_extractor()
+        with patch.dict(os.environ, {"WLED_SERIES_BUDGETS": "presets=30"}):
+            limited_extractor = MetricExtractor.get_extractor()
+        assert limited_extractor is not first
+        assert limited_extractor._item_limits == {MetricScope.PRESET: 10}
@@ -0,0 +1,169 @@
+import copy
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+from wled.models import Device
+
+from app.change_detection import (
+    PayloadSection,
+    SectionHashCache,
+    section_hashes,
+)
+from app.extraction import MetricExtractor
+from app.metrics import Metrics
+from app.scraper import Scraper
+from tests.test_websocket_push import FAKE_JSON, FAKE_PRESETS
+
+
+def make_device(**state):
+    data = copy.deepcopy(FAKE_JSON)
+    data["state"].update(state)
+    data["presets"] = copy.deepcopy(FAKE_PRESETS)
+    return Device.from_dict(data)
+
+
+def skipped(section):
+    return Metrics.WLED_SCRAPER_SECTIONS_SKIPPED.labels(
+        section=section.value
+    )._value.get()
+
+
+class TestSectionHashCache:
+    """Tests for the per-section payload hashes"""
+
+    def setup_method(self):
+        self.cache = SectionHashCache()
+
+    def test_is_enabled_default(self):
+        """Test change detection is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert SectionHashCache.is_enabled() is False
+
+    def test_digest_follows_content(self):
+        """Test equal payloads hash the same and changed ones don't"""
+        first = make_device().state
+        assert SectionHashCache.get_digest(first) == (
+            SectionHashCache.get_digest(make_device().state)
+        )
+        assert SectionHashCache.get_digest(first) != (
+            SectionHashCache.get_digest(make_device(bri=1).state)
+        )
+
+    def test_unchanged_only_after_remember(self):
+        """Test a section is only skipped once it was scraped"""
+        digest = SectionHashCache.get_digest("payload")
+        before = skipped(PayloadSection.INFO)
+        assert not self.cache.is_unchanged(
+            "10.0.0.1", PayloadSection.INFO, digest
+        )
+        self.cache.remember("10.0.0.1", PayloadSection.INFO, digest)
+        assert self.cache.is_unchanged("10.0.0.1", PayloadSection.INFO, digest)
+        assert not self.cache.is_unchanged(
+            "10.0.0.2", PayloadSection.INFO, digest
+        )
+        assert skipped(PayloadSection.INFO) == before + 1
+
+    def test_forget_device(self):
+        """Test that forgetting an instance scrapes it in full again"""
+        digest = SectionHashCache.get_digest("payload")
+        self.cache.remember("10.0.0.1", PayloadSection.STATE, digest)
+        self.cache.forget("10.0.0.1")
+        assert not self.cache.is_unchanged(
+            "10.0.0.1", PayloadSection.STATE, digest
+        )
+
+
+class TestScraperChangeDetection:
+    """Tests for skipping metric extraction of unchanged sections"""
+
+    def setup_method(self):
+        section_hashes.reset()
+        self.scraper = Scraper(MagicMock())
+        self.env = patch.dict(os.environ, {"ENABLE_CHANGE_DETECTION": "true"})
+        self.env.start()
+
+    def teardown_method(self):
+        self.env.stop()
+        section_hashes.reset()
+
+    def _scrape_with_spies(self, device, device_ip="10.0.0.1"):
+        extract_section = MetricExtractor.extract_section
+        with patch.object(
+            MetricExtractor,
+            "extract_section",
+            autospec=True,
+            side_effect=extract_section,
+        ) as spy:
+            self.scraper.scrape_device_metrics(device, device_ip=device_ip)
+        calls = {section: 0 for section in PayloadSection}
+        for call in spy.call_args_list:
+            calls[call.args[1]] += 1
+        return calls
+
+    def test_identical_payload_skips_everything(self):
+        """Test that an idle instance sets no gauges on the next scrape"""
+        before = skipped(PayloadSection.SEGMENTS)
+        first = self._scrape_with_spies(make_device())
+        second = self._scrape_with_spies(make_device())
+
+        assert set(first.values()) == {1}
+        assert set(second.values()) == {0}
+        assert skipped(PayloadSection.SEGMENTS) == before + 1
+
+    def test_changed_state_only_rescrapes_state(self):
+        """Test that only the section that changed is extracted"""
+        self._scrape_with_spies(make_device())
+        calls = self._scrape_with_spies(make_device(bri=10))
+
+        assert calls == {
+            PayloadSection.PRESETS: 0,
+            PayloadSection.INFO: 0,
+            PayloadSection.STATE: 1,
+            PayloadSection.SEGMENTS: 0,
+        }
+        brightness = Metrics.INSTANCE_STATE_BRIGHTNESS.labels(
+            ip="10.0.0.50", name="Fake"
+        )
+        assert brightness._value.get() == 10
+
+    def test_renamed_device_rescrapes_all_sections(self):
+        """Test that a name change re-sets every labelled gauge"""
+        self._scrape_with_spies(make_device())
+        device = make_device()
+        data = copy.deepcopy(FAKE_JSON)
+        data["info"]["name"] = "Renamed"
+        device.update_from_dict({"info": data["info"]})
+
+        calls = self._scrape_with_spies(device)
+
+        assert set(calls.values()) == {1}
+
+    def test_disabled_always_scrapes(self):
+        """Test that every section is extracted without change detection"""
+        with patch.dict(os.environ, {"ENABLE_CHANGE_DETECTION": "false"}):
+            self._scrape_with_spies(make_device())
+            calls = self._scrape_with_spies(make_device())
+        assert set(calls.values()) == {1}
+
+    def test_failed_extraction_is_not_remembered(self):
+        """Test that a section that failed is extracted again next time"""
+        extract_section = MetricExtractor.extract_section
+
+        def failing_segments(extractor, section, *args):
+            if section == PayloadSection.SEGMENTS:
+                raise ValueError("bad segment")
+            return extract_section(extractor, section, *args)
+
+        with patch.object(
+            MetricExtractor,
+            "extract_section",
+            autospec=True,
+            side_effect=failing_segments,
+        ):
+            with pytest.raises(ValueError):
+                self.scraper.scrape_device_metrics(
+                    make_device(), device_ip="10.0.0.1"
+                )
+        calls = self._scrape_with_spies(make_device())
+        assert calls[PayloadSection.SEGMENTS] == 1
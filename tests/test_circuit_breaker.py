@@ -0,0 +1,193 @@
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.circuit_breaker import (
+    CircuitBreaker,
+    CircuitBreakerOpenException,
+    CircuitBreakerRegistry,
+    CircuitState,
+    circuit_breakers,
+)
+from app.metrics import Metrics
+from app.scraper import Scraper
+from app.wled_client import WLEDClient
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TestCircuitBreaker:
+    """Tests for the per-device circuit breaker state machine"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            "10.0.0.1", failure_threshold=3, reset_timeout=60, clock=self.clock
+        )
+
+    def _state_gauge(self):
+        return Metrics.WLED_CLIENT_CIRCUIT_BREAKER_STATE.labels(
+            ip="10.0.0.1"
+        )._value.get()
+
+    def test_starts_closed(self):
+        """Test that a new breaker lets requests through"""
+        assert self.breaker.state == CircuitState.CLOSED
+        assert self.breaker.allow_request() is True
+        assert self._state_gauge() == 0
+
+    def test_opens_after_threshold(self):
+        """Test that consecutive failures open the circuit"""
+        for _ in range(2):
+            self.breaker.record_failure()
+        assert self.breaker.state == CircuitState.CLOSED
+        self.breaker.record_failure()
+        assert self.breaker.state == CircuitState.OPEN
+        assert self.breaker.allow_request() is False
+        assert self._state_gauge() == 1
+
+    def test_success_resets_failure_count(self):
+        """Test that a success in between keeps the circuit closed"""
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        assert self.breaker.state == CircuitState.CLOSED
+
+    def test_half_open_after_reset_timeout(self):
+        """Test that a single probe is allowed after the reset timeout"""
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.advance(60)
+        assert self.breaker.allow_request() is True
+        assert self.breaker.state == CircuitState.HALF_OPEN
+        assert self._state_gauge() == 2
+        # A second caller is rejected while the probe is in flight
+        assert self.breaker.allow_request() is False
+
+    def test_half_open_probe_success_closes(self):
+        """Test that a successful probe closes the circuit"""
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.advance(60)
+        self.breaker.allow_request()
+        self.breaker.record_success()
+        assert self.breaker.state == CircuitState.CLOSED
+        assert self.breaker.allow_request() is True
+
+    def test_half_open_probe_failure_reopens(self):
+        """Test that a failed probe opens the circuit again"""
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.advance(60)
+        self.breaker.allow_request()
+        self.breaker.record_failure()
+        assert self.breaker.state == CircuitState.OPEN
+        self.clock.advance(59)
+        assert self.breaker.allow_request() is False
+
+    def test_release_probe_allows_new_probe(self):
+        """Test that a cancelled probe doesn't leave the circuit stuck"""
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.advance(60)
+        assert self.breaker.allow_request() is True
+        self.breaker.release_probe()
+        assert self.breaker.allow_request() is True
+
+    def test_disabled_with_zero_threshold(self):
+        """Test that a threshold of 0 never opens the circuit"""
+        breaker = CircuitBreaker(
+            "10.0.0.1", failure_threshold=0, reset_timeout=60, clock=self.clock
+        )
+        for _ in range(10):
+            breaker.record_failure()
+        assert breaker.state == CircuitState.CLOSED
+        assert breaker.allow_request() is True
+
+
+class TestCircuitBreakerRegistry:
+    """Tests for the process wide breaker registry"""
+
+    def test_settings_defaults(self):
+        """Test the default breaker settings"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert CircuitBreakerRegistry.get_failure_threshold() == 5
+            assert CircuitBreakerRegistry.get_reset_timeout_seconds() == 300
+
+    def test_settings_from_env(self):
+        """Test breaker settings from the environment"""
+        env = {
+            "WLED_CIRCUIT_BREAKER_FAILURE_THRESHOLD": "2",
+            "WLED_CIRCUIT_BREAKER_RESET_SECONDS": "30",
+        }
+        with patch.dict(os.environ, env):
+            breaker = CircuitBreakerRegistry().get_breaker("10.0.0.5")
+        assert breaker.failure_threshold == 2
+        assert breaker.reset_timeout == 30
+
+    def test_get_breaker_is_per_device(self):
+        """Test that each device gets its own breaker"""
+        registry = CircuitBreakerRegistry()
+        assert registry.get_breaker("a") is registry.get_breaker("a")
+        assert registry.get_breaker("a") is not registry.get_breaker("b")
+
+
+class TestWLEDClientCircuitBreaker:
+    """Tests for the breaker around WLED device connections"""
+
+    def setup_method(self):
+        circuit_breakers.reset()
+
+    def teardown_method(self):
+        circuit_breakers.reset()
+
+    @pytest.mark.asyncio
+    @patch("app.wled_client.WLED")
+    async def test_open_circuit_fails_fast(self, mock_wled_class):
+        """Test that an open circuit skips the network entirely"""
+        mock_wled_instance = AsyncMock()
+        mock_wled_instance.__aenter__.side_effect = ConnectionError("dead")
+        mock_wled_class.return_value = mock_wled_instance
+
+        client = WLEDClient()
+        with patch.dict(
+            os.environ, {"WLED_CIRCUIT_BREAKER_FAILURE_THRESHOLD": "2"}
+        ):
+            for _ in range(2):
+                with pytest.raises(ConnectionError):
+                    await client.get_wled_instance_device("10.9.9.9")
+
+        with pytest.raises(CircuitBreakerOpenException):
+            await client.get_wled_instance_device("10.9.9.9")
+        assert mock_wled_class.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_scrape_with_open_circuit_reports_offline(self):
+        """Test that a skipped device is still reported offline"""
+        mock_client = MagicMock()
+        mock_client.get_wled_instance_device = AsyncMock(
+            side_effect=CircuitBreakerOpenException("open")
+        )
+        scraper = Scraper(mock_client)
+        events = Metrics.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER.labels(
+            ip="10.9.9.8", scrape_event="circuit_open"
+        )
+        before = events._value.get()
+
+        with pytest.raises(CircuitBreakerOpenException):
+            await scraper.scrape_instance("10.9.9.8")
+
+        online = Metrics.WLED_INSTANCE_ONLINE.labels(ip="10.9.9.8")
+        assert online._value.get() == 0
+        assert events._value.get() == before + 1
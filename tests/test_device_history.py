@@ -0,0 +1,240 @@
+import copy
+import os
+import tempfile
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from wled.models import Device
+
+from app.device_history import DeviceHistory, DeviceHistoryStore
+from app.main import app
+from app.raw_scraper import RawDevice
+from app.scraper import Scraper
+from tests.test_snapshot import FakeClock
+from tests.test_websocket_push import FAKE_JSON, FAKE_PRESETS
+
+
+class TestDeviceHistory:
+    """Tests for the per device ring buffer"""
+
+    def test_memory_is_bounded(self):
+        """Test the columns are allocated once and never grow"""
+        history = DeviceHistory(capacity=10)
+        allocated = history.memory_bytes
+        assert allocated == 10 * 8 * 5
+        for second in range(100):
+            history.append(second, {"rssi": -50})
+        assert history.memory_bytes == allocated
+        assert len(history) == 10
+
+    def test_wraps_oldest_first(self):
+        """Test a full buffer keeps the latest rows, oldest first"""
+        history = DeviceHistory(capacity=3)
+        for second in range(5):
+            history.append(second, {"fps": second * 10})
+        result = history.query(["fps"])
+        assert result["timestamps"] == [2, 3, 4]
+        assert result["fields"] == {"fps": [20, 30, 40]}
+
+    def test_missing_values(self):
+        """Test fields a device didn't report come back as None"""
+        history = DeviceHistory(capacity=3)
+        history.append(1, {"rssi": -60, "power": None})
+        result = history.query(["rssi", "power"])
+        assert result["fields"] == {"rssi": [-60], "power": [None]}
+
+    def test_since(self):
+        """Test only rows at or after since are returned"""
+        history = DeviceHistory(capacity=10)
+        for second in range(6):
+            history.append(second, {"fps": second})
+        assert history.query(["fps"], since=4)["timestamps"] == [4, 5]
+
+    def test_downsampling(self):
+        """Test rows are averaged into at most max_points buckets"""
+        history = DeviceHistory(capacity=10)
+        for second in range(10):
+            history.append(second, {"fps": second})
+        result = history.query(["fps"], max_points=3)
+        assert result["timestamps"] == [0, 4, 8]
+        assert result["fields"]["fps"] == [1.5, 5.5, 8.5]
+
+
+class TestDeviceHistoryStore:
+    """Tests for recording scraped devices"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.store = DeviceHistoryStore(clock=self.clock)
+
+    def test_is_enabled_default(self):
+        """Test the history is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert DeviceHistoryStore.is_enabled() is False
+
+    def test_model_and_raw_values_match(self):
+        """Test both scrape paths record the same values"""
+        device = Device.from_dict(copy.deepcopy(FAKE_JSON))
+        raw_device = RawDevice.from_payloads(copy.deepcopy(FAKE_JSON))
+        values = DeviceHistoryStore.get_values(device)
+        assert values == DeviceHistoryStore.get_values(raw_device)
+        assert values == {
+            "rssi": -60,
+            "fps": 40,
+            "power": 120,
+            "free_heap": 100000,
+        }
+
+    def test_memory_metric(self):
+        """Test the metric reports the buffers of every device"""
+        with patch.dict(os.environ, {"WLED_HISTORY_SAMPLES": "4"}):
+            self.store.record("10.0.0.1", {})
+            self.store.record("10.0.0.2", {})
+        memory = REGISTRY.get_sample_value(
+            "wargos_device_history_memory_bytes"
+        )
+        assert memory == 2 * 4 * 8 * 5
+        self.store.remove("10.0.0.2")
+        assert REGISTRY.get_sample_value(
+            "wargos_device_history_memory_bytes"
+        ) == (4 * 8 * 5)
+        self.store.reset()
+
+    @pytest.mark.asyncio
+    async def test_scrape_records_row(self):
+        """Test each successful scrape appends one row"""
+        wled_client = MagicMock()
+        wled_client.get_wled_instance_device = AsyncMock(
+            return_value=Device.from_dict(
+                copy.deepcopy(FAKE_JSON) | {"presets": FAKE_PRESETS}
+            )
+        )
+        environ = {"ENABLE_DEVICE_HISTORY": "true"}
+        with patch.dict(os.environ, environ), patch(
+            "app.scraper.device_histories", self.store
+        ):
+            scraper = Scraper(wled_client)
+            await scraper.scrape_instance("wled-desk.local")
+            self.clock.now += 60
+            await scraper.scrape_instance("wled-desk.local")
+        history = self.store.get("10.0.0.50")
+        assert history.query(["rssi"])["fields"]["rssi"] == [-60, -60]
+        self.store.reset()
+
+    def test_pushed_device_sampled_at_scrape_rate(self):
+        """Test pushes add at most one row per scrape interval"""
+        device = Device.from_dict(
+            copy.deepcopy(FAKE_JSON) | {"presets": FAKE_PRESETS}
+        )
+        environ = {"ENABLE_DEVICE_HISTORY": "true"}
+        scraper = Scraper(MagicMock())
+        with patch.dict(os.environ, environ), patch(
+            "app.scraper.device_histories", self.store
+        ), patch.object(
+            Scraper, "get_default_scrape_interval", return_value=60
+        ):
+            scraper.scrape_pushed_device("wled-desk.local", device)
+            self.clock.now += 30
+            scraper.scrape_pushed_device("wled-desk.local", device)
+            self.clock.now += 30
+            scraper.scrape_pushed_device("wled-desk.local", device)
+        history = self.store.get("10.0.0.50")
+        assert history.query(["fps"])["fields"]["fps"] == [40, 40]
+        self.store.reset()
+
+    @pytest.mark.asyncio
+    async def test_kept_through_series_eviction(self):
+        """Test an offline device keeps its history for the incident"""
+        self.store.record("10.0.0.50", {"rssi": -60})
+        extractor = MagicMock()
+        extractor.evict_stale_devices.return_value = ["10.0.0.50"]
+        environ = {"ENABLE_STALE_SERIES_EVICTION": "true"}
+        with patch.dict(os.environ, environ), patch(
+            "app.scraper.device_histories", self.store
+        ), patch.object(
+            Scraper, "get_wled_ip_list", return_value=["10.0.0.50"]
+        ), patch.object(
+            Scraper, "_scrape_instances_bounded", AsyncMock()
+        ), patch(
+            "app.scraper.MetricExtractor.get_extractor",
+            return_value=extractor,
+        ):
+            await Scraper(MagicMock()).scrape_all_instances()
+        assert len(self.store.get("10.0.0.50")) == 1
+        self.store.reset()
+
+
+class TestHistoryEndpoint:
+    """Tests for /devices/{ip}/history"""
+
+    def setup_method(self):
+        self.store = DeviceHistoryStore(clock=FakeClock())
+        for value in range(10):
+            self.store.record("10.0.0.1", {"fps": value, "rssi": -value})
+        self.client = TestClient(app)
+
+    def get(self, path):
+        with patch("app.main.device_histories", self.store):
+            return self.client.get(path)
+
+    def test_history(self):
+        """Test the selected fields are returned, downsampled"""
+        response = self.get(
+            "/devices/10.0.0.1/history?fields=fps&max_points=5"
+        )
+        body = response.json()
+        assert response.status_code == 200
+        assert body["samples"] == 10
+        assert list(body["fields"]) == ["fps"]
+        assert body["fields"]["fps"] == [0.5, 2.5, 4.5, 6.5, 8.5]
+
+    def test_unknown_field(self):
+        """Test unknown fields are rejected"""
+        response = self.get("/devices/10.0.0.1/history?fields=fps,voltage")
+        assert response.status_code == 400
+        assert response.json()["unknown_fields"] == ["voltage"]
+
+    def test_unknown_device(self):
+        """Test devices without history are not found"""
+        assert self.get("/devices/10.9.9.9/history").status_code == 404
+
+
+class TestSharedDeviceHistory:
+    """Tests for serving the history another worker recorded"""
+
+    def setup_method(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.environ = {
+            "ENABLE_DEVICE_HISTORY": "true",
+            "ENABLE_SHARED_METRICS": "true",
+            "SHARED_METRICS_PATH": os.path.join(self.temp_dir, "shared.prom"),
+        }
+        self.scraping = DeviceHistoryStore(clock=FakeClock())
+        self.serving = DeviceHistoryStore()
+
+    def test_published_history_is_loaded(self):
+        """Test a worker loads the rows the scraping one published"""
+        with patch.dict(os.environ, self.environ):
+            self.scraping.record("10.0.0.1", {"fps": 30})
+            self.scraping.record("10.0.0.1", {"rssi": -60})
+            self.scraping.publish()
+            assert self.scraping.refresh() is False
+            assert self.serving.refresh() is True
+            assert self.serving.refresh() is False
+        expected = self.scraping.get("10.0.0.1").query()
+        assert self.serving.get("10.0.0.1").query() == expected
+        assert self.serving.get("10.0.0.1").last_timestamp is not None
+
+    def test_endpoint_in_other_worker(self):
+        """Test a worker that never scraped serves the published history"""
+        with patch.dict(os.environ, self.environ):
+            self.scraping.record("10.0.0.1", {"fps": 30})
+            self.scraping.publish()
+            with patch("app.main.device_histories", self.serving), patch(
+                "app.scraper.device_histories", self.serving
+            ):
+                response = TestClient(app).get("/devices/10.0.0.1/history")
+        assert response.status_code == 200
+        assert response.json()["fields"]["fps"] == [30]
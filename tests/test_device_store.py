@@ -0,0 +1,260 @@
+import copy
+import os
+import tempfile
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from wled.models import Device
+
+from app.change_detection import PayloadSection
+from app.device_store import (
+    DeviceStateStore,
+    http_date,
+    is_not_modified,
+)
+from app.main import app
+from app.scraper import Scraper
+from tests.test_snapshot import FakeClock
+from tests.test_websocket_push import FAKE_JSON, FAKE_PRESETS
+
+INFO = {"ip": "10.0.0.1", "name": "Desk", "ver": "0.15.0"}
+STATE = {"on": True, "bri": 128, "seg": [{"id": 0}]}
+
+
+class TestDeviceStateStore:
+    """Tests for keeping the last scraped state of each device"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.store = DeviceStateStore(clock=self.clock)
+
+    def test_is_enabled_default(self):
+        """Test the store is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert DeviceStateStore.is_enabled() is False
+
+    def test_unchanged_scrape_keeps_version(self):
+        """Test an identical scrape keeps the record, ETag and date"""
+        first = self.store.update("10.0.0.1", INFO, STATE, {})
+        self.clock.now += 60
+        second = self.store.update("10.0.0.1", dict(INFO), dict(STATE), {})
+        assert second is first
+        self.clock.now += 60
+        third = self.store.update("10.0.0.1", INFO, dict(STATE, bri=10), {})
+        assert third.etag != first.etag
+        assert third.modified_at == first.modified_at + 120
+
+    def test_partial_update_keeps_other_parts(self):
+        """Test a presets only scrape keeps the info and state"""
+        self.store.update("10.0.0.1", INFO, STATE, {})
+        record = self.store.update("10.0.0.1", presets={1: {"n": "Red"}})
+        assert record.info == INFO and record.state == STATE
+        body = orjson.loads(record.body)
+        assert body["presets"] == {"1": {"n": "Red"}}
+        assert body["state"]["bri"] == 128
+
+    def test_model_segments_become_a_list(self):
+        """Test device model segments keyed by id are listed"""
+        record = self.store.update(
+            "10.0.0.1", INFO, {"seg": {0: {"id": 0}, 1: {"id": 1}}}, {}
+        )
+        assert record.state["seg"] == [{"id": 0}, {"id": 1}]
+
+    def test_listing(self):
+        """Test the summary is sorted and cached until a change"""
+        self.store.update("10.0.0.2", dict(INFO, ip="10.0.0.2"), STATE, {})
+        self.store.update("10.0.0.1", INFO, STATE, {})
+        body, etag, modified_at = self.store.get_listing()
+        devices = orjson.loads(body)["devices"]
+        assert [device["ip"] for device in devices] == [
+            "10.0.0.1",
+            "10.0.0.2",
+        ]
+        assert devices[0]["name"] == "Desk"
+        assert self.store.get_listing()[1] == etag
+        self.store.remove("10.0.0.2")
+        assert self.store.get_listing()[1] != etag
+
+
+class TestConditionalRequests:
+    """Tests for matching If-None-Match and If-Modified-Since"""
+
+    def test_etags(self):
+        """Test strong, weak, listed and wildcard ETags"""
+        assert is_not_modified({"if-none-match": '"a"'}, '"a"', 0)
+        assert is_not_modified({"if-none-match": 'W/"a"'}, '"a"', 0)
+        assert is_not_modified({"if-none-match": '"b", "a"'}, '"a"', 0)
+        assert is_not_modified({"if-none-match": "*"}, '"a"', 0)
+        assert not is_not_modified({"if-none-match": '"b"'}, '"a"', 0)
+
+    def test_modified_since(self):
+        """Test dates are compared in whole seconds"""
+        modified_at = 1700000000.5
+        headers = {"if-modified-since": http_date(1700000000)}
+        assert is_not_modified(headers, '"a"', modified_at)
+        assert not is_not_modified(headers, '"a"', modified_at + 1)
+        assert not is_not_modified({"if-modified-since": "x"}, '"a"', 1)
+
+    def test_etag_takes_precedence(self):
+        """Test If-Modified-Since is ignored next to If-None-Match"""
+        headers = {
+            "if-none-match": '"b"',
+            "if-modified-since": http_date(1800000000),
+        }
+        assert not is_not_modified(headers, '"a"', 1700000000)
+
+
+class TestDeviceStateScrape:
+    """Tests for the scraper filling the store"""
+
+    def test_scrape_fills_store(self):
+        """Test scraping a device model stores its payloads"""
+        store = DeviceStateStore()
+        data = copy.deepcopy(FAKE_JSON)
+        data["info"]["ip"] = "10.0.0.91"
+        device = Device.from_dict(data | {"presets": FAKE_PRESETS})
+        environ = {"ENABLE_DEVICE_STATE_STORE": "true"}
+        with patch.dict(os.environ, environ), patch(
+            "app.scraper.device_states", store
+        ):
+            Scraper(MagicMock()).scrape_device_metrics(device)
+            Scraper(MagicMock()).scrape_device_metrics(
+                device, sections=(PayloadSection.PRESETS,)
+            )
+        record = store.get("10.0.0.91")
+        assert record.info["name"] == "Fake"
+        assert record.state["bri"] == 128
+        assert isinstance(record.state["seg"], list)
+        assert record.presets
+
+    def test_disabled_store_stays_empty(self):
+        """Test nothing is kept while the store is off"""
+        store = DeviceStateStore()
+        device = Device.from_dict(copy.deepcopy(FAKE_JSON))
+        with patch.dict(os.environ, {}, clear=True), patch(
+            "app.scraper.device_states", store
+        ):
+            Scraper(MagicMock()).scrape_device_metrics(device)
+        assert store.get(device.info.ip) is None
+        assert orjson.loads(store.get_listing()[0]) == {"devices": []}
+
+    @pytest.mark.asyncio
+    async def test_kept_through_series_eviction(self):
+        """Test an offline device keeps serving its last known state"""
+        store = DeviceStateStore()
+        record = store.update("10.0.0.91", info={"name": "Fake"})
+        extractor = MagicMock()
+        extractor.evict_stale_devices.return_value = ["10.0.0.91"]
+        environ = {"ENABLE_STALE_SERIES_EVICTION": "true"}
+        with patch.dict(os.environ, environ), patch(
+            "app.scraper.device_states", store
+        ), patch.object(
+            Scraper, "get_wled_ip_list", return_value=["10.0.0.91"]
+        ), patch.object(
+            Scraper, "_scrape_instances_bounded", AsyncMock()
+        ), patch(
+            "app.scraper.MetricExtractor.get_extractor",
+            return_value=extractor,
+        ):
+            await Scraper(MagicMock()).scrape_all_instances()
+        extractor.evict_stale_devices.assert_called_once()
+        assert store.get("10.0.0.91") is record
+
+    def test_forgotten_when_removed(self):
+        """Test a device leaving the scrape set loses its state"""
+        store = DeviceStateStore()
+        store.update("10.0.0.91", info={"name": "Fake"})
+        with patch("app.scraper.device_states", store):
+            Scraper.forget_devices(("10.0.0.91",))
+        assert store.get("10.0.0.91") is None
+
+
+class TestDeviceEndpoints:
+    """Tests for /devices and /devices/{ip}"""
+
+    def setup_method(self):
+        self.store = DeviceStateStore()
+        self.store.update("10.0.0.1", INFO, STATE, {})
+        self.client = TestClient(app)
+
+    def get(self, path, **headers):
+        with patch("app.main.device_states", self.store):
+            return self.client.get(path, headers=headers)
+
+    def test_device(self):
+        """Test a device is served with validators"""
+        response = self.get("/devices/10.0.0.1")
+        assert response.status_code == 200
+        assert response.json()["state"]["bri"] == 128
+        assert response.headers["etag"] == self.store.get("10.0.0.1").etag
+        assert "last-modified" in response.headers
+
+    def test_device_not_modified(self):
+        """Test clients with the current version get a 304"""
+        etag = self.store.get("10.0.0.1").etag
+        response = self.get("/devices/10.0.0.1", **{"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        last_modified = self.get("/devices/10.0.0.1").headers["last-modified"]
+        response = self.get(
+            "/devices/10.0.0.1", **{"If-Modified-Since": last_modified}
+        )
+        assert response.status_code == 304
+
+    def test_unknown_device(self):
+        """Test devices never scraped are not found"""
+        response = self.get("/devices/10.9.9.9")
+        assert response.status_code == 404
+        assert response.json()["status"] == "not_found"
+
+    def test_listing(self):
+        """Test the listing and its ETag"""
+        response = self.get("/devices")
+        assert response.json()["devices"][0]["ip"] == "10.0.0.1"
+        etag = response.headers["etag"]
+        assert self.get("/devices", **{"If-None-Match": etag}).status_code == (
+            304
+        )
+
+
+class TestSharedDeviceStates:
+    """Tests for serving the states another worker scraped"""
+
+    def setup_method(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.environ = {
+            "ENABLE_DEVICE_STATE_STORE": "true",
+            "ENABLE_SHARED_METRICS": "true",
+            "SHARED_METRICS_PATH": os.path.join(self.temp_dir, "shared.prom"),
+        }
+        self.scraping = DeviceStateStore()
+        self.serving = DeviceStateStore()
+
+    def test_published_states_are_loaded(self):
+        """Test a worker loads the records the scraping one published"""
+        with patch.dict(os.environ, self.environ):
+            record = self.scraping.update(
+                "10.0.0.1", INFO, STATE, {1: {"n": "Preset 1"}}
+            )
+            self.scraping.publish()
+            assert self.scraping.refresh() is False
+            assert self.serving.refresh() is True
+            assert self.serving.refresh() is False
+        loaded = self.serving.get("10.0.0.1")
+        assert loaded.etag == record.etag
+        assert loaded.modified_at == record.modified_at
+        assert loaded.presets == {"1": {"n": "Preset 1"}}
+
+    def test_endpoint_in_other_worker(self):
+        """Test a worker that never scraped serves the published state"""
+        with patch.dict(os.environ, self.environ):
+            self.scraping.update("10.0.0.1", INFO, STATE, {})
+            self.scraping.publish()
+            with patch("app.main.device_states", self.serving), patch(
+                "app.scraper.device_states", self.serving
+            ):
+                response = TestClient(app).get("/devices/10.0.0.1")
+        assert response.status_code == 200
+        assert response.json()["info"]["name"] == INFO["name"]
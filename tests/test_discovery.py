@@ -0,0 +1,219 @@
+import asyncio
+import ipaddress
+import os
+import socket
+from contextlib import asynccontextmanager
+from unittest.mock import MagicMock, patch
+
+import pytest
+from aiohttp import web
+from prometheus_client import REGISTRY
+
+from app.device_store import DeviceStateStore
+from app.discovery import SubnetDiscovery, parse_cidrs
+from app.inventory import InventoryChange
+from app.scraper import Scraper
+from tests.test_snapshot import FakeClock
+from tests.test_websocket_push import FAKE_JSON
+
+WLED_HOSTS = ["127.0.0.2", "127.0.0.3", "127.0.0.4", "127.0.0.5"]
+OTHER_HOST = "127.0.0.6"
+FARM_RANGE = ipaddress.ip_network("127.0.0.0/29")
+
+
+def get_free_port(host):
+    with socket.socket() as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+
+@asynccontextmanager
+async def fake_farm():
+    """WLED instances and one other HTTP server, on one port of several
+    loopback addresses like a subnet"""
+
+    async def handle_wled_info(request):
+        return web.json_response(FAKE_JSON["info"])
+
+    async def handle_other_info(request):
+        return web.json_response({"hello": "world"})
+
+    port = get_free_port(WLED_HOSTS[0])
+    runners = {}
+    for host in WLED_HOSTS + [OTHER_HOST]:
+        app = web.Application()
+        handler = handle_other_info
+        if host in WLED_HOSTS:
+            handler = handle_wled_info
+        app.router.add_get("/json/info", handler)
+        runner = runners[host] = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+    try:
+        yield port, runners
+    finally:
+        for runner in runners.values():
+            await runner.cleanup()
+
+
+def get_probes(result):
+    return (
+        REGISTRY.get_sample_value(
+            "wargos_discovery_probes_total", {"result": result}
+        )
+        or 0
+    )
+
+
+def get_range_hit_ratio():
+    return REGISTRY.get_sample_value("wargos_discovery_range_hit_ratio")
+
+
+class TestSubnetDiscovery:
+    """Tests for sweeping a range of fake WLED servers"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+
+    def get_discovery(self, port, **kwargs):
+        return SubnetDiscovery(
+            [FARM_RANGE],
+            port=port,
+            device_interval=60,
+            empty_interval=3600,
+            clock=self.clock,
+            **kwargs,
+        )
+
+    def test_is_enabled_default(self):
+        """Test discovery is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert SubnetDiscovery.is_enabled() is False
+
+    def test_needs_leader_with_workers(self):
+        """Test several workers without leader election refuse to sweep"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert SubnetDiscovery.can_run_in_workers(None) is True
+        with patch.dict(os.environ, {"WEB_CONCURRENCY": "4"}, clear=True):
+            assert SubnetDiscovery.can_run_in_workers(None) is False
+        with patch.dict(os.environ, {"WORKERS": "2"}, clear=True):
+            assert SubnetDiscovery.can_run_in_workers(None) is False
+            assert SubnetDiscovery.can_run_in_workers(MagicMock()) is True
+
+    def test_parse_cidrs(self):
+        """Test invalid ranges are skipped, too large ones refused"""
+        networks = parse_cidrs("10.0.1.0/30, nope,10.0.0.0/8")
+        assert [str(network) for network in networks] == [
+            "10.0.1.0/30",
+            "10.0.0.0/8",
+        ]
+        discovery = SubnetDiscovery(networks)
+        assert discovery.pop_due() == ["10.0.1.1", "10.0.1.2"]
+
+    @pytest.mark.asyncio
+    async def test_sweep_fingerprints_wled(self):
+        """Test only the servers answering like WLED are found"""
+        closed = get_probes("closed")
+        opened = get_probes("open")
+        async with fake_farm() as (port, _):
+            discovery = self.get_discovery(port)
+            change = await discovery.sweep()
+        assert change == InventoryChange(added=tuple(WLED_HOSTS))
+        assert discovery.devices == WLED_HOSTS
+        # 127.0.0.1 has nothing listening, 127.0.0.6 isn't WLED
+        assert get_probes("closed") == closed + 1
+        assert get_probes("open") == opened + 1
+        assert get_range_hit_ratio() == 4 / 6
+        assert REGISTRY.get_sample_value("wargos_discovery_devices") == 4
+
+    @pytest.mark.asyncio
+    async def test_incremental_rescan(self):
+        """Test known devices are rescanned often, empty addresses rarely"""
+        async with fake_farm() as (port, _):
+            discovery = self.get_discovery(port)
+            await discovery.sweep()
+            assert discovery.pop_due() == []
+            self.clock.now += 60
+            assert discovery.pop_due() == WLED_HOSTS
+            assert await discovery.sweep() == InventoryChange()
+            # Only found devices were probed, the ranges are still 4 of 6
+            assert get_range_hit_ratio() == 4 / 6
+            self.clock.now += 3600
+            assert len(discovery.pop_due()) == 6
+
+    @pytest.mark.asyncio
+    async def test_gone_device_is_removed(self):
+        """Test a device is dropped after missing a few sweeps"""
+        async with fake_farm() as (port, runners):
+            discovery = self.get_discovery(port)
+            await discovery.sweep()
+            await runners.pop(WLED_HOSTS[0]).cleanup()
+            changes = []
+            for _ in range(SubnetDiscovery.MAX_MISSES):
+                self.clock.now += 60
+                changes.append(await discovery.sweep())
+        assert changes[-1] == InventoryChange(removed=(WLED_HOSTS[0],))
+        assert not any(changes[:-1])
+        assert discovery.devices == WLED_HOSTS[1:]
+        assert get_range_hit_ratio() == 3 / 6
+        assert discovery.get_entry(WLED_HOSTS[0]).next_due == (
+            self.clock.now + 3600
+        )
+
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency(self):
+        """Test no more than max_concurrency probes run at once"""
+        discovery = SubnetDiscovery(
+            [ipaddress.ip_network("10.0.1.0/28")], max_concurrency=3
+        )
+        in_flight = 0
+        peak = 0
+
+        async def probe(device_ip):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return "closed"
+
+        with patch.object(discovery, "probe", probe):
+            await discovery.sweep()
+        assert peak == 3
+
+
+class TestScraperDiscovery:
+    """Tests for merging discovered devices into the scrape set"""
+
+    def setup_method(self):
+        self.discovery = SubnetDiscovery([ipaddress.ip_network("10.0.1.0/29")])
+        for device_ip in ("10.0.1.1", "10.0.1.2"):
+            self.discovery._record(device_ip, True)
+        self.environ = {"ENABLE_DISCOVERY": "true", "WLED_IP_LIST": "10.0.1.2"}
+
+    def test_merged_after_configured(self):
+        """Test discovered devices follow the configured ones, once"""
+        with patch.dict(os.environ, self.environ), patch(
+            "app.scraper.subnet_discovery", self.discovery
+        ):
+            assert Scraper.get_wled_ip_list() == ["10.0.1.2", "10.0.1.1"]
+
+    def test_discovered_only(self):
+        """Test discovery alone is enough to have a scrape set"""
+        with patch.dict(os.environ, {"ENABLE_DISCOVERY": "true"}), patch(
+            "app.scraper.subnet_discovery", self.discovery
+        ), patch.object(Scraper, "parse_env_wled_ip_list", return_value=None):
+            assert Scraper.get_wled_ip_list() == ["10.0.1.1", "10.0.1.2"]
+
+    def test_forget_undiscovered(self):
+        """Test lost devices are forgotten unless they are configured"""
+        store = DeviceStateStore()
+        store.update("10.0.1.1", info={"name": "lost"})
+        store.update("10.0.1.2", info={"name": "configured"})
+        change = InventoryChange(removed=("10.0.1.1", "10.0.1.2"))
+        with patch.dict(os.environ, self.environ), patch(
+            "app.scraper.device_states", store
+        ):
+            Scraper.forget_undiscovered(change)
+        assert store.get("10.0.1.1") is None
+        assert store.get("10.0.1.2") is not None
@@ -0,0 +1,207 @@
+import importlib
+import os
+import sys
+import tempfile
+from unittest.mock import patch
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    Summary,
+    generate_latest,
+    values,
+)
+from prometheus_client.values import MultiProcessValue
+
+import app.exposition
+from app.exposition import ExpositionWriter, render_metrics
+from app.extraction import MetricExtractor
+from app.metrics import Metrics
+from app.snapshot import DeviceSnapshotCollector, DeviceSnapshotStore
+from tests.test_extraction import build_raw_device, extract_all
+
+
+def without_process_metrics(body):
+    """Drop the process stats, they change between two renders"""
+    return [
+        line
+        for line in body.decode().splitlines()
+        if "process_" not in line and "python_gc_" not in line
+    ]
+
+
+class TestExpositionWriter:
+    """The fast writer must render exactly what generate_latest() does"""
+
+    def setup_method(self):
+        self.writer = ExpositionWriter()
+        self.registry = CollectorRegistry()
+
+    def assert_parity(self, registry=None):
+        registry = registry or self.registry
+        # Twice, so the second render runs from the cached prefixes
+        for _ in range(2):
+            assert self.writer.render(registry) == generate_latest(registry)
+
+    def test_is_enabled_default(self):
+        """Test the fast writer is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert ExpositionWriter.is_enabled() is False
+
+    def test_parity_global_registry(self):
+        """Test parity on the registry after scraping devices"""
+        extractor = MetricExtractor()
+        extract_all(extractor, build_raw_device("Exposition A"))
+        extract_all(extractor, build_raw_device("Exposition B"))
+        assert without_process_metrics(
+            self.writer.render(REGISTRY)
+        ) == without_process_metrics(generate_latest(REGISTRY))
+
+    def test_parity_escaped_labels(self):
+        """Test quotes, backslashes, newlines and unicode in labels"""
+        gauge = Gauge(
+            "escape_gauge",
+            'Help with a \\ backslash\nand "quotes"',
+            ["b_label", "a_label"],
+            registry=self.registry,
+        )
+        gauge.labels('say "hi"', "back\\slash").set(1)
+        gauge.labels("line\nbreak", "Küche ✨").set(2)
+        self.assert_parity()
+
+    def test_parity_special_values(self):
+        """Test the float formatting of special and large values"""
+        gauge = Gauge(
+            "value_gauge", "Values", ["case"], registry=self.registry
+        )
+        values = [
+            float("nan"),
+            float("inf"),
+            float("-inf"),
+            0.0,
+            -0.0,
+            1e10,
+            1234567.0,
+            0.1,
+            -42,
+        ]
+        for index, value in enumerate(values):
+            gauge.labels(str(index)).set(value)
+        self.assert_parity()
+
+    def test_parity_zero_after_minus_zero(self):
+        """Test that 0.0 and -0.0 do not share a cached rendering"""
+        gauge = Gauge("zero_gauge", "Zero", ["case"], registry=self.registry)
+        gauge.labels("negative").set(-0.0)
+        gauge.labels("positive").set(0.0)
+        self.assert_parity()
+
+    def test_parity_other_metric_types(self):
+        """Test families rendered through prometheus_client itself"""
+        Gauge("plain_gauge", "Unlabelled", registry=self.registry).set(3)
+        Gauge("empty_gauge", "No children", ["x"], registry=self.registry)
+        Counter("events", "Events", ["kind"], registry=self.registry).labels(
+            "a"
+        ).inc()
+        Summary("latency_seconds", "Latency", registry=self.registry).observe(
+            0.5
+        )
+        Histogram("size_bytes", "Size", registry=self.registry).observe(10)
+        Gauge(
+            "unit_gauge",
+            "With unit",
+            ["x"],
+            unit="bytes",
+            registry=self.registry,
+        ).labels("y").set(1)
+        self.assert_parity()
+
+    def test_removed_series_are_not_rendered(self):
+        """Test that removing a child drops its line from the output"""
+        gauge = Gauge("churn_gauge", "Churn", ["id"], registry=self.registry)
+        gauge.labels("1").set(1)
+        gauge.labels("2").set(2)
+        self.assert_parity()
+        gauge.remove("1")
+        self.assert_parity()
+        assert b'id="1"' not in self.writer.render(self.registry)
+
+    def test_parity_snapshot_collector(self):
+        """Test the snapshot collector is rendered from its samples"""
+        store = DeviceSnapshotStore()
+        extractor = MetricExtractor(snapshots=store)
+        raw_device = build_raw_device("Exposition Snapshot")
+        extract_all(extractor, raw_device)
+        extractor.finish_device(raw_device.info["ip"])
+        self.registry.register(
+            DeviceSnapshotCollector(store, Metrics.device_metrics())
+        )
+        body = self.writer.render(self.registry)
+        assert b'name="Exposition Snapshot"' in body
+        self.assert_parity()
+
+    def test_target_info_falls_back(self):
+        """Test registries with target info use generate_latest()"""
+        registry = CollectorRegistry(target_info={"service": "wargos"})
+        Gauge("info_gauge", "Info", ["x"], registry=registry).labels("y")
+        assert ExpositionWriter.can_render(registry) is False
+        self.assert_parity(registry)
+
+    def test_missing_private_helpers_fall_back(self):
+        """Test /metrics still renders if prometheus_client moves them"""
+        Gauge("moved_gauge", "Moved", ["x"], registry=self.registry).labels(
+            "y"
+        ).set(1)
+        hidden = {"prometheus_client.validation": None}
+        try:
+            with patch.dict(sys.modules, hidden):
+                exposition = importlib.reload(app.exposition)
+            writer = exposition.ExpositionWriter()
+            assert writer.can_render(self.registry) is False
+            assert writer.render(self.registry) == generate_latest(
+                self.registry
+            )
+            with patch.dict(os.environ, {"ENABLE_FAST_EXPOSITION": "true"}):
+                body = exposition.render_collectors(
+                    list(self.registry._collector_to_names)
+                )
+            assert body == generate_latest(self.registry)
+        finally:
+            importlib.reload(app.exposition)
+        assert ExpositionWriter.can_render(self.registry) is True
+
+    def test_parity_multiprocess_values(self):
+        """Test metrics backed by multiprocess files, as in the image"""
+        with tempfile.TemporaryDirectory() as multiproc_dir:
+            with patch.dict(
+                os.environ, {"PROMETHEUS_MULTIPROC_DIR": multiproc_dir}
+            ), patch.object(values, "ValueClass", MultiProcessValue()):
+                gauge = Gauge(
+                    "multiproc_gauge",
+                    "Multiprocess gauge",
+                    ["ip"],
+                    registry=self.registry,
+                )
+                gauge.labels("10.0.0.1").set(3.5)
+                Counter(
+                    "multiproc_events", "Events", registry=self.registry
+                ).inc()
+                assert ExpositionWriter.can_render(self.registry) is True
+                self.assert_parity()
+                assert b'multiproc_gauge{ip="10.0.0.1"} 3.5' in (
+                    self.writer.render(self.registry)
+                )
+
+    def test_render_metrics_toggle(self):
+        """Test render_metrics() only uses the writer when enabled"""
+        with patch(
+            "app.exposition.exposition_writer.render", return_value=b"fast"
+        ) as render:
+            with patch.dict(os.environ, {"ENABLE_FAST_EXPOSITION": "false"}):
+                assert render_metrics(self.registry) == b""
+            with patch.dict(os.environ, {"ENABLE_FAST_EXPOSITION": "true"}):
+                assert render_metrics(self.registry) == b"fast"
+        render.assert_called_once_with(self.registry)
@@ -0,0 +1,134 @@
+import gzip
+import os
+from unittest.mock import MagicMock, patch
+
+from fastapi.testclient import TestClient
+
+from app.exposition_cache import (
+    ExpositionCache,
+    accepts_gzip,
+    exposition_cache,
+)
+from app.extraction import MetricExtractor
+from app.main import app
+from tests.test_extraction import build_raw_device, extract_all
+from tests.test_snapshot import FakeClock
+
+
+class TestAcceptsGzip:
+    """Tests for reading the Accept-Encoding header"""
+
+    def test_accepts_gzip(self):
+        """Test the codings that allow gzip"""
+        assert accepts_gzip("gzip")
+        assert accepts_gzip("deflate, GZIP;q=0.5")
+        assert accepts_gzip("*")
+        assert accepts_gzip("gzip;q=1, *;q=0")
+        assert accepts_gzip("*;q=0, gzip;level=1;q=0.2")
+        assert accepts_gzip("identity;q=0, *")
+
+    def test_refuses_gzip(self):
+        """Test missing, refused and malformed codings"""
+        assert not accepts_gzip(None)
+        assert not accepts_gzip("identity, deflate")
+        assert not accepts_gzip("gzip;q=0")
+        assert not accepts_gzip("gzip;q=abc")
+        assert not accepts_gzip("*, gzip;q=0")
+        assert not accepts_gzip("gzip;q=0, *")
+        assert not accepts_gzip("*;q=0")
+        assert not accepts_gzip("deflate;q=0.5, identity")
+
+
+class TestExpositionCache:
+    """Tests for caching the rendered exposition"""
+
+    def setup_method(self):
+        self.render = MagicMock(side_effect=[b"first\n", b"second\n"])
+        self.clock = FakeClock()
+        self.cache = ExpositionCache(render=self.render, clock=self.clock)
+
+    def test_is_enabled_default(self):
+        """Test the cache is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert ExpositionCache.is_enabled() is False
+
+    def test_renders_once_until_invalidated(self):
+        """Test repeated requests share one rendering"""
+        assert self.cache.get() == (b"first\n", False)
+        assert self.cache.get() == (b"first\n", False)
+        self.cache.invalidate()
+        assert self.cache.get() == (b"second\n", False)
+        assert self.render.call_count == 2
+
+    def test_gzip_copy(self):
+        """Test the gzip copy is built once per rendering"""
+        with patch(
+            "app.exposition_cache.gzip.compress", side_effect=gzip.compress
+        ) as compress:
+            body, is_gzip = self.cache.get(use_gzip=True)
+            assert self.cache.get(use_gzip=True) == (body, True)
+        assert is_gzip
+        assert gzip.decompress(body) == b"first\n"
+        assert compress.call_count == 1
+        assert self.cache.get() == (b"first\n", False)
+
+    def test_ttl_expires_rendering(self):
+        """Test the TTL re-renders without an invalidation"""
+        env = {"METRICS_EXPOSITION_CACHE_TTL_SECONDS": "5"}
+        with patch.dict(os.environ, env):
+            self.cache.get()
+            self.clock.now += 4
+            assert self.cache.get() == (b"first\n", False)
+            self.clock.now += 1
+            assert self.cache.get() == (b"second\n", False)
+
+    def test_finished_device_invalidates(self):
+        """Test a scraped device makes the next request render again"""
+        self.cache.get()
+        extractor = MetricExtractor()
+        extract_all(extractor, build_raw_device("CacheDevice"))
+        with patch("app.extraction.exposition_cache", self.cache):
+            extractor.finish_device("10.0.0.50")
+        assert not self.cache.is_fresh()
+
+
+class TestMetricsEndpointCache:
+    """Tests for serving /metrics from the cache"""
+
+    def setup_method(self):
+        self.client = TestClient(app)
+        self.env = patch.dict(os.environ, {"ENABLE_EXPOSITION_CACHE": "true"})
+        self.env.start()
+        exposition_cache.invalidate()
+
+    def teardown_method(self):
+        self.env.stop()
+
+    def test_plain_response(self):
+        """Test clients without gzip get the plain rendering"""
+        response = self.client.get(
+            "/metrics", headers={"Accept-Encoding": "identity"}
+        )
+        assert response.status_code == 200
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert b"wargos_" in response.content
+
+    def test_gzip_response(self):
+        """Test clients accepting gzip get the compressed copy"""
+        response = self.client.get(
+            "/metrics", headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        # The test client decodes the body transparently
+        assert b"wargos_" in response.content
+
+    def test_cached_until_invalidated(self):
+        """Test a new scrape shows up on the next request"""
+        first = self.client.get("/metrics").content
+        extract_all(MetricExtractor(), build_raw_device("CacheFresh"))
+        assert b"CacheFresh" not in self.client.get("/metrics").content
+        exposition_cache.invalidate()
+        assert b"CacheFresh" in self.client.get("/metrics").content
+        assert first
@@ -0,0 +1,213 @@
+import copy
+import os
+from unittest.mock import patch
+
+from prometheus_client import CollectorRegistry, Gauge
+
+from app.change_detection import PayloadSection
+from app.extraction import (
+    METRIC_FAMILIES,
+    METRIC_SPECS,
+    MetricExtractor,
+    MetricScope,
+    MetricSpec,
+    compile_getter,
+)
+from app.metrics import Metrics
+from app.raw_scraper import RawDevice
+from tests.test_websocket_push import FAKE_JSON, FAKE_PRESETS
+
+
+def build_raw_device(name):
+    data = copy.deepcopy(FAKE_JSON)
+    data["info"]["name"] = name
+    return RawDevice.from_payloads(data, copy.deepcopy(FAKE_PRESETS))
+
+
+def extract_all(extractor, raw_device):
+    for section in PayloadSection:
+        extractor.extract_section(
+            section, raw_device.info, raw_device.state, raw_device.presets
+        )
+
+
+class TestCompileGetter:
+    """Tests for reading JSON paths"""
+
+    def test_nested_path(self):
+        """Test nested keys, missing parents and defaults"""
+        getter = compile_getter(("fs", "t"), 1)
+        assert getter({"fs": {"t": 5}}) == 5
+        assert getter({"fs": {}}) == 1
+        assert getter({}) == 1
+
+    def test_empty_path_returns_data(self):
+        """Test that an empty path hands over the scope data"""
+        assert compile_getter((), 0)([1, 2]) == [1, 2]
+
+
+class TestMetricExtractor:
+    """Tests for the compiled metric specs"""
+
+    def test_every_family_is_named(self):
+        """Test that the spec table covers every family"""
+        assert set(METRIC_FAMILIES) == {
+            "filesystem",
+            "info",
+            "leds",
+            "nightlight",
+            "presets",
+            "segment_colors",
+            "segments",
+            "state",
+            "sync",
+            "wifi",
+        }
+
+    def test_extracts_each_scope(self):
+        """Test one pass sets info, state, segment, color and preset metrics"""
+        extract_all(MetricExtractor(), build_raw_device("Extracted"))
+        labels = {"ip": "10.0.0.50", "name": "Extracted"}
+        assert Metrics.INSTANCE_LED_MAX_POWER.labels(
+            **labels
+        )._value.get() == (850)
+        assert Metrics.INSTANCE_STATE_PRESET_ID.labels(
+            **labels
+        )._value.get() == (0)
+        assert (
+            Metrics.INSTANCE_SEGMENT_SPEED_VALUE.labels(
+                segment=0, **labels
+            )._value.get()
+            == 128
+        )
+        assert (
+            Metrics.INSTANCE_SEGMENT_COLOR_VALUE.labels(
+                segment=0,
+                color_priority="primary",
+                color_tuple_position=0,
+                **labels,
+            )._value.get()
+            == 255
+        )
+        assert (
+            Metrics.INSTANCE_PRESET_COUNT_VALUE.labels(**labels)._value.get()
+            == 1
+        )
+
+    def test_disabled_family_is_not_compiled(self):
+        """Test that a disabled family sets none of its metrics"""
+        extractor = MetricExtractor(disabled_families={"wifi"})
+        extract_all(extractor, build_raw_device("NoWifi"))
+        labels = {"ip": "10.0.0.50", "name": "NoWifi"}
+        wifi_series = Metrics.INSTANCE_WIFI_RSSI._metrics.keys()
+        assert not [key for key in wifi_series if "NoWifi" in key]
+        assert Metrics.INSTANCE_FREE_HEAP.labels(**labels)._value.get() == (
+            100000
+        )
+
+    def test_custom_spec(self):
+        """Test a spec with a transform and extra labels"""
+        metric = Gauge(
+            "custom_led_count",
+            "Doubled LED count",
+            ["ip", "name", "product"],
+            registry=CollectorRegistry(),
+        )
+        spec = MetricSpec(
+            "custom",
+            MetricScope.INFO,
+            metric,
+            ("leds", "count"),
+            transform=lambda count: count * 2,
+            labels=(("product", lambda info: info["product"]),),
+        )
+        raw_device = build_raw_device("Custom")
+        MetricExtractor(specs=(spec,)).extract_section(
+            PayloadSection.INFO,
+            raw_device.info,
+            raw_device.state,
+            raw_device.presets,
+        )
+        child = metric.labels(ip="10.0.0.50", name="Custom", product="FOSS")
+        assert child._value.get() == 60
+
+    def test_get_extractor_is_compiled_once(self):
+        """Test the extractor is reused until the families setting changes"""
+        with patch.dict(os.environ, {"WLED_DISABLED_METRIC_FAMILIES": ""}):
+            first = MetricExtractor.get_extractor()
+            assert MetricExtractor.get_extractor() is first
+        with patch.dict(
+            os.environ, {"WLED_DISABLED_METRIC_FAMILIES": "presets, sync"}
+        ):
+            assert MetricExtractor.get_disabled_families() == {
+                "presets",
+                "sync",
+            }
+            assert MetricExtractor.get_extractor() is not first
+
+    def test_spec_metrics_are_unique_per_scope(self):
+        """Test that no metric is set twice in the same scope"""
+        keys = [
+            (spec.scope, spec.metric)
+            for spec in METRIC_SPECS
+            if not spec.labels
+        ]
+        assert len(keys) == len(set(keys))
+
+
+class TestBoundDevice:
+    """Tests for the labelled children bound per device"""
+
+    def setup_method(self):
+        self.extractor = MetricExtractor()
+
+    def bound_children(self, raw_device):
+        extract_all(self.extractor, raw_device)
+        device = self.extractor.get_bound_device(
+            {"ip": raw_device.info["ip"], "name": raw_device.info["name"]}
+        )
+        return dict(device.children)
+
+    def test_children_are_reused(self):
+        """Test the second scrape sets the children bound on the first"""
+        first = self.bound_children(build_raw_device("Bound"))
+        with patch.object(
+            Metrics.INSTANCE_SEGMENT_SPEED_VALUE, "labels"
+        ) as labels:
+            second = self.bound_children(build_raw_device("Bound"))
+        labels.assert_not_called()
+        assert second.keys() == first.keys()
+        for key, children in first.items():
+            assert [child for child, _ in second[key]] == [
+                child for child, _ in children
+            ]
+
+    def test_rename_binds_again(self):
+        """Test a renamed device binds children with its new name"""
+        self.bound_children(build_raw_device("Before"))
+        children = self.bound_children(build_raw_device("After"))
+        assert len(self.extractor._devices) == 1
+        child, _ = children[(MetricScope.INFO,)][0]
+        assert child is Metrics.INSTANCE_FREE_HEAP.labels(
+            ip="10.0.0.50", name="After"
+        )
+
+    def test_segment_change_drops_segment_children(self):
+        """Test a changed segment set rebinds segments but not state"""
+        first = self.bound_children(build_raw_device("Segments"))
+        raw_device = build_raw_device("Segments")
+        raw_device.state["seg"].append({"id": 1, "col": [[1, 2, 3]]})
+        second = self.bound_children(raw_device)
+
+        assert (MetricScope.SEGMENT, 1) in second
+        assert (MetricScope.COLOR, 1, "primary", 2) in second
+        assert second[(MetricScope.STATE,)] is first[(MetricScope.STATE,)]
+        assert second[(MetricScope.SEGMENT, 0)] is not (
+            first[(MetricScope.SEGMENT, 0)]
+        )
+
+    def test_forget_device(self):
+        """Test that a forgotten device binds its children again"""
+        self.bound_children(build_raw_device("Forgotten"))
+        self.extractor.forget("10.0.0.50")
+        assert self.extractor._devices == {}
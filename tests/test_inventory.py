@@ -0,0 +1,263 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.circuit_breaker import CircuitBreakerRegistry
+from app.device_store import DeviceStateStore
+from app.inventory import (
+    DeviceInventory,
+    InventoryDevice,
+    InventoryException,
+    parse_inventory,
+)
+from app.scheduler import ScrapeScheduler
+from app.scrape_tiers import TierEntry, TieredDeviceCache
+from app.scraper import Scraper
+from tests.test_snapshot import FakeClock
+
+INVENTORY = """
+devices:
+  - ip: 10.0.0.1
+    name: desk
+    tags: [office, strip]
+    interval: 30
+  - ip: 10.0.0.2
+    backup: config
+  - ip: 10.0.0.3
+    enabled: false
+  - 10.0.0.4
+"""
+
+
+def get_reloads(result):
+    return (
+        REGISTRY.get_sample_value(
+            "wargos_inventory_reloads_total", {"result": result}
+        )
+        or 0
+    )
+
+
+class TestParseInventory:
+    """Tests for reading the inventory file"""
+
+    def test_yaml(self):
+        """Test attributes, defaults and bare ip entries"""
+        devices = parse_inventory("inventory.yaml", INVENTORY)
+        assert list(devices) == [
+            "10.0.0.1",
+            "10.0.0.2",
+            "10.0.0.3",
+            "10.0.0.4",
+        ]
+        assert devices["10.0.0.1"] == InventoryDevice(
+            ip="10.0.0.1",
+            name="desk",
+            tags=("office", "strip"),
+            interval=30.0,
+        )
+        assert devices["10.0.0.4"] == InventoryDevice(ip="10.0.0.4")
+
+    def test_json(self):
+        """Test a JSON list of devices"""
+        devices = parse_inventory(
+            "inventory.json", b'["10.0.0.1", {"ip": "10.0.0.2"}]'
+        )
+        assert list(devices) == ["10.0.0.1", "10.0.0.2"]
+
+    @pytest.mark.parametrize(
+        "body",
+        [
+            "devices: [{name: desk}]",
+            "devices: [{ip: 10.0.0.1, backup: weekly}]",
+            "devices: [{ip: 10.0.0.1, interval: 0}]",
+            "devices: [{ip: 10.0.0.1, colour: red}]",
+            "devices: [10.0.0.1, 10.0.0.1]",
+            "devices: 10.0.0.1",
+        ],
+    )
+    def test_invalid(self, body):
+        """Test entries that can't be scraped are rejected"""
+        with pytest.raises(InventoryException):
+            parse_inventory("inventory.yaml", body)
+
+
+class TestDeviceInventory:
+    """Tests for reloading the inventory when the file changes"""
+
+    def setup_method(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "inventory.yaml")
+        self.inventory = DeviceInventory(self.path)
+        self.mtime = 1_000_000_000
+
+    def teardown_method(self):
+        self.inventory.reset()
+
+    def write(self, body):
+        with open(self.path, "w") as inventory_file:
+            inventory_file.write(body)
+        # Every write gets a distinct mtime, even on coarse filesystems
+        self.mtime += 1_000_000_000
+        os.utime(self.path, ns=(self.mtime, self.mtime))
+
+    def test_refresh_only_on_change(self):
+        """Test the file is read once until it changes again"""
+        self.write(INVENTORY)
+        change = self.inventory.refresh()
+        assert change.added == ("10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4")
+        with patch("app.inventory.parse_inventory") as parse:
+            assert self.inventory.refresh() is None
+        parse.assert_not_called()
+        assert self.inventory.get_ip_list() == [
+            "10.0.0.1",
+            "10.0.0.2",
+            "10.0.0.4",
+        ]
+
+    def test_incremental_change(self):
+        """Test a reload reports only the devices that differ"""
+        self.write(INVENTORY)
+        self.inventory.refresh()
+        first = self.inventory.get("10.0.0.2")
+        self.write(
+            INVENTORY.replace("interval: 30", "interval: 10").replace(
+                "  - 10.0.0.4", "  - 10.0.0.5"
+            )
+        )
+        change = self.inventory.refresh()
+        assert change.added == ("10.0.0.5",)
+        assert change.removed == ("10.0.0.4",)
+        assert change.changed == ("10.0.0.1",)
+        assert self.inventory.get("10.0.0.2") == first
+
+    def test_invalid_file_keeps_devices(self):
+        """Test a broken edit is reported and the devices kept"""
+        self.write(INVENTORY)
+        self.inventory.refresh()
+        errors = get_reloads("error")
+        self.write("devices: [")
+        assert self.inventory.refresh() is None
+        assert self.inventory.refresh() is None
+        assert get_reloads("error") == errors + 1
+        assert len(self.inventory.get_ip_list()) == 3
+
+    def test_backup_policy(self):
+        """Test backups only include the devices whose policy allows it"""
+        self.write(INVENTORY)
+        self.inventory.refresh()
+        assert self.inventory.get_backup_ip_list("config") == [
+            "10.0.0.1",
+            "10.0.0.2",
+            "10.0.0.4",
+        ]
+        assert self.inventory.get_backup_ip_list("presets") == [
+            "10.0.0.1",
+            "10.0.0.4",
+        ]
+
+    def test_info_metric(self):
+        """Test enabled devices are exported with their attributes"""
+        self.write(INVENTORY)
+        self.inventory.refresh()
+        labels = {"ip": "10.0.0.1", "name": "desk", "tags": "office,strip"}
+        assert (
+            REGISTRY.get_sample_value("wargos_inventory_device_info", labels)
+            == 1
+        )
+        self.write(INVENTORY.replace("name: desk", "name: shelf"))
+        self.inventory.refresh()
+        assert (
+            REGISTRY.get_sample_value("wargos_inventory_device_info", labels)
+            is None
+        )
+
+
+class TestScraperInventory:
+    """Tests for scraping the instances of the inventory"""
+
+    def setup_method(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "inventory.json")
+        self.inventory = DeviceInventory()
+        self.store = DeviceStateStore()
+
+    def teardown_method(self):
+        self.inventory.reset()
+
+    def get_wled_ip_list(self, environ):
+        with patch.dict(os.environ, environ), patch(
+            "app.scraper.device_inventory", self.inventory
+        ), patch("app.scraper.device_states", self.store):
+            return Scraper.get_wled_ip_list()
+
+    def test_falls_back_to_env(self):
+        """Test WLED_IP_LIST is used until the inventory could be read"""
+        environ = {
+            "WLED_INVENTORY_FILE": self.path,
+            "WLED_IP_LIST": "10.0.0.9",
+        }
+        assert self.get_wled_ip_list(environ) == ["10.0.0.9"]
+
+    def test_removed_device_is_forgotten(self):
+        """Test only removed devices lose their state"""
+        environ = {"WLED_INVENTORY_FILE": self.path}
+        with open(self.path, "w") as inventory_file:
+            inventory_file.write('["10.0.0.1", "10.0.0.2"]')
+        assert self.get_wled_ip_list(environ) == ["10.0.0.1", "10.0.0.2"]
+        kept = self.store.update("10.0.0.1", info={"name": "kept"})
+        self.store.update("10.0.0.2", info={"name": "removed"})
+        with open(self.path, "w") as inventory_file:
+            inventory_file.write('["10.0.0.1"]')
+        assert self.get_wled_ip_list(environ) == ["10.0.0.1"]
+        assert self.store.get("10.0.0.1") is kept
+        assert self.store.get("10.0.0.2") is None
+
+    def test_removed_device_clears_client_state(self):
+        """Test the tier cache and circuit breaker of a removed device go"""
+        tiers = TieredDeviceCache()
+        breakers = CircuitBreakerRegistry()
+        for device_ip in ("10.0.0.1", "10.0.0.2"):
+            tiers._entries[device_ip] = TierEntry(None, 0, 0, 0)
+            breakers.get_breaker(device_ip)
+        with patch("app.scraper.tiered_devices", tiers), patch(
+            "app.scraper.circuit_breakers", breakers
+        ):
+            Scraper.forget_devices(("10.0.0.2",))
+        assert tiers.get_entry("10.0.0.1") is not None
+        assert tiers.get_entry("10.0.0.2") is None
+        assert list(breakers._breakers) == ["10.0.0.1"]
+        breakers.reset()
+
+
+class TestSchedulerIntervals:
+    """Tests for the per device intervals of the inventory"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.scheduler = ScrapeScheduler(60, clock=self.clock)
+
+    def test_unchanged_devices_keep_schedule(self):
+        """Test adding a device doesn't reschedule the others"""
+        self.scheduler.sync_devices(["10.0.0.1"], intervals={})
+        self.scheduler.pop_due()
+        self.scheduler.record_success("10.0.0.1")
+        next_due = self.scheduler.get_entry("10.0.0.1").next_due
+        self.clock.now += 10
+        self.scheduler.sync_devices(
+            ["10.0.0.1", "10.0.0.2"], intervals={"10.0.0.2": 5}
+        )
+        assert self.scheduler.get_entry("10.0.0.1").next_due == next_due
+        assert self.scheduler.get_interval("10.0.0.2") == 5
+        assert self.scheduler.pop_due() == ["10.0.0.2"]
+
+    def test_shorter_interval_is_due_sooner(self):
+        """Test a lowered interval applies without waiting out the old"""
+        self.scheduler.sync_devices(["10.0.0.1"], intervals={})
+        self.scheduler.record_success("10.0.0.1")
+        self.scheduler.sync_devices(["10.0.0.1"], intervals={"10.0.0.1": 5})
+        self.clock.now += 5
+        assert self.scheduler.pop_due() == ["10.0.0.1"]
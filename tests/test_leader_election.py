@@ -0,0 +1,197 @@
+import os
+import tempfile
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.leader_election import LeaderElection
+from app.lock_manager import SQLiteLockManager
+from app.main import app, lifespan
+from app.scraper_daemon import ScraperDaemon
+from tests.test_snapshot import FakeClock
+
+
+@pytest.fixture
+def locks():
+    with tempfile.TemporaryDirectory() as directory:
+        yield SQLiteLockManager(db_path=os.path.join(directory, "locks.db"))
+
+
+def advance_database_clock(seconds):
+    """Lets leases in the database expire without sleeping"""
+    now = time.time() + seconds
+    return patch("app.lock_manager.time.time", return_value=now)
+
+
+class TestLeases:
+    """Tests for the lease statements of the lock manager"""
+
+    def test_renewal_keeps_token(self, locks):
+        """Test the holder renews its lease under the same token"""
+        first = locks.acquire_lease("scraper", "a", 10)
+        second = locks.acquire_lease("scraper", "a", 10)
+        assert first["token"] == second["token"] == 1
+        assert second["acquired_at"] == first["acquired_at"]
+        assert second["expires_at"] >= first["expires_at"]
+
+    def test_held_lease_is_refused(self, locks):
+        """Test nobody else gets a lease before it expires"""
+        locks.acquire_lease("scraper", "a", 10)
+        assert locks.acquire_lease("scraper", "b", 10) is None
+        assert locks.get_lease_info("scraper")["holder"] == "a"
+
+    def test_takeover_bumps_token(self, locks):
+        """Test an expired lease goes to the next holder, fenced"""
+        locks.acquire_lease("scraper", "a", 10)
+        with advance_database_clock(11):
+            lease = locks.acquire_lease("scraper", "b", 10)
+        assert lease["token"] == 2
+        assert locks.check_lease("scraper", "a", 1) is False
+        assert locks.check_lease("scraper", "b", 2) is True
+
+    def test_release_hands_over(self, locks):
+        """Test a released lease can be taken right away"""
+        locks.acquire_lease("scraper", "a", 10)
+        assert locks.release_lease("scraper", "a") is True
+        assert locks.release_lease("scraper", "b") is False
+        assert locks.acquire_lease("scraper", "b", 10)["token"] == 2
+
+
+class TestLeaderElection:
+    """Tests for sticky leadership through the renewed lease"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+
+    def election(self, locks, holder):
+        return LeaderElection(locks=locks, holder=holder, clock=self.clock)
+
+    def sample(self, name, labels=None):
+        return REGISTRY.get_sample_value(name, labels or {})
+
+    def test_is_enabled_default(self):
+        """Test leader election is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert LeaderElection.is_enabled() is False
+            assert LeaderElection.get_renew_interval_seconds() == 5
+
+    def test_leader_is_sticky(self, locks):
+        """Test the leader keeps the lease over many renewals"""
+        leader = self.election(locks, "a")
+        follower = self.election(locks, "b")
+        for _ in range(5):
+            assert leader.renew() is True
+            assert follower.renew() is False
+        assert leader.is_leader and leader.token == 1
+        assert not follower.is_leader
+        assert self.sample("wargos_leader_info", {"holder": "a"}) == 1
+
+    def test_leadership_lapses_without_renewal(self, locks):
+        """Test a leader stops trusting a lease it couldn't renew"""
+        leader = self.election(locks, "a")
+        leader.renew()
+        self.clock.now += LeaderElection.get_lease_ttl_seconds()
+        assert leader.is_leader is False
+
+    def test_failover(self, locks):
+        """Test a follower takes over a dead leader and fences it off"""
+        leader = self.election(locks, "a")
+        follower = self.election(locks, "b")
+        leader.renew()
+        failovers = self.sample("wargos_leader_failovers_total")
+        with advance_database_clock(LeaderElection.get_lease_ttl_seconds()):
+            assert follower.renew() is True
+            assert leader.is_current() is False
+            assert follower.is_current() is True
+        assert follower.token == 2
+        assert self.sample("wargos_leader_failovers_total") == failovers + 1
+        assert self.sample("wargos_leader_fencing_token") == 2
+        assert self.sample("wargos_leader_info", {"holder": "a"}) is None
+
+    def test_own_lease_is_no_failover(self, locks):
+        """Test re-acquiring its own lease after a restart isn't counted"""
+        locks.acquire_lease("scraper", "a", 10)
+        with advance_database_clock(11):
+            locks.acquire_lease("scraper", "b", 10)
+        failovers = self.sample("wargos_leader_failovers_total")
+        with advance_database_clock(22):
+            restarted = self.election(locks, "b")
+            assert restarted.renew() is True
+        assert restarted.token == 2
+        assert self.sample("wargos_leader_failovers_total") == failovers
+
+    def test_handover_is_no_failover(self, locks):
+        """Test taking over a released lease isn't counted"""
+        leader = self.election(locks, "a")
+        leader.renew()
+        locks.release_lease("scraper", "a")
+        failovers = self.sample("wargos_leader_failovers_total")
+        follower = self.election(locks, "b")
+        assert follower.renew() is True
+        assert follower.token == 2
+        assert self.sample("wargos_leader_failovers_total") == failovers
+
+    def test_lease_age(self, locks):
+        """Test the lease age grows while the same leader renews"""
+        leader = self.election(locks, "a")
+        with patch.dict(os.environ, {"LEADER_LEASE_TTL_SECONDS": "60"}):
+            leader.renew()
+            acquired_at = locks.get_lease_info("scraper")["acquired_at"]
+            self.clock.now = acquired_at + 30
+            leader.renew()
+        assert self.sample("wargos_leader_lease_age_seconds") == 30
+
+    @pytest.mark.asyncio
+    async def test_stop_releases(self, locks):
+        """Test stopping hands the lease to the next process at once"""
+        leader = LeaderElection(locks=locks, holder="a")
+        leader.start()
+        await leader.stop()
+        assert LeaderElection(locks=locks, holder="b").renew() is True
+
+
+class TestLeaderScrapes:
+    """Tests for scraping only as the leader"""
+
+    @pytest.mark.asyncio
+    async def test_daemon_scrapes_as_leader(self):
+        """Test a daemon scrapes and publishes while it leads"""
+        daemon = ScraperDaemon(shared=MagicMock())
+        daemon.scraper = MagicMock(perform_full_scrape=AsyncMock())
+        daemon.leader_election = MagicMock(is_leader=True)
+        daemon.leader_election.is_current.return_value = True
+        assert await daemon.run_once() is True
+        daemon._shared.publish.assert_called_once_with()
+
+    @pytest.mark.asyncio
+    async def test_fenced_daemon_does_not_publish(self):
+        """Test a leader replaced during its scrape keeps its results"""
+        daemon = ScraperDaemon(shared=MagicMock())
+        daemon.scraper = MagicMock(perform_full_scrape=AsyncMock())
+        daemon.leader_election = MagicMock(is_leader=True)
+        daemon.leader_election.is_current.return_value = False
+        assert await daemon.run_once() is False
+        daemon._shared.publish.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_worker_follower_skips_scrape(self):
+        """Test a worker that doesn't lead neither scrapes nor locks"""
+        environ = {"ENABLE_LEADER_ELECTION": "true"}
+        with patch.dict(os.environ, environ), patch(
+            "app.main.LeaderElection"
+        ) as election_class, patch("app.main.Scraper") as scraper, patch(
+            "app.main.lock_manager"
+        ) as locks:
+            election_class.is_enabled.return_value = True
+            election = election_class.return_value
+            election.is_leader = False
+            election.stop = AsyncMock()
+            scraper.get_default_wait_first_interval.return_value = 0
+            scraper.get_default_scrape_interval.return_value = 60
+            async with lifespan(app):
+                election.start.assert_called_once_with()
+        scraper.get_client.return_value.perform_full_scrape.assert_not_called()
+        locks.try_acquire_lock.assert_not_called()
+        election.stop.assert_awaited_once()
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import sqlite3
+import time
+from unittest.mock import patch
+
+import pytest
+
+from app.lock_manager import (
+    FlockLockManager,
+    SQLiteLockManager,
+    create_lock_manager,
+)
+
+
+def hold_lock_until(lock_dir, acquired, done):
+    """Run in another process, holds the lock until told to exit"""
+    locks = FlockLockManager(lock_dir)
+    assert locks.try_acquire_lock("scraper", os.getpid(), 60)
+    acquired.set()
+    done.wait(10)
+
+
+@pytest.fixture(params=["sqlite", "flock"])
+def locks(request, tmp_path):
+    if request.param == "flock":
+        return FlockLockManager(str(tmp_path / "locks"))
+    return SQLiteLockManager(db_path=str(tmp_path / "locks.db"))
+
+
+class TestLockBackends:
+    """Both backends must behave the same for the callers"""
+
+    def test_acquire_and_release(self, locks):
+        """Test one holder at a time, and release by the holder only"""
+        assert locks.try_acquire_lock("scraper", 1, 60) is True
+        assert locks.try_acquire_lock("scraper", 2, 60) is False
+        assert locks.get_lock_info("scraper")["worker_pid"] == 1
+        assert locks.release_lock("scraper", 2) is False
+        assert locks.release_lock("scraper", 1) is True
+        assert locks.get_lock_info("scraper") is None
+        assert locks.try_acquire_lock("scraper", 2, 60) is True
+
+    def test_independent_locks(self, locks):
+        """Test different lock names don't block each other"""
+        assert locks.try_acquire_lock("scraper", 1, 60) is True
+        assert locks.try_acquire_lock("backup", 2, 60) is True
+
+    def test_leases(self, locks):
+        """Test renewal, refusal and a fenced takeover after expiry"""
+        assert locks.acquire_lease("scraper", "a", 10)["token"] == 1
+        assert locks.acquire_lease("scraper", "a", 10)["token"] == 1
+        assert locks.acquire_lease("scraper", "b", 10) is None
+        assert locks.release_lease("scraper", "a") is True
+        assert locks.acquire_lease("scraper", "b", 10)["token"] == 2
+        assert locks.check_lease("scraper", "b", 2) is True
+        assert locks.check_lease("scraper", "a", 1) is False
+
+
+class TestSQLiteLockManagerConnection:
+    """Tests for the persistent connection and one statement acquire"""
+
+    def test_one_connection_per_process(self, tmp_path):
+        """Test lock operations reuse a single connection"""
+        locks = SQLiteLockManager(db_path=str(tmp_path / "locks.db"))
+        with patch(
+            "app.lock_manager.sqlite3.connect", side_effect=sqlite3.connect
+        ) as connect:
+            for pid in range(5):
+                locks.try_acquire_lock("scraper", pid, 60)
+                locks.get_lock_info("scraper")
+                locks.release_lock("scraper", pid)
+        assert connect.call_count == 1
+
+    def test_steals_expired_lock(self, tmp_path):
+        """Test an expired lock is taken over by the acquire itself"""
+        locks = SQLiteLockManager(db_path=str(tmp_path / "locks.db"))
+        assert locks.try_acquire_lock("scraper", 1, 10)
+        later = time.time() + 11
+        with patch("app.lock_manager.time.time", return_value=later):
+            assert locks.try_acquire_lock("scraper", 2, 10) is True
+        assert locks.get_lock_info("scraper")["worker_pid"] == 2
+
+    def test_expired_lock_has_no_info(self, tmp_path):
+        """Test an expired lock is reported free, like the flock backend"""
+        locks = SQLiteLockManager(db_path=str(tmp_path / "locks.db"))
+        assert locks.try_acquire_lock("scraper", 1, 10)
+        later = time.time() + 11
+        with patch("app.lock_manager.time.time", return_value=later):
+            assert locks.get_lock_info("scraper") is None
+
+    def test_reconnects_after_fork(self, tmp_path):
+        """Test a forked process opens its own connection"""
+        locks = SQLiteLockManager(db_path=str(tmp_path / "locks.db"))
+        locks.get_lock_info("scraper")
+        with patch("app.lock_manager.os.getpid", return_value=-1):
+            assert locks.try_acquire_lock("scraper", 1, 60) is True
+            assert locks._conn_pid == -1
+
+
+class TestFlockLockManager:
+    """Tests for the flock backend"""
+
+    def test_lock_dies_with_its_process(self, tmp_path):
+        """Test another process holds the lock until it exits"""
+        lock_dir = str(tmp_path / "locks")
+        context = multiprocessing.get_context("fork")
+        acquired = context.Event()
+        done = context.Event()
+        process = context.Process(
+            target=hold_lock_until, args=(lock_dir, acquired, done)
+        )
+        process.start()
+        assert acquired.wait(10)
+
+        locks = FlockLockManager(lock_dir)
+        assert locks.try_acquire_lock("scraper", os.getpid(), 60) is False
+        info = locks.get_lock_info("scraper")
+        assert info["worker_pid"] == process.pid
+
+        # No release and no expiry, the kernel frees it on exit
+        process.kill()
+        process.join(10)
+        assert locks.try_acquire_lock("scraper", os.getpid(), 60) is True
+
+    def test_backend_setting(self, tmp_path):
+        """Test LOCK_MANAGER_BACKEND picks the flock backend"""
+        environ = {
+            "LOCK_MANAGER_BACKEND": "flock",
+            "LOCK_MANAGER_DIR": str(tmp_path),
+        }
+        with patch.dict(os.environ, environ):
+            assert isinstance(create_lock_manager(), FlockLockManager)
+        with patch.dict(os.environ, {}, clear=True):
+            assert isinstance(create_lock_manager(), SQLiteLockManager)
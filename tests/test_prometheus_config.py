@@ -18,8 +18,8 @@ class TestPrometheusConfiguration:
 
     @pytest.fixture
     def mock_generate_latest(self):
-        """Mock generate_latest"""
-        with patch("app.main.generate_latest") as mock:
+        """Mock the /metrics renderer"""
+        with patch("app.main.render_exposition") as mock:
             mock.return_value = b"# HELP test_metric\n# TYPE test_metric counter\ntest_metric 1.0\n"
             yield mock
 
@@ -0,0 +1,178 @@
+import copy
+import json
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+from wled.models import Device
+
+from app.circuit_breaker import circuit_breakers
+from app.raw_scraper import RawDevice, RawJsonException, RawScraper
+from app.scraper import Scraper
+from app.wled_client import WLEDClient
+from tests.test_websocket_push import (
+    FAKE_HOST,
+    FAKE_JSON,
+    FAKE_PRESETS,
+    FakeWLEDServer,
+)
+
+# Samples the hand-written scrape_* methods exported before the metric
+# spec replaced them, both paths must still export exactly these
+GOLDEN_PATH = os.path.join(
+    os.path.dirname(__file__), "fixtures", "extraction_golden.json"
+)
+
+
+def load_golden_samples(case):
+    with open(GOLDEN_PATH) as golden_file:
+        golden = json.load(golden_file)
+    return {
+        (name, tuple(sorted(labels.items())), value)
+        for name, labels, value in golden[case]
+    }
+
+
+def build_payload(name, **overrides):
+    data = copy.deepcopy(FAKE_JSON)
+    data["info"]["name"] = name
+    for section, values in overrides.items():
+        data[section].update(values)
+    return data
+
+
+def collect_samples(device_name):
+    """Every exported sample of a device, without its name label"""
+    samples = set()
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            if sample.labels.get("name") != device_name:
+                continue
+            labels = dict(sample.labels)
+            labels.pop("name")
+            samples.add(
+                (sample.name, tuple(sorted(labels.items())), sample.value)
+            )
+    return samples
+
+
+class TestRawScraperParity:
+    """Both paths must export exactly what the hand-written scrape_*
+    methods did, and the same as each other"""
+
+    def setup_method(self):
+        self.scraper = Scraper(MagicMock())
+
+    def assert_parity(self, case, presets=None, **overrides):
+        presets = copy.deepcopy(FAKE_PRESETS if presets is None else presets)
+        # Each case has its own devices, series of other cases stay around
+        model_name = f"ParityModel {case}"
+        raw_name = f"ParityRaw {case}"
+        model_data = build_payload(model_name, **overrides)
+        raw_data = build_payload(raw_name, **overrides)
+
+        device = Device.from_dict(
+            copy.deepcopy(model_data) | {"presets": copy.deepcopy(presets)}
+        )
+        self.scraper.scrape_device_metrics(device)
+        self.scraper.scrape_raw_device_metrics(
+            RawDevice.from_payloads(raw_data, presets)
+        )
+
+        model_samples = collect_samples(model_name)
+        assert model_samples == load_golden_samples(case)
+        assert collect_samples(raw_name) == model_samples
+
+    def test_parity_default_payload(self):
+        """Test parity on a typical payload"""
+        self.assert_parity("default_payload")
+
+    def test_parity_active_preset_and_playlist(self):
+        """Test parity with an active preset and playlist"""
+        self.assert_parity(
+            "active_preset_and_playlist", state={"ps": 3, "pl": 4}
+        )
+
+    def test_parity_websocket_disabled(self):
+        """Test parity when the build has no WebSocket support"""
+        self.assert_parity("websocket_disabled", info={"ws": -1, "uptime": 0})
+
+    def test_parity_small_esp8266(self):
+        """Test parity of the architecture tweak for small flash sizes"""
+        self.assert_parity(
+            "small_esp8266",
+            info={"arch": "ESP8266", "fs": {"u": 10, "t": 200, "pmt": 0}},
+        )
+
+    def test_parity_hex_colors_and_missing_fields(self):
+        """Test parity with hex colors and fields left to their defaults"""
+        segment = {"id": 0, "col": ["#ff8000", [1, 2, 3, 4]], "start": 2}
+        self.assert_parity(
+            "hex_colors_and_missing_fields",
+            state={"seg": [segment, {"stop": 5}]},
+        )
+
+    def test_parity_presets_and_playlists(self):
+        """Test parity of presets, unnamed presets and playlists"""
+        presets = {
+            "0": {},
+            "1": {"n": "Red", "on": True, "transition": 7, "ql": "R"},
+            "2": {"on": False},
+            "3": {
+                "n": "Loop",
+                "playlist": {"ps": [1, 2], "dur": 10, "transition": 0},
+            },
+        }
+        self.assert_parity("presets_and_playlists", presets=presets)
+
+    def test_incomplete_payload_raises(self):
+        """Test that a payload without state is rejected"""
+        with pytest.raises(RawJsonException):
+            RawDevice.from_payloads({"info": {}})
+
+    def test_is_enabled_default(self):
+        """Test the raw path is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert RawScraper.is_enabled() is False
+
+
+class TestRawScrapeFetch:
+    """Tests for fetching and scraping the raw payloads"""
+
+    def setup_method(self):
+        circuit_breakers.reset()
+
+    def teardown_method(self):
+        circuit_breakers.reset()
+
+    @pytest.mark.asyncio
+    async def test_get_wled_instance_raw(self):
+        """Test fetching /json and /presets.json over the session"""
+        server = FakeWLEDServer()
+        async with server.running() as session:
+            client = WLEDClient(session=session)
+            raw_device = await client.get_wled_instance_raw(FAKE_HOST)
+
+        assert raw_device.info["name"] == "Fake"
+        assert raw_device.state["bri"] == 128
+        assert raw_device.presets == FAKE_PRESETS
+        assert server.presets_requests == 1
+
+    @pytest.mark.asyncio
+    async def test_scrape_instance_uses_raw_path(self):
+        """Test that the setting switches scrape_instance to raw JSON"""
+        wled_client = MagicMock()
+        wled_client.get_wled_instance_raw = AsyncMock(
+            return_value=RawDevice.from_payloads(
+                build_payload("RawMode"), FAKE_PRESETS
+            )
+        )
+        wled_client.get_wled_instance_device = AsyncMock()
+        scraper = Scraper(wled_client)
+
+        with patch.dict(os.environ, {"ENABLE_RAW_JSON_SCRAPE": "true"}):
+            await scraper.scrape_instance("10.0.0.77")
+
+        wled_client.get_wled_instance_device.assert_not_called()
+        assert collect_samples("RawMode")
@@ -0,0 +1,199 @@
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.metrics import Metrics
+from app.scheduler import ScrapeScheduler
+from app.scraper import Scraper
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TestScrapeScheduler:
+    """Tests for the per-device adaptive scrape scheduler"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.scheduler = ScrapeScheduler(60, max_backoff=600, clock=self.clock)
+        self.scheduler.sync_devices(["10.0.0.1", "10.0.0.2"])
+
+    def test_is_enabled_default(self):
+        """Test the scheduler is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert ScrapeScheduler.is_enabled() is False
+
+    def test_is_enabled_from_env(self):
+        """Test enabling the scheduler from the environment"""
+        with patch.dict(os.environ, {"ENABLE_ADAPTIVE_SCHEDULER": "true"}):
+            assert ScrapeScheduler.is_enabled() is True
+
+    def test_parse_env_interval_overrides(self):
+        """Test parsing per-device interval overrides"""
+        env = {"WLED_SCRAPE_INTERVAL_OVERRIDES": "10.0.0.1=300, 10.0.0.2=15"}
+        with patch.dict(os.environ, env):
+            overrides = ScrapeScheduler.parse_env_interval_overrides()
+        assert overrides == {"10.0.0.1": 300.0, "10.0.0.2": 15.0}
+
+    def test_parse_env_interval_overrides_skips_invalid(self):
+        """Test that malformed overrides are skipped"""
+        env = {"WLED_SCRAPE_INTERVAL_OVERRIDES": "10.0.0.1,10.0.0.2=abc,x=5"}
+        with patch.dict(os.environ, env):
+            overrides = ScrapeScheduler.parse_env_interval_overrides()
+        assert overrides == {"x": 5.0}
+
+    def test_new_devices_are_due_immediately(self):
+        """Test that newly tracked devices are scraped right away"""
+        assert self.scheduler.pop_due() == ["10.0.0.1", "10.0.0.2"]
+
+    def test_success_reschedules_at_normal_interval(self):
+        """Test that a successful scrape waits the base interval"""
+        self.scheduler.record_success("10.0.0.1")
+        self.scheduler.record_success("10.0.0.2")
+        self.clock.advance(59)
+        assert self.scheduler.pop_due() == []
+        self.clock.advance(1)
+        assert self.scheduler.pop_due() == ["10.0.0.1", "10.0.0.2"]
+
+    def test_failures_back_off_exponentially(self):
+        """Test that consecutive failures double the interval"""
+        intervals = []
+        for _ in range(5):
+            self.scheduler.record_failure("10.0.0.1")
+            intervals.append(self.scheduler.get_backoff_interval("10.0.0.1"))
+        assert intervals == [120, 240, 480, 600, 600]
+
+    def test_success_resets_backoff(self):
+        """Test that a device comes back to the normal rate on success"""
+        self.scheduler.record_failure("10.0.0.1")
+        self.scheduler.record_failure("10.0.0.1")
+        self.scheduler.record_success("10.0.0.1")
+        entry = self.scheduler.get_entry("10.0.0.1")
+        assert entry.consecutive_failures == 0
+        assert entry.next_due == self.clock.now + 60
+
+    def test_backed_off_device_is_not_due(self):
+        """Test that an offline device is skipped until its backoff ends"""
+        self.scheduler.record_failure("10.0.0.1")
+        self.scheduler.record_success("10.0.0.2")
+        self.clock.advance(61)
+        assert self.scheduler.pop_due() == ["10.0.0.2"]
+        self.clock.advance(60)
+        assert "10.0.0.1" in self.scheduler.pop_due()
+
+    def test_interval_override(self):
+        """Test a per-device interval override"""
+        self.scheduler.set_interval_override("10.0.0.1", 300)
+        assert self.scheduler.get_interval("10.0.0.1") == 300
+        assert self.scheduler.get_interval("10.0.0.2") == 60
+        self.scheduler.record_failure("10.0.0.1")
+        # Backoff is capped, but never below the normal interval
+        assert self.scheduler.get_backoff_interval("10.0.0.1") == 600
+
+        self.scheduler.set_interval_override("10.0.0.1", None)
+        assert self.scheduler.get_interval("10.0.0.1") == 60
+
+    def test_overrides_from_constructor(self):
+        """Test overrides apply to devices tracked later"""
+        scheduler = ScrapeScheduler(
+            60, interval_overrides={"10.0.0.9": 10}, clock=self.clock
+        )
+        scheduler.sync_devices(["10.0.0.9"])
+        assert scheduler.get_interval("10.0.0.9") == 10
+
+    def test_sync_devices_drops_removed(self):
+        """Test that removed devices stop being scheduled"""
+        self.scheduler.sync_devices(["10.0.0.2", "10.0.0.3"])
+        assert sorted(self.scheduler.devices) == ["10.0.0.2", "10.0.0.3"]
+
+    def test_sync_devices_keeps_existing_state(self):
+        """Test that re-syncing doesn't reset a known device"""
+        self.scheduler.record_failure("10.0.0.1")
+        self.scheduler.sync_devices(["10.0.0.1", "10.0.0.2"])
+        assert self.scheduler.get_entry("10.0.0.1").consecutive_failures == 1
+
+    def test_pop_due_exports_queue_depth(self):
+        """Test that the queue depth gauge tracks due devices"""
+        self.scheduler.pop_due()
+        assert Metrics.SCHEDULER_QUEUE_DEPTH._value.get() == 2
+
+    def test_pop_due_orders_most_overdue_first(self):
+        """Test that the most overdue device is scraped first"""
+        self.scheduler.record_success("10.0.0.1")
+        self.clock.advance(10)
+        self.scheduler.record_success("10.0.0.2")
+        self.clock.advance(100)
+        assert self.scheduler.pop_due() == ["10.0.0.1", "10.0.0.2"]
+
+    def test_claim_releases_check(self):
+        """Test that releases are only checked at the base interval"""
+        assert self.scheduler.claim_releases_check() is True
+        self.clock.advance(30)
+        assert self.scheduler.claim_releases_check() is False
+        self.clock.advance(30)
+        assert self.scheduler.claim_releases_check() is True
+
+
+class TestScraperWithScheduler:
+    """Tests for scraping only the devices the scheduler says are due"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.scheduler = ScrapeScheduler(60, clock=self.clock)
+        self.scraper = Scraper(MagicMock())
+        self.ip_list = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+
+    @pytest.mark.asyncio
+    async def test_scrape_all_only_scrapes_due_devices(self):
+        """Test that failing devices are backed off between cycles"""
+        scraped = []
+
+        async def fake_scrape(device_ip, set_metrics=True):
+            scraped.append(device_ip)
+            if device_ip == "10.0.0.2":
+                raise ConnectionError("device offline")
+
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=self.ip_list
+        ), patch.object(
+            self.scraper, "scrape_instance", side_effect=fake_scrape
+        ):
+            await self.scraper.scrape_all_instances(
+                set_metrics=False, scheduler=self.scheduler
+            )
+            assert sorted(scraped) == self.ip_list
+
+            scraped.clear()
+            self.clock.advance(60)
+            await self.scraper.scrape_all_instances(
+                set_metrics=False, scheduler=self.scheduler
+            )
+            assert sorted(scraped) == ["10.0.0.1", "10.0.0.3"]
+
+        entry = self.scheduler.get_entry("10.0.0.2")
+        assert entry.consecutive_failures == 1
+
+    @pytest.mark.asyncio
+    async def test_perform_full_scrape_gates_releases(self):
+        """Test that releases aren't checked on every scheduler tick"""
+        with patch.object(
+            self.scraper, "scrape_all_instances"
+        ) as mock_all, patch.object(
+            self.scraper, "scrape_releases"
+        ) as mock_releases, patch.object(
+            Scraper, "should_scrape_releases", return_value=True
+        ):
+            await self.scraper.perform_full_scrape(scheduler=self.scheduler)
+            await self.scraper.perform_full_scrape(scheduler=self.scheduler)
+
+        assert mock_all.call_count == 2
+        mock_releases.assert_called_once()
@@ -0,0 +1,193 @@
+import copy
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from wled.models import Device
+
+from app.circuit_breaker import circuit_breakers
+from app.metrics import Metrics
+from app.scrape_tiers import ScrapeTier, TieredDeviceCache
+from app.wled_client import WLEDClient
+from tests.test_websocket_push import FAKE_JSON, FAKE_PRESETS
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeLED(object):
+    """Stands in for a connected WLED client, recording every request"""
+
+    def __init__(self):
+        self.data = copy.deepcopy(FAKE_JSON)
+        self.presets = copy.deepcopy(FAKE_PRESETS)
+        self.requests = []
+
+    async def update(self):
+        self.requests.append("update")
+        data = copy.deepcopy(self.data | {"presets": self.presets})
+        return Device.from_dict(data)
+
+    async def request(self, uri):
+        self.requests.append(uri)
+        responses = {
+            "/json/si": {
+                "state": self.data["state"],
+                "info": self.data["info"],
+            },
+            "/json/state": self.data["state"],
+            "/json/info": self.data["info"],
+            "/json/eff": self.data["effects"],
+            "/json/pal": self.data["palettes"],
+            "/presets.json": self.presets,
+        }
+        return copy.deepcopy(responses[uri])
+
+
+class TestTieredDeviceCache:
+    """Tests for refreshing state, info and catalog at their own pace"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.cache = TieredDeviceCache(clock=self.clock)
+        self.led = FakeLED()
+        self.env = patch.dict(
+            os.environ,
+            {
+                "WLED_STATE_SCRAPE_INTERVAL_SECONDS": "10",
+                "WLED_INFO_SCRAPE_INTERVAL_SECONDS": "60",
+                "WLED_CATALOG_SCRAPE_INTERVAL_SECONDS": "3600",
+            },
+        )
+        self.env.start()
+
+    def teardown_method(self):
+        self.env.stop()
+
+    def test_settings_defaults(self):
+        """Test tiering is opt-in with state on every scrape"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert TieredDeviceCache.is_enabled() is False
+            assert TieredDeviceCache.get_state_interval_seconds() == 0
+            assert TieredDeviceCache.get_info_interval_seconds() == 60
+            assert TieredDeviceCache.get_catalog_interval_seconds() == 3600
+
+    @pytest.mark.asyncio
+    async def test_first_update_is_full(self):
+        """Test that an unknown instance gets one full update"""
+        device = await self.cache.update(self.led, "10.0.0.1")
+        assert self.led.requests == ["update"]
+        assert device.state.brightness == 128
+        assert self.cache.get_entry("10.0.0.1").device is device
+
+    @pytest.mark.asyncio
+    async def test_only_due_tiers_are_fetched(self):
+        """Test that each tier is fetched on its own interval"""
+        await self.cache.update(self.led, "10.0.0.1")
+        self.led.requests.clear()
+
+        self.clock.advance(5)
+        await self.cache.update(self.led, "10.0.0.1")
+        assert self.led.requests == []
+
+        self.clock.advance(5)
+        self.led.data["state"]["bri"] = 42
+        device = await self.cache.update(self.led, "10.0.0.1")
+        assert self.led.requests == ["/json/state"]
+        assert device.state.brightness == 42
+
+        self.led.requests.clear()
+        self.clock.advance(50)
+        await self.cache.update(self.led, "10.0.0.1")
+        assert self.led.requests == ["/json/si"]
+
+        self.led.requests.clear()
+        self.clock.advance(3600)
+        await self.cache.update(self.led, "10.0.0.1")
+        assert self.led.requests == [
+            "/json/si",
+            "/presets.json",
+            "/json/eff",
+            "/json/pal",
+        ]
+
+    @pytest.mark.asyncio
+    async def test_preset_change_refetches_presets(self):
+        """Test that a new presets file time refetches presets early"""
+        await self.cache.update(self.led, "10.0.0.1")
+        self.led.requests.clear()
+
+        self.led.data["info"]["fs"]["pmt"] = 1700000000
+        self.led.presets["2"] = {"n": "Blue", "on": True, "seg": []}
+        self.clock.advance(60)
+        device = await self.cache.update(self.led, "10.0.0.1")
+
+        assert self.led.requests == ["/json/si", "/presets.json"]
+        assert sorted(device.presets) == [1, 2]
+
+    @pytest.mark.asyncio
+    async def test_firmware_change_refetches_effects(self):
+        """Test that a new effect count refetches the effect list"""
+        await self.cache.update(self.led, "10.0.0.1")
+        self.led.requests.clear()
+
+        self.led.data["info"]["fxcount"] = 2
+        self.led.data["effects"] = ["Solid", "Blink"]
+        self.clock.advance(60)
+        device = await self.cache.update(self.led, "10.0.0.1")
+
+        assert self.led.requests == ["/json/si", "/json/eff", "/json/pal"]
+        assert len(device.effects) == 2
+
+    @pytest.mark.asyncio
+    async def test_fetches_are_counted_per_tier(self):
+        """Test the tier fetch counter"""
+        fetches = Metrics.WLED_CLIENT_TIER_FETCHES.labels(
+            ip="10.0.0.9", tier=ScrapeTier.STATE.value
+        )
+        before = fetches._value.get()
+        await self.cache.update(self.led, "10.0.0.9")
+        self.clock.advance(10)
+        await self.cache.update(self.led, "10.0.0.9")
+        assert fetches._value.get() == before + 1
+
+    @pytest.mark.asyncio
+    async def test_remove_forgets_instance(self):
+        """Test that a removed instance gets a full update again"""
+        await self.cache.update(self.led, "10.0.0.1")
+        self.cache.remove("10.0.0.1")
+        self.led.requests.clear()
+        await self.cache.update(self.led, "10.0.0.1")
+        assert self.led.requests == ["update"]
+
+
+class TestWLEDClientTieredScrape:
+    """Tests for the tiered cache behind WLEDClient"""
+
+    def setup_method(self):
+        circuit_breakers.reset()
+
+    @pytest.mark.asyncio
+    @patch("app.wled_client.tiered_devices")
+    @patch("app.wled_client.WLED")
+    async def test_enabled_uses_tiered_cache(self, mock_wled, mock_tiers):
+        """Test that tiering replaces the full update when enabled"""
+        led = MagicMock()
+        mock_wled.return_value.__aenter__ = AsyncMock(return_value=led)
+        mock_wled.return_value.__aexit__ = AsyncMock(return_value=False)
+        mock_tiers.update = AsyncMock(return_value="device")
+
+        with patch.dict(os.environ, {"ENABLE_TIERED_SCRAPE": "true"}):
+            device = await WLEDClient().get_wled_instance_device("10.0.0.1")
+
+        assert device == "device"
+        mock_tiers.update.assert_awaited_once_with(led, "10.0.0.1")
+        led.update.assert_not_called()
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.metrics import Metrics
+from app.scraper import Scraper
+
+
+class TestScraperConcurrency:
+    """Tests for the bounded concurrent fan-out in scrape_all_instances"""
+
+    def setup_method(self):
+        self.scraper = Scraper(MagicMock())
+        self.ip_list = [f"192.168.1.{i}" for i in range(1, 9)]
+
+    def test_get_scrape_max_concurrency_default(self):
+        """Test the default max concurrency"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert Scraper.get_scrape_max_concurrency() == 10
+
+    def test_get_scrape_max_concurrency_custom(self):
+        """Test max concurrency from the environment"""
+        with patch.dict(os.environ, {"WLED_SCRAPE_MAX_CONCURRENCY": "4"}):
+            assert Scraper.get_scrape_max_concurrency() == 4
+
+    def test_get_scrape_max_concurrency_invalid(self):
+        """Test invalid values use the default and are floored at 1"""
+        for value, expected in [("nope", 10), ("0", 1), ("-3", 1)]:
+            with patch.dict(
+                os.environ, {"WLED_SCRAPE_MAX_CONCURRENCY": value}
+            ):
+                assert Scraper.get_scrape_max_concurrency() == expected
+
+    @pytest.mark.asyncio
+    async def test_scrape_all_respects_max_concurrency(self):
+        """Test that no more than the limit are scraped at once"""
+        in_flight = 0
+        max_seen = 0
+        scraped = []
+
+        async def fake_scrape(device_ip, set_metrics=True):
+            nonlocal in_flight, max_seen
+            in_flight += 1
+            max_seen = max(max_seen, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            scraped.append(device_ip)
+
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=self.ip_list
+        ), patch.object(
+            self.scraper, "scrape_instance", side_effect=fake_scrape
+        ), patch.dict(
+            os.environ, {"WLED_SCRAPE_MAX_CONCURRENCY": "3"}
+        ):
+            await self.scraper.scrape_all_instances(set_metrics=False)
+
+        assert max_seen == 3
+        assert sorted(scraped) == sorted(self.ip_list)
+
+    @pytest.mark.asyncio
+    async def test_scrape_all_cycle_tracks_slowest_device(self):
+        """Test that the cycle costs the slowest device, not the sum"""
+
+        async def fake_scrape(device_ip, set_metrics=True):
+            await asyncio.sleep(0.05)
+
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=self.ip_list
+        ), patch.object(
+            self.scraper, "scrape_instance", side_effect=fake_scrape
+        ), patch.dict(
+            os.environ, {"WLED_SCRAPE_MAX_CONCURRENCY": "10"}
+        ):
+            start = time.monotonic()
+            await self.scraper.scrape_all_instances(set_metrics=False)
+            elapsed = time.monotonic() - start
+
+        # Serially this would take 8 * 0.05 = 0.4s
+        assert elapsed < 0.2
+
+    @pytest.mark.asyncio
+    async def test_scrape_all_isolates_device_failures(self):
+        """Test that one failing device doesn't cancel the others"""
+        scraped = []
+
+        async def fake_scrape(device_ip, set_metrics=True):
+            if device_ip == "192.168.1.3":
+                raise ConnectionError("device offline")
+            await asyncio.sleep(0.01)
+            scraped.append(device_ip)
+
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=self.ip_list
+        ), patch.object(
+            self.scraper, "scrape_instance", side_effect=fake_scrape
+        ), patch.dict(
+            os.environ, {"WLED_SCRAPE_MAX_CONCURRENCY": "4"}
+        ):
+            await self.scraper.scrape_all_instances(set_metrics=True)
+
+        assert len(scraped) == len(self.ip_list) - 1
+        assert "192.168.1.3" not in scraped
+
+    @pytest.mark.asyncio
+    async def test_scrape_all_serial_mode(self):
+        """Test that a limit of 1 keeps the original serial order"""
+        scraped = []
+
+        async def fake_scrape(device_ip, set_metrics=True):
+            await asyncio.sleep(0)
+            scraped.append(device_ip)
+
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=self.ip_list
+        ), patch.object(
+            self.scraper, "scrape_instance", side_effect=fake_scrape
+        ), patch.dict(
+            os.environ, {"WLED_SCRAPE_MAX_CONCURRENCY": "1"}
+        ):
+            await self.scraper.scrape_all_instances(set_metrics=False)
+
+        assert scraped == self.ip_list
+
+
+class TestScrapeCycleDeadline:
+    """Tests for the hard deadline on a full scrape cycle"""
+
+    def setup_method(self):
+        self.scraper = Scraper(MagicMock())
+        self.ip_list = [f"192.168.2.{i}" for i in range(1, 5)]
+
+    def test_deadline_defaults_to_part_of_interval(self):
+        """Test the deadline defaults to 80% of the scrape interval"""
+        with patch.dict(os.environ, {}, clear=True), patch.object(
+            Scraper, "get_default_scrape_interval", return_value=60
+        ):
+            assert Scraper.get_scrape_cycle_deadline_seconds() == 48
+
+    def test_deadline_from_env(self):
+        """Test a custom deadline from the environment"""
+        with patch.dict(
+            os.environ, {"WLED_SCRAPE_CYCLE_DEADLINE_SECONDS": "20"}
+        ):
+            assert Scraper.get_scrape_cycle_deadline_seconds() == 20
+
+    @pytest.mark.asyncio
+    async def test_deadline_cancels_remaining_devices(self):
+        """Test that devices past the deadline are cancelled and reported"""
+        scraped = []
+
+        async def fake_scrape(device_ip, set_metrics=True):
+            if device_ip in ("192.168.2.3", "192.168.2.4"):
+                await asyncio.sleep(10)
+            scraped.append(device_ip)
+
+        def deadline_events(device_ip):
+            return Metrics.WLED_INSTANCE_SCRAPE_EVENTS_COUNTER.labels(
+                ip=device_ip, scrape_event="deadline_exceeded"
+            )._value.get()
+
+        before = {ip: deadline_events(ip) for ip in self.ip_list}
+        env = {
+            "WLED_SCRAPE_MAX_CONCURRENCY": "4",
+            "WLED_SCRAPE_CYCLE_DEADLINE_SECONDS": "0.1",
+        }
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=self.ip_list
+        ), patch.object(
+            self.scraper, "scrape_instance", side_effect=fake_scrape
+        ), patch.dict(
+            os.environ, env
+        ):
+            start = time.monotonic()
+            await self.scraper.scrape_all_instances(set_metrics=True)
+            elapsed = time.monotonic() - start
+
+        assert elapsed < 1
+        assert sorted(scraped) == ["192.168.2.1", "192.168.2.2"]
+        for device_ip in self.ip_list:
+            expected = 1 if device_ip not in scraped else 0
+            assert deadline_events(device_ip) == before[device_ip] + expected
+
+    @pytest.mark.asyncio
+    async def test_deadline_applies_to_serial_mode(self):
+        """Test that the serial loop is also bounded by the deadline"""
+
+        async def fake_scrape(device_ip, set_metrics=True):
+            await asyncio.sleep(10)
+
+        env = {
+            "WLED_SCRAPE_MAX_CONCURRENCY": "1",
+            "WLED_SCRAPE_CYCLE_DEADLINE_SECONDS": "0.05",
+        }
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=self.ip_list
+        ), patch.object(
+            self.scraper, "scrape_instance", side_effect=fake_scrape
+        ), patch.dict(
+            os.environ, env
+        ):
+            start = time.monotonic()
+            await self.scraper.scrape_all_instances(set_metrics=False)
+            assert time.monotonic() - start < 1
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.main import app, lifespan
+from app.scraper_daemon import ScraperDaemon
+from app.shared_metrics import SharedMetricsFile
+
+
+class TestScraperDaemon:
+    """Tests for the dedicated scraper process"""
+
+    def setup_method(self):
+        self.shared = MagicMock()
+        self.daemon = ScraperDaemon(shared=self.shared)
+        self.daemon.scraper = MagicMock()
+        self.daemon.scraper.perform_full_scrape = AsyncMock()
+
+    def test_is_enabled_default(self):
+        """Test the daemon mode is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert ScraperDaemon.is_enabled() is False
+
+    def test_daemon_mode_shares_metrics(self):
+        """Test workers serve the shared file when a daemon scrapes"""
+        environ = {"ENABLE_SCRAPER_DAEMON": "true"}
+        with patch.dict(os.environ, environ, clear=True):
+            assert SharedMetricsFile.is_enabled() is True
+
+    @pytest.mark.asyncio
+    async def test_run_once_scrapes_and_publishes(self):
+        """Test a cycle scrapes under the lock and publishes"""
+        with patch("app.scraper_daemon.lock_manager") as locks:
+            locks.try_acquire_lock.return_value = True
+            assert await self.daemon.run_once() is True
+        self.daemon.scraper.perform_full_scrape.assert_awaited_once()
+        self.shared.publish.assert_called_once_with()
+        locks.release_lock.assert_called_once_with("scraper", os.getpid())
+
+    @pytest.mark.asyncio
+    async def test_run_once_skips_when_locked(self):
+        """Test nothing is scraped while another process holds the lock"""
+        with patch("app.scraper_daemon.lock_manager") as locks:
+            locks.try_acquire_lock.return_value = False
+            assert await self.daemon.run_once() is False
+        self.daemon.scraper.perform_full_scrape.assert_not_awaited()
+        self.shared.publish.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_run_once_failure_keeps_last_snapshot(self):
+        """Test a failed scrape releases the lock without publishing"""
+        self.daemon.scraper.perform_full_scrape.side_effect = RuntimeError()
+        with patch("app.scraper_daemon.lock_manager") as locks:
+            locks.try_acquire_lock.return_value = True
+            assert await self.daemon.run_once() is False
+        self.shared.publish.assert_not_called()
+        locks.release_lock.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_run_until_stopped(self):
+        """Test the loop repeats until stopped, then cleans up"""
+        cycles = []
+
+        async def run_once():
+            cycles.append(1)
+            if len(cycles) == 3:
+                self.daemon.stop()
+
+        self.daemon.loop_interval = 0
+        with patch.object(self.daemon, "start", AsyncMock()), patch.object(
+            self.daemon, "close", AsyncMock()
+        ) as close, patch.object(
+            self.daemon, "run_once", side_effect=run_once
+        ), patch(
+            "app.scraper_daemon.Scraper.get_default_wait_first_interval",
+            return_value=0,
+        ):
+            await asyncio.wait_for(self.daemon.run(), timeout=5)
+        assert len(cycles) == 3
+        close.assert_awaited_once()
+
+
+class TestDaemonModeLifespan:
+    """Tests for the HTTP workers when a scraper daemon runs"""
+
+    @pytest.mark.asyncio
+    async def test_workers_skip_scrape_loop(self):
+        """Test workers neither scrape nor hold push connections"""
+        environ = {
+            "ENABLE_SCRAPER_DAEMON": "true",
+            "ENABLE_BACKGROUND_TASKS": "true",
+            "ENABLE_WEBSOCKET_PUSH": "true",
+        }
+        with patch.dict(os.environ, environ), patch(
+            "app.main.repeat_every"
+        ) as repeat_every, patch("app.main.Scraper") as scraper:
+            async with lifespan(app):
+                assert app.state.push_manager is None
+        repeat_every.assert_not_called()
+        scraper.get_client.return_value.perform_full_scrape.assert_not_called()
@@ -0,0 +1,184 @@
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.change_detection import PayloadSection, section_hashes
+from app.extraction import MetricExtractor
+from app.metrics import Metrics
+from app.scheduler import ScrapeScheduler
+from app.scrape_intervals import scrape_intervals
+from app.scraper import Scraper
+from tests.test_extraction import build_raw_device, extract_all
+from tests.test_snapshot import FakeClock
+
+
+def series_of(metric, name):
+    return [key for key in metric._metrics if name in key]
+
+
+def evicted(section):
+    return Metrics.WLED_SCRAPER_SERIES_EVICTED.labels(
+        section=section.value
+    )._value.get()
+
+
+class TestSeriesEviction:
+    """Tests for removing series a device stopped reporting"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.extractor = MetricExtractor(evict_series=True, clock=self.clock)
+
+    def scrape(self, raw_device, scrape_ip=None):
+        extract_all(self.extractor, raw_device)
+        self.extractor.finish_device(
+            raw_device.info["ip"], scrape_ip=scrape_ip
+        )
+
+    def test_is_enabled_default(self):
+        """Test eviction is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert MetricExtractor.is_eviction_enabled() is False
+
+    def test_renamed_preset_is_evicted(self):
+        """Test the series of a renamed preset are removed"""
+        raw_device = build_raw_device("EvictPreset")
+        self.scrape(raw_device)
+        before = evicted(PayloadSection.PRESETS)
+
+        raw_device.presets["1"]["n"] = "Crimson"
+        self.scrape(raw_device)
+
+        names = {
+            key[3]
+            for key in series_of(
+                Metrics.INSTANCE_PRESET_IS_ON_VALUE, "EvictPreset"
+            )
+        }
+        assert names == {"Crimson"}
+        assert not [
+            key
+            for key in series_of(
+                Metrics.INSTANCE_PRESET_QUICK_LABEL_INFO, "EvictPreset"
+            )
+            if "Red" in key
+        ]
+        # is on, transition and quick label of the old name
+        assert evicted(PayloadSection.PRESETS) == before + 3
+
+    def test_deleted_segment_is_evicted(self):
+        """Test a deleted segment takes its color series along"""
+        raw_device = build_raw_device("EvictSegment")
+        raw_device.state["seg"].append({"id": 1, "col": [[1, 2, 3]]})
+        self.scrape(raw_device)
+        raw_device.state["seg"].pop()
+        self.scrape(raw_device)
+
+        speed = series_of(Metrics.INSTANCE_SEGMENT_SPEED_VALUE, "EvictSegment")
+        colors = series_of(
+            Metrics.INSTANCE_SEGMENT_COLOR_VALUE, "EvictSegment"
+        )
+        assert [key[2] for key in speed] == ["0"]
+        assert {key[2] for key in colors} == {"0"}
+
+    def test_roamed_bssid_is_evicted(self):
+        """Test that only the current access point is exported"""
+        raw_device = build_raw_device("EvictBssid")
+        self.scrape(raw_device)
+        raw_device.info["wifi"]["bssid"] = "cc:dd"
+        self.scrape(raw_device)
+
+        bssids = series_of(Metrics.INSTANCE_WIFI_BSSID, "EvictBssid")
+        assert [key[2] for key in bssids] == ["cc:dd"]
+
+    def test_returning_series_is_exported_again(self):
+        """Test a segment that comes back binds a fresh child"""
+        raw_device = build_raw_device("EvictReturn")
+        segments = list(raw_device.state["seg"])
+        raw_device.state["seg"] = segments + [{"id": 1, "sx": 9}]
+        self.scrape(raw_device)
+        raw_device.state["seg"] = segments
+        self.scrape(raw_device)
+        raw_device.state["seg"] = segments + [{"id": 1, "sx": 9}]
+        self.scrape(raw_device)
+
+        speed = Metrics.INSTANCE_SEGMENT_SPEED_VALUE.labels(
+            ip="10.0.0.50", name="EvictReturn", segment=1
+        )
+        assert speed._value.get() == 9
+
+    def test_renamed_device_is_evicted(self):
+        """Test every series of the old device name is removed"""
+        self.scrape(build_raw_device("EvictOldName"))
+        self.scrape(build_raw_device("EvictNewName"))
+
+        for metric in Metrics.device_metrics():
+            assert series_of(metric, "EvictOldName") == []
+        assert series_of(Metrics.INSTANCE_FREE_HEAP, "EvictNewName")
+
+    def test_stale_device_is_evicted(self):
+        """Test a device that isn't scraped anymore is removed"""
+        self.scrape(build_raw_device("EvictStale"), scrape_ip="wled.local")
+        section_hashes.remember("wled.local", PayloadSection.INFO, b"x")
+
+        env = {
+            "WLED_STALE_DEVICE_SECONDS": "60",
+            "DEFAULT_WLED_INSTANCE_SCRAPE_INTERVAL_SECONDS": "10",
+        }
+        with patch.dict(os.environ, env):
+            assert self.extractor.evict_stale_devices() == []
+            self.clock.now += 61
+            assert self.extractor.evict_stale_devices() == ["10.0.0.50"]
+
+        assert series_of(Metrics.INSTANCE_FREE_HEAP, "EvictStale") == []
+        assert not section_hashes.is_unchanged(
+            "wled.local", PayloadSection.INFO, b"x"
+        )
+
+    def test_slow_device_kept_between_scrapes(self):
+        """Test a device is only stale after missing its own interval"""
+        self.scrape(build_raw_device("EvictSlow"), scrape_ip="wled.slow")
+        scheduler = ScrapeScheduler(60, interval_overrides={"wled.slow": 600})
+        scheduler.sync_devices(["wled.slow"])
+        scrape_intervals.use_scheduler(scheduler)
+        try:
+            with patch.dict(os.environ, {"WLED_STALE_DEVICE_SECONDS": "60"}):
+                self.clock.now += 600
+                assert self.extractor.evict_stale_devices() == []
+                self.clock.now += 1201
+                assert self.extractor.evict_stale_devices() == ["10.0.0.50"]
+        finally:
+            scrape_intervals.use_scheduler(None)
+
+    def test_disabled_keeps_series(self):
+        """Test that without eviction old series stay around"""
+        extractor = MetricExtractor()
+        raw_device = build_raw_device("KeepBssid")
+        extract_all(extractor, raw_device)
+        raw_device.info["wifi"]["bssid"] = "cc:dd"
+        extract_all(extractor, raw_device)
+
+        bssids = series_of(Metrics.INSTANCE_WIFI_BSSID, "KeepBssid")
+        assert len(bssids) == 2
+
+
+class TestScraperEviction:
+    """Tests for evicting stale devices at the end of a scrape cycle"""
+
+    @pytest.mark.asyncio
+    async def test_cycle_evicts_stale_devices(self):
+        """Test that the setting evicts stale devices every cycle"""
+        scraper = Scraper(MagicMock())
+        scraper._scrape_instances_bounded = AsyncMock()
+        extractor = MagicMock()
+        env = {
+            "ENABLE_STALE_SERIES_EVICTION": "true",
+            "WLED_IP_LIST": "10.0.0.1",
+        }
+        with patch.dict(os.environ, env), patch.object(
+            MetricExtractor, "get_extractor", return_value=extractor
+        ):
+            await scraper._scrape_all_instances_internal()
+
+        extractor.evict_stale_devices.assert_called_once_with()
@@ -0,0 +1,228 @@
+import multiprocessing
+import os
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    generate_latest,
+)
+from prometheus_client.parser import text_string_to_metric_families
+
+from app.exposition_cache import ExpositionCache
+from app.extraction import MetricExtractor
+from app.lock_manager import SQLiteLockManager
+from app.main import app
+from app.metrics import Metrics
+from app.shared_metrics import SharedMetricsFile, split_collectors
+from tests.test_extraction import build_raw_device, extract_all
+
+SHARED_NAME = Metrics.WLED_ACTIVE_SERIES._name
+COUNTER_NAME = Metrics.SCRAPER_FULL_SCRAPE_EXCEPTIONS._name
+
+
+def scrape_and_publish(path, device_name):
+    """Run in another process, like the worker holding the scraper lock"""
+    extract_all(MetricExtractor(), build_raw_device(device_name))
+    SharedMetricsFile(path).publish()
+
+
+class TestSharedMetricsFile:
+    """Tests for sharing the exporter metrics between workers"""
+
+    def setup_method(self):
+        self.registry = CollectorRegistry()
+        self.shared_gauge = Gauge(
+            SHARED_NAME,
+            "Shared",
+            ["name"],
+            registry=self.registry,
+        )
+        self.local_counter = Counter(
+            "http_requests", "Local", registry=self.registry
+        )
+        self.request_counter = Counter(
+            Metrics.REQUESTS_COALESCED._name,
+            "Request driven",
+            registry=self.registry,
+        )
+
+    def test_is_enabled_default(self):
+        """Test shared metrics are opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert SharedMetricsFile.is_enabled() is False
+
+    def test_default_path(self):
+        """Test the file goes to the Prometheus multiprocess directory"""
+        environ = {"PROMETHEUS_MULTIPROC_DIR": "/shared"}
+        with patch.dict(os.environ, environ, clear=True):
+            path = SharedMetricsFile.get_path()
+        assert path == "/shared/wargos_shared_metrics.prom"
+
+    def test_split_collectors(self):
+        """Test exporter metrics are shared and the rest stays local"""
+        shared, local = split_collectors(self.registry)
+        assert shared == [self.shared_gauge]
+        assert local == [self.local_counter, self.request_counter]
+
+    def test_split_registry(self):
+        """Test request driven exporter metrics stay with each worker"""
+        shared, local = split_collectors()
+        assert Metrics.INSTANCE_FREE_HEAP in shared
+        assert Metrics.SCRAPER_FULL_SCRAPE_TIME in shared
+        assert Metrics.REQUESTS_COALESCED in local
+        assert Metrics.BACKUP_OPERATIONS_TOTAL in local
+
+    def test_publish_and_render(self, tmp_path):
+        """Test a worker serves its own metrics and the published ones"""
+        path = str(tmp_path / "shared.prom")
+        self.shared_gauge.labels("Published").set(1)
+        SharedMetricsFile(path).publish(self.registry)
+        assert os.listdir(tmp_path) == ["shared.prom"]
+
+        reader_registry = CollectorRegistry()
+        Counter("http_requests", "Local", registry=reader_registry).inc(5)
+        Gauge(
+            SHARED_NAME,
+            "Shared",
+            ["name"],
+            registry=reader_registry,
+        ).labels("Never scraped here").set(1)
+        body = SharedMetricsFile(path).render(reader_registry).decode()
+
+        assert f'{SHARED_NAME}{{name="Published"}} 1.0' in body
+        assert "Never scraped here" not in body
+        assert "http_requests_total 5.0" in body
+        assert body.count(f"# TYPE {SHARED_NAME} gauge") == 1
+
+    def test_refresh_only_on_change(self, tmp_path):
+        """Test the file is only read again after it was replaced"""
+        path = str(tmp_path / "shared.prom")
+        writer = SharedMetricsFile(path)
+        reader = SharedMetricsFile(path)
+        assert reader.refresh() is False
+
+        writer.publish(self.registry)
+        assert reader.refresh() is True
+        assert reader.refresh() is False
+
+        self.shared_gauge.labels("New").set(2)
+        writer.publish(self.registry)
+        assert reader.refresh() is True
+        os.remove(path)
+        assert reader.refresh() is True
+        assert reader.render(self.registry).count(SHARED_NAME.encode()) == 0
+
+    def test_published_from_another_process(self, tmp_path):
+        """Test a worker serves devices scraped by another process"""
+        path = str(tmp_path / "shared.prom")
+        process = multiprocessing.get_context("fork").Process(
+            target=scrape_and_publish, args=(path, "Scraped Elsewhere")
+        )
+        process.start()
+        process.join(timeout=30)
+        assert process.exitcode == 0
+
+        body = SharedMetricsFile(path).render().decode()
+        assert 'name="Scraped Elsewhere"' in body
+        assert "process_cpu_seconds_total" in body
+
+
+class TestSharedMetricsWorkers:
+    """Tests for shared metrics with several workers taking the lock"""
+
+    def take_turns(self, tmp_path, turns=4):
+        """Two workers hold the scraper lock in turn, like the scrape loop
+        without leader election, returns what the first one serves"""
+        locks = SQLiteLockManager(db_path=str(tmp_path / "locks.db"))
+        path = str(tmp_path / "shared.prom")
+        workers = []
+        for worker_pid, increment in ((1, 10), (2, 1)):
+            registry = CollectorRegistry()
+            counter = Counter(COUNTER_NAME, "Counter", registry=registry)
+            workers.append((worker_pid, increment, registry, counter))
+        serving = SharedMetricsFile(path)
+        served = []
+        for turn in range(turns):
+            worker_pid, increment, registry, counter = workers[turn % 2]
+            assert locks.try_acquire_lock("scraper", worker_pid, 300)
+            counter.inc(increment)
+            if SharedMetricsFile.is_enabled():
+                SharedMetricsFile(path).publish(registry)
+            locks.release_lock("scraper", worker_pid)
+
+            registry = workers[0][2]
+            if SharedMetricsFile.is_enabled():
+                body = serving.render(registry)
+            else:
+                body = generate_latest(registry)
+            for family in text_string_to_metric_families(body.decode()):
+                served.extend(
+                    sample.value
+                    for sample in family.samples
+                    if sample.name == f"{COUNTER_NAME}_total"
+                )
+        return served
+
+    def test_requires_leader_election_with_workers(self):
+        """Test more than one worker needs leader election or a daemon"""
+        environ = {"ENABLE_SHARED_METRICS": "true", "WORKERS": "2"}
+        with patch.dict(os.environ, environ, clear=True):
+            assert SharedMetricsFile.is_enabled() is False
+        environ["ENABLE_LEADER_ELECTION"] = "true"
+        with patch.dict(os.environ, environ, clear=True):
+            assert SharedMetricsFile.is_enabled() is True
+        environ = {"ENABLE_SHARED_METRICS": "true", "WEB_CONCURRENCY": "1"}
+        with patch.dict(os.environ, environ, clear=True):
+            assert SharedMetricsFile.is_enabled() is True
+        environ = {"ENABLE_SCRAPER_DAEMON": "true", "WORKERS": "2"}
+        with patch.dict(os.environ, environ, clear=True):
+            assert SharedMetricsFile.is_enabled() is True
+
+    def test_counters_never_go_back_with_a_moving_lock(self, tmp_path):
+        """Test each worker serves its own counters when the lock moves"""
+        environ = {"ENABLE_SHARED_METRICS": "true", "WORKERS": "2"}
+        with patch.dict(os.environ, environ, clear=True):
+            served = self.take_turns(tmp_path)
+        assert served == [10.0, 10.0, 20.0, 20.0]
+
+    def test_moving_lock_would_publish_counters_backwards(self, tmp_path):
+        """Test why sharing is refused, holders overwrite each other"""
+        environ = {"ENABLE_SHARED_METRICS": "true", "WORKERS": "2"}
+        with patch.dict(os.environ, environ, clear=True), patch.object(
+            SharedMetricsFile, "can_run_in_workers", return_value=True
+        ):
+            served = self.take_turns(tmp_path)
+        assert served == [10.0, 1.0, 20.0, 2.0]
+
+
+class TestSharedMetricsEndpoint:
+    """Tests for /metrics in shared mode"""
+
+    def test_metrics_serves_shared_file(self, tmp_path):
+        """Test /metrics renders the published file in every mode"""
+        path = str(tmp_path / "shared.prom")
+        with open(path, "wb") as shared_file:
+            shared_file.write(b"wargos_published_marker 1.0\n")
+        reader = SharedMetricsFile(path)
+        environ = {"ENABLE_SHARED_METRICS": "true"}
+        client = TestClient(app)
+        with patch("app.main.shared_metrics", reader), patch(
+            "app.shared_metrics.shared_metrics", reader
+        ), patch.dict(os.environ, environ):
+            plain = client.get("/metrics")
+            environ["ENABLE_EXPOSITION_CACHE"] = "true"
+            with patch.dict(os.environ, environ), patch(
+                "app.main.exposition_cache", ExpositionCache()
+            ):
+                cached = client.get("/metrics")
+                with open(path + ".new", "wb") as shared_file:
+                    shared_file.write(b"wargos_published_marker 2.0\n")
+                os.replace(path + ".new", path)
+                refreshed = client.get("/metrics")
+
+        assert "wargos_published_marker 1.0" in plain.text
+        assert "wargos_published_marker 1.0" in cached.text
+        assert "wargos_published_marker 2.0" in refreshed.text
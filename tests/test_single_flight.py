@@ -0,0 +1,196 @@
+import asyncio
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.main import backup_configs_all, prometheus_scrape_all
+from app.scraper import Scraper
+from app.single_flight import SingleFlight, coalesce
+
+ENABLED = {"ENABLE_REQUEST_COALESCING": "true"}
+
+
+def coalesced_count(operation):
+    value = REGISTRY.get_sample_value(
+        "wargos_requests_coalesced_total", {"operation": operation}
+    )
+    return value or 0
+
+
+class SlowOperation:
+    """Counts runs, each one lasting until released"""
+
+    def __init__(self, result="done"):
+        self.runs = 0
+        self.result = result
+        self.release = asyncio.Event()
+
+    async def __call__(self, *args):
+        self.runs += 1
+        await self.release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+class TestSingleFlight:
+    """Tests for coalescing identical operations in flight"""
+
+    def setup_method(self):
+        self.flight = SingleFlight()
+
+    def test_is_enabled_default(self):
+        """Test coalescing is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert SingleFlight.is_enabled() is False
+
+    @pytest.mark.asyncio
+    async def test_concurrent_callers_share_one_run(self):
+        """Test callers in flight wait for the one run and its result"""
+        operation = SlowOperation(result=["result"])
+        before = coalesced_count("test_share")
+        callers = [
+            asyncio.ensure_future(
+                self.flight.run("test_share", "all", operation)
+            )
+            for _ in range(5)
+        ]
+        await settle()
+        operation.release.set()
+        results = await asyncio.gather(*callers)
+        assert operation.runs == 1
+        assert all(result is results[0] for result in results)
+        assert coalesced_count("test_share") == before + 4
+        assert not self.flight.is_in_flight("test_share", "all")
+
+    @pytest.mark.asyncio
+    async def test_sequential_calls_run_again(self):
+        """Test a finished run is not reused by later callers"""
+        operation = SlowOperation()
+        operation.release.set()
+        await self.flight.run("test_sequential", "all", operation)
+        await self.flight.run("test_sequential", "all", operation)
+        assert operation.runs == 2
+
+    @pytest.mark.asyncio
+    async def test_keys_are_independent(self):
+        """Test different operations or targets don't coalesce"""
+        operation = SlowOperation()
+        callers = [
+            asyncio.ensure_future(self.flight.run(*key, operation))
+            for key in [("a", "1"), ("a", "2"), ("b", "1")]
+        ]
+        await settle()
+        operation.release.set()
+        await asyncio.gather(*callers)
+        assert operation.runs == 3
+
+    @pytest.mark.asyncio
+    async def test_exception_reaches_every_caller(self):
+        """Test a failed run fails all its callers, then is forgotten"""
+        operation = SlowOperation(result=RuntimeError("device down"))
+        callers = [
+            asyncio.ensure_future(
+                self.flight.run("test_error", "all", operation)
+            )
+            for _ in range(3)
+        ]
+        await settle()
+        operation.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert not self.flight.is_in_flight("test_error", "all")
+
+    @pytest.mark.asyncio
+    async def test_cancelled_caller_keeps_run_going(self):
+        """Test a caller going away doesn't cancel the others' run"""
+        operation = SlowOperation()
+        first = asyncio.ensure_future(
+            self.flight.run("test_cancel", "all", operation)
+        )
+        second = asyncio.ensure_future(
+            self.flight.run("test_cancel", "all", operation)
+        )
+        await settle()
+        first.cancel()
+        await settle()
+        operation.release.set()
+        assert await second == "done"
+
+    @pytest.mark.asyncio
+    async def test_coalesce_disabled(self):
+        """Test every call runs while coalescing is off"""
+        operation = SlowOperation()
+        operation.release.set()
+        with patch.dict(os.environ, {}, clear=True):
+            await asyncio.gather(
+                coalesce("test_off", "all", operation),
+                coalesce("test_off", "all", operation),
+            )
+        assert operation.runs == 2
+
+
+class TestCoalescedEndpoints:
+    """Tests for the on demand endpoints sharing work"""
+
+    @pytest.mark.asyncio
+    async def test_prometheus_all(self):
+        """Test concurrent /prometheus/all share one scrape round"""
+        operation = SlowOperation()
+        scraper = MagicMock(scrape_all_instances=operation)
+        with patch.dict(os.environ, ENABLED), patch(
+            "app.main.Scraper.get_client", return_value=scraper
+        ):
+            requests = [
+                asyncio.ensure_future(prometheus_scrape_all())
+                for _ in range(3)
+            ]
+            await settle()
+            operation.release.set()
+            await asyncio.gather(*requests)
+        assert operation.runs == 1
+
+    @pytest.mark.asyncio
+    async def test_config_backup_all(self):
+        """Test concurrent backups share their results"""
+        operation = SlowOperation(result=[{"status": "success"}])
+        scraper = MagicMock(backup_configs_from_all_instances=operation)
+        scraper.get_config_backup_dir.return_value = "/backups"
+        with patch.dict(os.environ, ENABLED), patch(
+            "app.main.Scraper.get_client", return_value=scraper
+        ):
+            requests = [
+                asyncio.ensure_future(backup_configs_all()) for _ in range(2)
+            ]
+            await settle()
+            operation.release.set()
+            responses = await asyncio.gather(*requests)
+        assert operation.runs == 1
+        assert responses[0]["results"] == [{"status": "success"}]
+        assert responses[1]["results"] == [{"status": "success"}]
+
+    @pytest.mark.asyncio
+    async def test_background_scrape_is_joined(self):
+        """Test /prometheus/all joins a background full scrape"""
+        operation = SlowOperation()
+        scraper = Scraper(MagicMock())
+        scraper.scrape_self = MagicMock()
+        scraper.should_scrape_releases = MagicMock(return_value=False)
+        scraper.scrape_all_instances = operation
+        with patch.dict(os.environ, ENABLED), patch(
+            "app.main.Scraper.get_client", return_value=scraper
+        ):
+            background = asyncio.ensure_future(scraper.perform_full_scrape())
+            await settle()
+            request = asyncio.ensure_future(prometheus_scrape_all())
+            await settle()
+            operation.release.set()
+            await asyncio.gather(background, request)
+        assert operation.runs == 1
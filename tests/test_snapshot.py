@@ -0,0 +1,204 @@
+import os
+from unittest.mock import patch
+
+from prometheus_client import CollectorRegistry, generate_latest
+
+from app.change_detection import PayloadSection
+from app.extraction import METRIC_SPECS, MetricExtractor
+from app.metrics import Metrics, register_snapshot_collector
+from app.scheduler import ScrapeScheduler
+from app.scrape_intervals import scrape_intervals
+from app.snapshot import (
+    DeviceSnapshotCollector,
+    DeviceSnapshotStore,
+    device_snapshots,
+)
+from tests.test_extraction import build_raw_device, extract_all
+from tests.test_raw_scraper import collect_samples
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeviceSnapshotStore:
+    """Tests for the per device snapshot records"""
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.store = DeviceSnapshotStore(clock=self.clock)
+
+    def test_is_enabled_default(self):
+        """Test snapshot exposition is opt-in"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert DeviceSnapshotStore.is_enabled() is False
+
+    def test_publish_replaces_record(self):
+        """Test that publishing swaps in a new record for the device"""
+        first = self.store.publish("10.0.0.1", {"a": ()})
+        second = self.store.publish("10.0.0.1", {"b": ()})
+        assert self.store.get("10.0.0.1") is second
+        assert first.samples == {"a": ()}
+
+    def test_records_are_copied_on_write(self):
+        """Test that a collect in progress keeps iterating its records"""
+        self.store.publish("10.0.0.1", {})
+        records = self.store._records
+        self.store.publish("10.0.0.2", {})
+        self.store.remove("10.0.0.1")
+        assert list(records) == ["10.0.0.1"]
+        assert list(self.store._records) == ["10.0.0.2"]
+
+    def test_stale_records_are_not_fresh(self):
+        """Test that devices not scraped within the max age drop out"""
+        self.store.publish("10.0.0.1", {})
+        self.clock.now += 100
+        self.store.publish("10.0.0.2", {})
+        env = {
+            "WLED_SNAPSHOT_MAX_AGE_SECONDS": "60",
+            "DEFAULT_WLED_INSTANCE_SCRAPE_INTERVAL_SECONDS": "10",
+        }
+        with patch.dict(os.environ, env):
+            fresh = self.store.get_fresh_records()
+        assert [record.device_ip for record in fresh] == ["10.0.0.2"]
+
+    def test_slow_device_fresh_between_scrapes(self):
+        """Test a device is only dropped after missing its own interval"""
+        scheduler = ScrapeScheduler(60, interval_overrides={"10.0.0.1": 600})
+        scheduler.sync_devices(["10.0.0.1", "10.0.0.2"])
+        self.store.publish("10.0.0.1", {})
+        self.store.publish("10.0.0.2", {})
+        self.clock.now += 600
+        scrape_intervals.use_scheduler(scheduler)
+        try:
+            env = {"WLED_SNAPSHOT_MAX_AGE_SECONDS": "60"}
+            with patch.dict(os.environ, env):
+                fresh = self.store.get_fresh_records()
+                assert [record.device_ip for record in fresh] == ["10.0.0.1"]
+                self.clock.now += 1201
+                assert self.store.get_fresh_records() == []
+        finally:
+            scrape_intervals.use_scheduler(None)
+
+
+class TestSnapshotExposition:
+    """Tests for rendering device metrics from snapshots"""
+
+    def setup_method(self):
+        self.store = DeviceSnapshotStore()
+        self.extractor = MetricExtractor(snapshots=self.store)
+        self.registry = CollectorRegistry()
+        self.registry.register(
+            DeviceSnapshotCollector(self.store, Metrics.device_metrics())
+        )
+
+    def scrape(self, raw_device):
+        extract_all(self.extractor, raw_device)
+        return self.extractor.finish_device(raw_device.info["ip"])
+
+    def render(self):
+        return generate_latest(self.registry).decode()
+
+    def test_snapshot_matches_gauges(self):
+        """Test snapshots export exactly what the gauges would"""
+        extract_all(MetricExtractor(), build_raw_device("SnapGauge"))
+        self.scrape(build_raw_device("SnapStore"))
+
+        rendered = set()
+        for metric in self.registry.collect():
+            for sample in metric.samples:
+                labels = dict(sample.labels)
+                assert labels.pop("name") == "SnapStore"
+                rendered.add(
+                    (sample.name, tuple(sorted(labels.items())), sample.value)
+                )
+        assert rendered == collect_samples("SnapGauge")
+
+    def test_gauges_are_left_alone(self):
+        """Test that snapshot mode doesn't touch the global gauges"""
+        self.scrape(build_raw_device("SnapOnly"))
+        assert collect_samples("SnapOnly") == set()
+        assert 'name="SnapOnly"' in self.render()
+
+    def test_removed_segment_drops_out(self):
+        """Test series of a removed segment vanish with the next record"""
+        raw_device = build_raw_device("SnapSegments")
+        raw_device.state["seg"].append({"id": 1, "sx": 5})
+        self.scrape(raw_device)
+        assert 'segment="1"' in self.render()
+
+        self.scrape(build_raw_device("SnapSegments"))
+        assert 'segment="1"' not in self.render()
+        assert 'segment="0"' in self.render()
+
+    def test_skipped_section_keeps_its_samples(self):
+        """Test a record keeps sections that weren't extracted again"""
+        raw_device = build_raw_device("SnapPartial")
+        self.scrape(raw_device)
+        raw_device.state["bri"] = 7
+        self.extractor.extract_section(
+            PayloadSection.STATE,
+            raw_device.info,
+            raw_device.state,
+            raw_device.presets,
+        )
+        snapshot = self.extractor.finish_device("10.0.0.50")
+
+        assert snapshot.samples[Metrics.INSTANCE_STATE_BRIGHTNESS] == (
+            (("SnapPartial", "10.0.0.50"), 7.0),
+        )
+        assert Metrics.INSTANCE_PRESET_COUNT_VALUE in snapshot.samples
+
+    def test_unpublished_changes_are_not_exported(self):
+        """Test a scrape in progress isn't visible before it's published"""
+        raw_device = build_raw_device("SnapAtomic")
+        self.scrape(raw_device)
+        raw_device.state["bri"] = 9
+        self.extractor.extract_section(
+            PayloadSection.STATE,
+            raw_device.info,
+            raw_device.state,
+            raw_device.presets,
+        )
+        assert 'brightness{ip="10.0.0.50",name="SnapAtomic"} 128.0' in (
+            self.render()
+        )
+
+    def test_removed_device_drops_out(self):
+        """Test that a device without a record isn't exported"""
+        self.scrape(build_raw_device("SnapGone"))
+        self.store.remove("10.0.0.50")
+        assert "SnapGone" not in self.render()
+
+    def test_register_replaces_gauges(self):
+        """Test the collector takes over the names of the gauges"""
+        registry = CollectorRegistry()
+        for metric in Metrics.device_metrics():
+            registry.register(metric)
+        store = DeviceSnapshotStore()
+        register_snapshot_collector(store, registry=registry)
+
+        extractor = MetricExtractor(snapshots=store)
+        extract_all(extractor, build_raw_device("SnapRegistered"))
+        extractor.finish_device("10.0.0.50")
+
+        rendered = generate_latest(registry).decode()
+        assert rendered.count("# TYPE wargos_wled_instance_free_heap ") == 1
+        assert 'name="SnapRegistered"' in rendered
+
+    def test_get_extractor_uses_global_store(self):
+        """Test the setting switches the shared extractor to snapshots"""
+        with patch.dict(os.environ, {"ENABLE_SNAPSHOT_METRICS": "true"}):
+            extractor = MetricExtractor.get_extractor()
+        assert extractor._snapshots is device_snapshots
+        assert MetricExtractor.get_extractor()._snapshots is None
+
+    def test_device_metrics_cover_the_specs(self):
+        """Test every extracted metric is exported from snapshots"""
+        assert {spec.metric for spec in METRIC_SPECS} == set(
+            Metrics.device_metrics()
+        )
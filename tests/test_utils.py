@@ -2,7 +2,7 @@ import unittest
 import logging
 import os
 from unittest.mock import patch
-from app.utils import LogHelper
+from app.utils import EnvHelper, LogHelper
 
 
 class TestUtils(unittest.TestCase):
@@ -87,5 +87,48 @@ class TestUtils(unittest.TestCase):
             self.assertEqual(logger.level, logging.INFO)
 
 
+class TestEnvHelper(unittest.TestCase):
+    @patch.dict(os.environ, {"SOME_FLAG": "Yes"})
+    def test_get_bool_truthy(self):
+        """Test that truthy values are parsed case-insensitively"""
+        self.assertTrue(EnvHelper.get_bool("SOME_FLAG"))
+
+    @patch.dict(os.environ, {"SOME_FLAG": "off"})
+    def test_get_bool_falsy(self):
+        """Test that anything else is False"""
+        self.assertFalse(EnvHelper.get_bool("SOME_FLAG"))
+
+    def test_get_bool_default(self):
+        """Test that a missing env var uses the default"""
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertTrue(EnvHelper.get_bool("SOME_FLAG"))
+            self.assertFalse(EnvHelper.get_bool("SOME_FLAG", "false"))
+
+    @patch.dict(os.environ, {"SOME_INT": "12"})
+    def test_get_int(self):
+        """Test that ints are parsed from the env"""
+        self.assertEqual(EnvHelper.get_int("SOME_INT", 3), 12)
+
+    @patch.dict(os.environ, {"SOME_INT": "twelve"})
+    def test_get_int_invalid_uses_default(self):
+        """Test that invalid ints fall back to the default"""
+        self.assertEqual(EnvHelper.get_int("SOME_INT", 3), 3)
+
+    @patch.dict(os.environ, {"SOME_INT": "-5"})
+    def test_get_int_minimum(self):
+        """Test that ints are floored at the minimum"""
+        self.assertEqual(EnvHelper.get_int("SOME_INT", 3, minimum=0), 0)
+
+    @patch.dict(os.environ, {"SOME_FLOAT": "2.5"})
+    def test_get_float(self):
+        """Test that floats are parsed from the env"""
+        self.assertEqual(EnvHelper.get_float("SOME_FLOAT", 1), 2.5)
+
+    @patch.dict(os.environ, {"SOME_FLOAT": "fast"})
+    def test_get_float_invalid_uses_default(self):
+        """Test that invalid floats fall back to the default"""
+        self.assertEqual(EnvHelper.get_float("SOME_FLOAT", 1.5), 1.5)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,342 @@
+import asyncio
+import copy
+import os
+import socket
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+from app.metrics import Metrics
+from app.scraper import Scraper
+from app.websocket_push import WebSocketPushManager
+from app.wled_client import WLEDClient
+
+FAKE_HOST = "fake-wled.test"
+
+FAKE_JSON = {
+    "info": {
+        "ver": "0.14.0",
+        "vid": 2310130,
+        "leds": {
+            "count": 30,
+            "fps": 40,
+            "pwr": 120,
+            "maxpwr": 850,
+            "maxseg": 16,
+        },
+        "name": "Fake",
+        "udpport": 21324,
+        "live": False,
+        "ws": 1,
+        "fxcount": 100,
+        "palcount": 50,
+        "arch": "esp32",
+        "core": "v3",
+        "freeheap": 100000,
+        "uptime": 100,
+        "brand": "WLED",
+        "product": "FOSS",
+        "mac": "aabbccddeeff",
+        "ip": "10.0.0.50",
+        "wifi": {"bssid": "aa:bb", "rssi": -60, "signal": 80, "channel": 6},
+        "fs": {"u": 10, "t": 100, "pmt": 0},
+    },
+    "state": {
+        "on": True,
+        "bri": 128,
+        "transition": 7,
+        "ps": -1,
+        "pl": -1,
+        "lor": 0,
+        "nl": {"on": False, "dur": 60, "tbri": 0, "mode": 1},
+        "udpn": {"send": False, "recv": True, "sgrp": 1, "rgrp": 1},
+        "seg": [
+            {
+                "id": 0,
+                "start": 0,
+                "stop": 30,
+                "len": 30,
+                "col": [[255, 0, 0], [0, 0, 0], [0, 0, 0]],
+                "fx": 0,
+                "sx": 128,
+                "ix": 128,
+                "pal": 0,
+                "sel": True,
+                "rev": False,
+                "on": True,
+                "bri": 255,
+                "cln": -1,
+                "cct": 127,
+            }
+        ],
+    },
+    "effects": ["Solid"],
+    "palettes": ["Default"],
+}
+
+FAKE_PRESETS = {
+    "0": {},
+    "1": {"n": "Red", "on": True, "transition": 7, "mainseg": 0, "seg": []},
+}
+
+
+class FakeResolver(AbstractResolver):
+    """Resolves every hostname to the local fake WLED server"""
+
+    def __init__(self, port):
+        self._port = port
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [
+            {
+                "hostname": host,
+                "host": "127.0.0.1",
+                "port": self._port,
+                "family": socket.AF_INET,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            }
+        ]
+
+    async def close(self):
+        pass
+
+
+class FakeWLEDServer(object):
+    """Serves /json, /presets.json and pushes state over /ws like WLED"""
+
+    def __init__(self):
+        self.data = copy.deepcopy(FAKE_JSON)
+        self.presets = copy.deepcopy(FAKE_PRESETS)
+        self.websockets = []
+        self.ws_connections = 0
+        self.presets_requests = 0
+
+    async def handle_json(self, request):
+        return web.json_response(self.data)
+
+    async def handle_presets(self, request):
+        self.presets_requests += 1
+        return web.json_response(self.presets)
+
+    async def handle_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.ws_connections += 1
+        self.websockets.append(ws)
+        async for _ in ws:
+            pass
+        return ws
+
+    async def push_state(self, **state):
+        self.data["state"].update(state)
+        message = {"state": self.data["state"], "info": self.data["info"]}
+        for ws in list(self.websockets):
+            await ws.send_json(message)
+
+    async def drop_connections(self):
+        websockets, self.websockets = self.websockets, []
+        for ws in websockets:
+            await ws.close()
+
+    @asynccontextmanager
+    async def running(self):
+        app = web.Application()
+        app.router.add_get("/json", self.handle_json)
+        app.router.add_get("/presets.json", self.handle_presets)
+        app.router.add_get("/ws", self.handle_ws)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        connector = aiohttp.TCPConnector(resolver=FakeResolver(port))
+        session = aiohttp.ClientSession(connector=connector)
+        try:
+            yield session
+        finally:
+            await self.drop_connections()
+            await session.close()
+            await runner.cleanup()
+
+
+async def wait_for(condition, timeout=5):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def brightness_gauge():
+    return Metrics.INSTANCE_STATE_BRIGHTNESS.labels(
+        ip="10.0.0.50", name="Fake"
+    )._value.get()
+
+
+class TestWebSocketPushManager:
+    """Tests for push mode against a fake WLED WebSocket server"""
+
+    def test_settings_defaults(self):
+        """Test push mode is opt-in with a 1s to 60s reconnect backoff"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert WebSocketPushManager.is_enabled() is False
+            assert WebSocketPushManager.get_reconnect_min_seconds() == 1
+            assert WebSocketPushManager.get_reconnect_max_seconds() == 60
+
+    def test_reconnect_delay_backs_off(self):
+        """Test the reconnect delay doubles up to the maximum"""
+        manager = WebSocketPushManager(
+            MagicMock(), reconnect_min=1, reconnect_max=10
+        )
+        delays = [manager.get_reconnect_delay(n) for n in range(1, 7)]
+        assert delays == [1, 2, 4, 8, 10, 10]
+
+    @pytest.mark.asyncio
+    async def test_pushed_state_updates_gauges(self):
+        """Test that gauges follow state pushed over the WebSocket"""
+        server = FakeWLEDServer()
+        async with server.running() as session:
+            manager = WebSocketPushManager(Scraper.get_client(session=session))
+            manager.sync_devices([FAKE_HOST])
+            try:
+                await wait_for(lambda: manager.is_connected(FAKE_HOST))
+                await wait_for(lambda: server.websockets)
+                assert brightness_gauge() == 128
+
+                await server.push_state(bri=42)
+                await wait_for(lambda: brightness_gauge() == 42)
+
+                connected = Metrics.WLED_PUSH_CONNECTED.labels(ip=FAKE_HOST)
+                assert connected._value.get() == 1
+                online = Metrics.WLED_INSTANCE_ONLINE.labels(ip=FAKE_HOST)
+                assert online._value.get() == 1
+            finally:
+                await manager.stop()
+
+        assert not manager.is_connected(FAKE_HOST)
+        connected = Metrics.WLED_PUSH_CONNECTED.labels(ip=FAKE_HOST)
+        assert connected._value.get() == 0
+
+    @pytest.mark.asyncio
+    async def test_reconnects_after_connection_lost(self):
+        """Test that a dropped WebSocket is opened again"""
+        server = FakeWLEDServer()
+        reconnects = Metrics.WLED_PUSH_RECONNECTS.labels(ip=FAKE_HOST)
+        before = reconnects._value.get()
+        async with server.running() as session:
+            manager = WebSocketPushManager(
+                Scraper.get_client(session=session),
+                reconnect_min=0.01,
+                reconnect_max=0.05,
+            )
+            manager.sync_devices([FAKE_HOST])
+            try:
+                await wait_for(lambda: server.ws_connections == 1)
+                await server.drop_connections()
+                await wait_for(lambda: server.ws_connections == 2)
+                await wait_for(lambda: manager.is_connected(FAKE_HOST))
+
+                await server.push_state(bri=7)
+                await wait_for(lambda: brightness_gauge() == 7)
+            finally:
+                await manager.stop()
+        assert reconnects._value.get() == before + 1
+
+    @pytest.mark.asyncio
+    async def test_refresh_presets_polls_over_http(self):
+        """Test that presets, which aren't pushed, are polled"""
+        server = FakeWLEDServer()
+        async with server.running() as session:
+            manager = WebSocketPushManager(Scraper.get_client(session=session))
+            assert await manager.refresh_presets(FAKE_HOST) is False
+
+            manager.sync_devices([FAKE_HOST])
+            try:
+                await wait_for(lambda: manager.is_connected(FAKE_HOST))
+                requests_before = server.presets_requests
+                server.presets["2"] = {"n": "Blue", "on": True, "seg": []}
+
+                assert await manager.refresh_presets(FAKE_HOST) is True
+            finally:
+                await manager.stop()
+
+        assert server.presets_requests == requests_before + 1
+        preset_count = Metrics.INSTANCE_PRESET_COUNT_VALUE.labels(
+            name="Fake", ip="10.0.0.50"
+        )
+        assert preset_count._value.get() == 2
+
+    @pytest.mark.asyncio
+    async def test_unreachable_device_backs_off(self):
+        """Test that failed connections wait longer each time"""
+        delays = []
+
+        async def fake_sleep(delay):
+            delays.append(delay)
+            if len(delays) == 4:
+                raise asyncio.CancelledError()
+
+        scraper = Scraper(MagicMock())
+        scraper.wled_client.listen_wled_instance = AsyncMock(
+            side_effect=ConnectionError("unreachable")
+        )
+        manager = WebSocketPushManager(
+            scraper, reconnect_min=1, reconnect_max=5, sleep=fake_sleep
+        )
+        manager.sync_devices(["10.9.8.7"])
+        await asyncio.gather(*manager._tasks.values(), return_exceptions=True)
+
+        assert delays == [1, 2, 4, 5]
+        assert not manager.is_connected("10.9.8.7")
+
+    @pytest.mark.asyncio
+    async def test_sync_devices_stops_removed(self):
+        """Test that removed instances stop being listened to"""
+
+        async def fake_listen(device_ip, callback):
+            await asyncio.sleep(10)
+
+        scraper = Scraper(MagicMock())
+        scraper.wled_client.listen_wled_instance = fake_listen
+        manager = WebSocketPushManager(scraper)
+        manager.sync_devices(["10.9.8.1", "10.9.8.2"])
+        task = manager._tasks["10.9.8.1"]
+
+        manager.sync_devices(["10.9.8.2"])
+        await asyncio.gather(task, return_exceptions=True)
+
+        assert task.cancelled()
+        assert manager.devices == ["10.9.8.2"]
+        await manager.stop()
+
+
+class TestScraperWithPushManager:
+    """Tests for polling only what isn't pushed in push mode"""
+
+    @pytest.mark.asyncio
+    async def test_connected_devices_only_poll_presets(self):
+        """Test that pushed instances skip the full HTTP scrape"""
+        push_manager = MagicMock()
+        push_manager.is_connected.side_effect = lambda ip: ip == "10.0.0.1"
+        push_manager.refresh_presets = AsyncMock(return_value=True)
+        scraper = Scraper(MagicMock(), push_manager=push_manager)
+        ip_list = ["10.0.0.1", "10.0.0.2"]
+
+        with patch.object(
+            Scraper, "parse_env_wled_ip_list", return_value=ip_list
+        ), patch.object(scraper, "scrape_instance") as mock_scrape:
+            await scraper.scrape_all_instances(set_metrics=False)
+
+        push_manager.sync_devices.assert_called_once_with(ip_list)
+        push_manager.refresh_presets.assert_awaited_once_with("10.0.0.1")
+        mock_scrape.assert_awaited_once_with("10.0.0.2", set_metrics=False)
+
+    def test_get_client_passes_push_manager(self):
+        """Test that Scraper.get_client threads the push manager through"""
+        push_manager = MagicMock()
+        scraper = Scraper.get_client(push_manager=push_manager)
+        assert scraper.push_manager is push_manager
+        assert isinstance(scraper.wled_client, WLEDClient)
@@ -65,7 +65,9 @@ class TestWLEDClientDetailed:
         result = client._connecting_device("192.168.1.100")
 
         mock_wled_class.assert_called_once_with(
-            host="192.168.1.100", session=mock_session
+            host="192.168.1.100",
+            session=mock_session,
+            request_timeout=8.0,
         )
         assert result == mock_wled_class.return_value
 
@@ -76,7 +78,9 @@ class TestWLEDClientDetailed:
 
         result = client._connecting_device("192.168.1.100")
 
-        mock_wled_class.assert_called_once_with(host="192.168.1.100")
+        mock_wled_class.assert_called_once_with(
+            host="192.168.1.100", request_timeout=8.0
+        )
         assert result == mock_wled_class.return_value
 
     @patch("app.wled_client.WLEDReleases")
@@ -116,7 +120,9 @@ class TestWLEDClientDetailed:
         result = await client.get_wled_instance_device("192.168.1.100")
 
         assert result == mock_device
-        mock_wled_class.assert_called_once_with(host="192.168.1.100")
+        mock_wled_class.assert_called_once_with(
+            host="192.168.1.100", request_timeout=8.0
+        )
 
     @pytest.mark.asyncio
     @patch("app.wled_client.WLED")
@@ -137,7 +143,9 @@ class TestWLEDClientDetailed:
 
         assert result == mock_device
         mock_wled_class.assert_called_once_with(
-            host="192.168.1.100", session=mock_session
+            host="192.168.1.100",
+            session=mock_session,
+            request_timeout=8.0,
         )
 
     @pytest.mark.asyncio
@@ -176,7 +184,9 @@ class TestWLEDClientDetailed:
         await client.simple_wled_test()
 
         # Verify WLED was called with default IP
-        mock_wled_class.assert_called_once_with(host="10.0.1.179")
+        mock_wled_class.assert_called_once_with(
+            host="10.0.1.179", request_timeout=8.0
+        )
         # Verify master was called to turn on
         mock_wled_instance.master.assert_called_once_with(
             on=True, brightness=255
@@ -198,7 +208,9 @@ class TestWLEDClientDetailed:
             client = WLEDClient()
             await client.simple_wled_test()
 
-            mock_wled_class.assert_called_once_with(host="192.168.1.100")
+            mock_wled_class.assert_called_once_with(
+                host="192.168.1.100", request_timeout=8.0
+            )
 
     @pytest.mark.asyncio
     @patch("app.wled_client.WLEDReleases")
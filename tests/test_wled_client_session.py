@@ -0,0 +1,271 @@
+import asyncio
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from app.scraper import Scraper
+from app.wled_client import WLEDClient
+from tests.test_websocket_push import FAKE_JSON
+
+
+class FakeWebSocketWLED:
+    """Stands in for wled.WLED, whose WebSocket always goes to port 80"""
+
+    def __init__(self, host, session, request_timeout):
+        self.host = host
+        self.session = session
+        self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def update(self):
+        return MagicMock()
+
+    async def connect(self):
+        self._client = await self.session.ws_connect(f"http://{self.host}/ws")
+
+    async def listen(self, callback):
+        await self._client.receive()
+
+    async def disconnect(self):
+        await self._client.close()
+
+
+class TestWLEDClientSharedSession:
+    """Tests for the pooled session shared by all device and backup traffic"""
+
+    def teardown_method(self):
+        WLEDClient.set_shared_session(None)
+
+    def test_http_settings_defaults(self):
+        """Test the default connection pool settings"""
+        with patch.dict(os.environ, {}, clear=True):
+            assert WLEDClient.get_http_connection_limit() == 100
+            assert WLEDClient.get_http_connection_limit_per_host() == 2
+            assert WLEDClient.get_http_keepalive_seconds() == 30.0
+            assert WLEDClient.get_http_dns_cache_ttl_seconds() == 300
+
+    def test_http_settings_custom(self):
+        """Test connection pool settings from the environment"""
+        env = {
+            "WLED_HTTP_CONNECTION_LIMIT": "20",
+            "WLED_HTTP_CONNECTION_LIMIT_PER_HOST": "1",
+            "WLED_HTTP_KEEPALIVE_SECONDS": "7.5",
+            "WLED_HTTP_DNS_CACHE_TTL_SECONDS": "60",
+        }
+        with patch.dict(os.environ, env):
+            assert WLEDClient.get_http_connection_limit() == 20
+            assert WLEDClient.get_http_connection_limit_per_host() == 1
+            assert WLEDClient.get_http_keepalive_seconds() == 7.5
+            assert WLEDClient.get_http_dns_cache_ttl_seconds() == 60
+
+    @pytest.mark.asyncio
+    async def test_create_session_uses_pool_settings(self):
+        """Test that the session connector is built from the settings"""
+        env = {
+            "WLED_HTTP_CONNECTION_LIMIT": "20",
+            "WLED_HTTP_CONNECTION_LIMIT_PER_HOST": "1",
+        }
+        with patch.dict(os.environ, env):
+            session = WLEDClient.create_session()
+        try:
+            assert isinstance(session, aiohttp.ClientSession)
+            assert session.connector.limit == 20
+            assert session.connector.limit_per_host == 1
+        finally:
+            await session.close()
+
+    def test_timeout_settings_defaults(self):
+        """Test the default device request timeouts"""
+        with patch.dict(os.environ, {}, clear=True):
+            timeout = WLEDClient.get_client_timeout()
+        assert timeout.connect == 3
+        assert timeout.sock_read == 5
+        assert timeout.total == 8
+
+    def test_timeout_settings_custom(self):
+        """Test device request timeouts from the environment"""
+        env = {
+            "WLED_CONNECT_TIMEOUT_SECONDS": "1",
+            "WLED_READ_TIMEOUT_SECONDS": "2",
+            "WLED_TOTAL_TIMEOUT_SECONDS": "4",
+        }
+        with patch.dict(os.environ, env):
+            timeout = WLEDClient.get_client_timeout()
+        assert timeout.connect == 1
+        assert timeout.sock_read == 2
+        assert timeout.total == 4
+
+    @pytest.mark.asyncio
+    async def test_create_session_uses_timeouts(self):
+        """Test that the pooled session enforces the request timeouts"""
+        with patch.dict(os.environ, {"WLED_CONNECT_TIMEOUT_SECONDS": "1.5"}):
+            session = WLEDClient.create_session()
+        try:
+            assert session.timeout.connect == 1.5
+        finally:
+            await session.close()
+
+    @patch("app.wled_client.WLED")
+    def test_connecting_device_uses_total_timeout(self, mock_wled_class):
+        """Test that the wled library gets the total request timeout"""
+        with patch.dict(os.environ, {"WLED_TOTAL_TIMEOUT_SECONDS": "4"}):
+            WLEDClient()._connecting_device("192.168.1.1")
+        mock_wled_class.assert_called_once_with(
+            host="192.168.1.1", request_timeout=4.0
+        )
+
+    @pytest.mark.asyncio
+    async def test_close_shared_session(self):
+        """Test that closing the shared session clears it"""
+        session = WLEDClient.create_session()
+        WLEDClient.set_shared_session(session)
+        assert WLEDClient.get_shared_session() is session
+
+        await WLEDClient.close_shared_session()
+
+        assert session.closed
+        assert WLEDClient.get_shared_session() is None
+
+    @pytest.mark.asyncio
+    async def test_close_shared_session_without_session(self):
+        """Test that closing without a shared session is a no-op"""
+        await WLEDClient.close_shared_session()
+        assert WLEDClient.get_shared_session() is None
+
+    def test_get_client_defaults_to_shared_session(self):
+        """Test that new clients pick up the shared session"""
+        mock_session = MagicMock()
+        WLEDClient.set_shared_session(mock_session)
+        assert WLEDClient.get_client().session is mock_session
+
+    def test_get_client_explicit_session_wins(self):
+        """Test that an explicit session overrides the shared one"""
+        WLEDClient.set_shared_session(MagicMock())
+        explicit_session = MagicMock()
+        client = WLEDClient.get_client(session=explicit_session)
+        assert client.session is explicit_session
+
+    def test_scraper_get_client_passes_session(self):
+        """Test that Scraper.get_client threads the session through"""
+        mock_session = MagicMock()
+        scraper = Scraper.get_client(session=mock_session)
+        assert scraper.wled_client.session is mock_session
+
+    @pytest.mark.asyncio
+    @patch("app.wled_client.WLED")
+    async def test_device_requests_use_shared_session(self, mock_wled_class):
+        """Test that device connections reuse the shared session"""
+        mock_wled_instance = AsyncMock()
+        mock_wled_instance.__aenter__.return_value.update.return_value = (
+            MagicMock()
+        )
+        mock_wled_class.return_value = mock_wled_instance
+        mock_session = MagicMock()
+        WLEDClient.set_shared_session(mock_session)
+
+        await WLEDClient.get_client().get_wled_instance_device("192.168.1.1")
+
+        mock_wled_class.assert_called_once_with(
+            host="192.168.1.1", session=mock_session, request_timeout=8.0
+        )
+
+    @pytest.mark.asyncio
+    async def test_backup_uses_shared_session(self, tmp_path):
+        """Test that backups reuse the client session instead of a new one"""
+        mock_response = AsyncMock()
+        mock_response.status = 200
+        mock_response.json.return_value = {"id": {"name": "test"}}
+        mock_get = MagicMock()
+        mock_get.__aenter__ = AsyncMock(return_value=mock_response)
+        mock_get.__aexit__ = AsyncMock(return_value=False)
+        mock_session = MagicMock()
+        mock_session.get.return_value = mock_get
+
+        scraper = Scraper.get_client(session=mock_session)
+        with patch("app.scraper.aiohttp.ClientSession") as mock_cls:
+            result = await scraper.backup_config_from_instance(
+                "192.168.1.1", str(tmp_path)
+            )
+
+        assert result["status"] == "success"
+        mock_session.get.assert_called_once()
+        mock_cls.assert_not_called()
+
+
+class TestWLEDClientPushSession:
+    """Tests for keeping the WebSockets out of the pooled session"""
+
+    def teardown_method(self):
+        WLEDClient.set_shared_session(None)
+        WLEDClient.set_push_session(None)
+
+    @pytest.mark.asyncio
+    async def test_create_push_session_is_unlimited(self):
+        """Test the WebSocket session never waits for a free connection"""
+        session = WLEDClient.create_push_session()
+        WLEDClient.set_push_session(session)
+        assert session.connector.limit == 0
+        assert session.connector.limit_per_host == 0
+        assert WLEDClient.get_client().push_session is session
+        await WLEDClient.close_shared_session()
+        assert session.closed
+        assert WLEDClient.get_push_session() is None
+
+    @pytest.mark.asyncio
+    async def test_push_connections_leave_the_pool_free(self):
+        """Test N WebSockets and an HTTP fetch work with a pool of N"""
+        connections = 2
+        closing = asyncio.Event()
+
+        async def handle_ws(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            await closing.wait()
+            await ws.close()
+            return ws
+
+        async def handle_info(request):
+            return web.json_response(FAKE_JSON["info"])
+
+        server = web.Application()
+        server.router.add_get("/ws", handle_ws)
+        server.router.add_get("/json/info", handle_info)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host = f"127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+        env = {"WLED_HTTP_CONNECTION_LIMIT": str(connections)}
+        with patch.dict(os.environ, env):
+            WLEDClient.set_shared_session(WLEDClient.create_session())
+        WLEDClient.set_push_session(WLEDClient.create_push_session())
+        client = WLEDClient.get_client()
+        connected = []
+        try:
+            with patch("app.wled_client.WLED", FakeWebSocketWLED):
+                listeners = [
+                    asyncio.create_task(
+                        client.listen_wled_instance(host, connected.append)
+                    )
+                    for _ in range(connections)
+                ]
+                while len(connected) < connections:
+                    await asyncio.sleep(0.01)
+                info = await asyncio.wait_for(
+                    client.get_wled_instance_info(host), timeout=5
+                )
+            assert info["ver"] == FAKE_JSON["info"]["ver"]
+        finally:
+            closing.set()
+            await asyncio.gather(*listeners, return_exceptions=True)
+            await WLEDClient.close_shared_session()
+            await runner.cleanup()